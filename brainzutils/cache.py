@@ -12,20 +12,88 @@ versions of data saved in the cache.
 
 More information about Redis can be found at http://redis.io/.
 """
+import asyncio
+import bisect
 import builtins
+import contextvars
+import decimal
+import hashlib
+import inspect
+import itertools
+import json
+import math
 import os
+import random
 import socket
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 import datetime
 import re
 from typing import Optional
 
 import redis
+import redis.asyncio
 import msgpack
 
+from brainzutils import cache_breaker, cache_scripts, cache_shared, cache_stats, cache_tracking
+# pylint: disable=unused-import
+# Public names of the parts of the cache in other modules are also available from this module
+from brainzutils.cache_breaker import CircuitOpenError
+from brainzutils.cache_shared import SHARED_CACHE_WAYS
+from brainzutils.cache_stats import LATENCY_BUCKETS, PAYLOAD_BUCKETS
+from brainzutils.cache_tracking import INVALIDATION_CHANNEL
+# pylint: enable=unused-import
+
 
 _r: redis.StrictRedis = None
+# Clients of all nodes when keys are distributed between multiple nodes, _r is the first one
+_clients: list = []
+# Connections of redis.asyncio are bound to the event loop that opened them, so every event loop
+# gets its own asyncio clients: loop -> (clients of all nodes, clients of their replicas)
+_loop_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_loop_clients_lock = threading.Lock()
+_async_connection_args: tuple = ([], [], None, None)
+_ring: list = []  # sorted hashes of the points of the consistent hashing ring
+_ring_nodes: list = []  # index of the node that each point belongs to
+_executor: Optional[ThreadPoolExecutor] = None
+# Clients of the replicas of each node
+_replica_clients: list = []
+_read_your_writes: float = 0
+_recent_writes: OrderedDict = OrderedDict()  # key -> time until which it's read from the primary
+_recent_writes_lock = threading.Lock()
+_breaker: Optional[cache_breaker.CircuitBreaker] = None
+_instrumentation: Optional[cache_stats.Instrumentation] = None
+_hot_keys: Optional[cache_stats.HotKeys] = None
+_chunk_size: int = 1000
+_pipeline_chunks: bool = False
+_init_args: Optional[dict] = None  # Arguments of the last init call, for reset
 _glob_namespace: str = None
+_local: Optional["_LocalCache"] = None
+_local_namespaces: frozenset = frozenset()
+_shared: Optional[cache_shared.SharedCache] = None
+_shared_namespaces: frozenset = frozenset()
+_tracking: Optional[cache_tracking.TrackingCache] = None
+_tracking_namespaces: frozenset = frozenset()
+_namespace_versions: dict = {}  # namespace -> (version, time until which it's valid)
+_namespace_version_ttl: float = 5
+_serializer: Optional["MsgpackSerializer"] = None
+_namespace_serializers: dict = {}
+_compression_threshold: Optional[int] = None
+_compression_level: int = 6
+_unlink_supported: bool = True  # UNLINK was added in Redis 4.0
+_smismember_supported: bool = True  # SMISMEMBER was added in Redis 6.2
+
+# Locks of the keys that are being computed in get_or_compute by threads of this process
+_compute_locks = weakref.WeakValueDictionary()
+_compute_locks_lock = threading.Lock()
 
 NS_REGEX = re.compile('[a-zA-Z0-9_-]+$')
 CONTENT_ENCODING = "utf-8"
@@ -33,10 +101,26 @@ ENCODING_ASCII = "ascii"
 
 
 def init(host: str = "localhost", port: int = 6379, db_number: int = 0,
-         namespace: str = "", client_name: str = None):
+         namespace: str = "", client_name: str = None,
+         local_cache_namespaces: Optional[list] = None, local_cache_max_entries: int = 1024,
+         local_cache_max_bytes: int = 16 * 1024 * 1024, local_cache_ttl: int = 60,
+         unix_socket_path: str = None, max_connections: int = None, pool_timeout: float = None,
+         socket_connect_timeout: float = None, socket_timeout: float = None,
+         socket_keepalive: bool = None, health_check_interval: int = None,
+         compression_threshold: int = None, compression_level: int = 6,
+         namespace_version_ttl: float = 5, serializer=None, namespace_serializers: dict = None,
+         client_tracking_namespaces: Optional[list] = None, client_tracking_max_entries: int = 10000,
+         nodes: Optional[list] = None, replicas: Optional[list] = None, read_your_writes: float = 0,
+         circuit_breaker_failures: int = 0, circuit_breaker_latency: float = None,
+         circuit_breaker_reset_timeout: float = 10, circuit_breaker_fail_silently: bool = True,
+         instrumentation: bool = False, chunk_size: int = 1000, pipeline_chunks: bool = False,
+         shared_cache_namespaces: Optional[list] = None, shared_cache_path: str = None,
+         shared_cache_size: int = 64 * 1024 * 1024, shared_cache_slot_size: int = 2048,
+         shared_cache_ttl: int = 60, hot_keys_sample_rate: float = 0, hot_keys_top: int = 20):
     """Initializes Redis client. Needs to be called before use.
 
-    Namespace versions are stored in a local directory.
+    Namespace versions are stored in Redis and cached in the process for
+    ``namespace_version_ttl`` seconds, see :meth:`invalidate_namespace`.
 
     Args:
         host: Redis server hostname.
@@ -45,7 +129,93 @@ def init(host: str = "localhost", port: int = 6379, db_number: int = 0,
         namespace: Global namespace that will be prepended to all keys.
         client_name: The client name to assign to the redis connection. This value is used to identify which clients
           are connected to a server, and is only used for debugging purposes.
+        local_cache_namespaces: Namespaces whose items are also kept in an in-process LRU cache in front of
+          Redis. The local cache is disabled if this is empty. Only use it for data that rarely changes, other
+          processes' writes become visible only after ``local_cache_ttl`` seconds.
+        local_cache_max_entries: Maximum number of items kept in the local cache.
+        local_cache_max_bytes: Maximum total size of the (encoded) values kept in the local cache.
+        local_cache_ttl: Number of seconds after which an item in the local cache expires.
+        unix_socket_path: Path of a unix domain socket to connect to instead of ``host`` and ``port``.
+        max_connections: Maximum number of connections in the connection pool (unlimited by default).
+        pool_timeout: If set, a blocking connection pool is used: when all ``max_connections`` (50 if
+          not set) connections are in use, callers wait up to this many seconds for a free connection
+          instead of failing immediately.
+        socket_connect_timeout: Timeout for connecting to Redis, in seconds.
+        socket_timeout: Timeout for Redis commands, in seconds.
+        socket_keepalive: True if TCP keepalive should be enabled on the connections.
+        health_check_interval: Connections that have been idle for this many seconds are checked
+          with a PING before they are used.
+        compression_threshold: If set, encoded values larger than this many bytes are compressed
+          with zlib. Compressed and uncompressed values can be read regardless of this setting.
+        compression_level: zlib compression level, from 1 (fastest) to 9 (smallest).
+        namespace_version_ttl: Number of seconds for which namespace versions are cached in the process.
+          Invalidations of a namespace by other processes take up to this long to become visible.
+        serializer: Serializer used to encode values, :class:`MsgpackSerializer` by default.
+        namespace_serializers: A dict of namespace/serializer pairs to encode values in some namespaces
+          differently. Changing the serializer of a namespace makes its existing items unreadable, so
+          the namespace should be invalidated when doing that.
+        client_tracking_namespaces: Namespaces whose items are kept in the process using client side
+          caching of Redis 6+: a background thread receives invalidation messages from Redis for all keys
+          in these namespaces and removes changed items from the process, so they're always up to date.
+          This works best for items that are read often and rarely change, like configuration. Returned
+          values are shared between callers and must not be modified.
+        client_tracking_max_entries: Maximum number of items kept in the process with client side caching.
+        nodes: Multiple Redis servers to distribute keys between, as a list of dicts with ``host`` and
+          ``port`` or ``unix_socket_path`` and optionally ``db_number`` of each node. Keys are assigned
+          to nodes with consistent hashing, so adding or removing a node moves only a small part of
+          the keys. Functions working with multiple keys query all involved nodes in parallel. If
+          not set, the single node given by ``host`` and ``port`` (or ``unix_socket_path``) is used.
+          All other options apply to each node. A node can have a ``replicas`` list, see below.
+        replicas: Replicas of the node given by ``host`` and ``port``, as a list of dicts with ``host``
+          and ``port`` or ``unix_socket_path``. Read-only commands (the get, hgetall, hkeys and smembers
+          functions) are sent to a random replica, all other commands to the primary. Keep in mind
+          that replicas may lag behind the primary. Client side caching always reads from the primary.
+        read_your_writes: Number of seconds after this process writes a key during which the key is
+          read from the primary instead of the replicas, so that the process sees its own writes.
+        circuit_breaker_failures: Number of consecutive failed calls after which the circuit breaker
+          opens, 0 to disable it. While the circuit breaker is open, calls don't wait for Redis:
+          reads return misses (None or empty collections), writes are dropped and return False or 0,
+          and :meth:`get_or_compute` computes values without storing them. Calls fail if they can't
+          connect to Redis or time out. Only calls of functions for single items (get, set, hgetall,
+          etc.) and their ``_many`` and async versions are affected.
+        circuit_breaker_latency: If set, calls that take longer than this many seconds also count
+          as failures.
+        circuit_breaker_reset_timeout: Number of seconds after which an open circuit breaker lets a
+          single call through to check if Redis is back. If it succeeds, the circuit breaker closes.
+        circuit_breaker_fail_silently: If False, calls raise :class:`CircuitOpenError` instead of
+          returning misses while the circuit breaker is open.
+        instrumentation: True to record latencies and payload sizes of commands and hit ratios of
+          namespaces, see :meth:`command_stats`.
+        chunk_size: Maximum number of keys in a single command of the functions for multiple items
+          (get_many, set_many and delete_many), larger batches are split into multiple commands so
+          they don't block Redis for long, 0 to never split them. Items written with an expiration
+          time or a condition are stored atomically per chunk.
+        pipeline_chunks: True to send all chunks of a batch in a single pipeline, which saves round
+          trips but loses the atomicity of chunks written with an expiration time or a condition.
+        shared_cache_namespaces: Namespaces whose items are also kept in a cache in shared memory that
+          is used by all processes on the host (e.g. gunicorn workers), between the local cache and
+          Redis. Like for the local cache, only use it for data that rarely changes. Requires a
+          platform with ``fcntl``.
+        shared_cache_path: Path of the memory-mapped file of the shared cache. By default it's a file
+          in ``/dev/shm`` (or the temporary directory) named after the user, the global namespace, the
+          Redis servers and databases and the size options. All processes that use the same file need
+          to use the same size options. The file must belong to the user and must not be writable by
+          other users.
+        shared_cache_size: Size of the shared cache in bytes.
+        shared_cache_slot_size: Size of a slot of the shared cache in bytes. Items whose key and value
+          don't fit into a slot (with a small header) are not stored in the shared cache.
+        shared_cache_ttl: Number of seconds after which an item in the shared cache expires.
+        hot_keys_sample_rate: Fraction of the keys read with the get functions that are counted to find
+          the most frequently read keys of every namespace, see :meth:`hot_keys`. 0 disables it.
+        hot_keys_top: Number of the most frequently read keys that are reported for every namespace.
+
+    Options of the connection pool that are not set use the defaults of the redis package.
+
+    The module can be initialized before the process forks, e.g. with gunicorn's ``--preload``:
+    child processes reinitialize it with the same options, see :meth:`reset`.
     """
+    global _init_args
+    _init_args = dict(locals())
 
     # The first priority in setting the client name is to set the user specified
     # client_name as this can come in handy during testing and development. Otherwise,
@@ -57,31 +227,740 @@ def init(host: str = "localhost", port: int = 6379, db_number: int = 0,
     if client_name is None:
         client_name = socket.gethostname()
 
-    global _r, _glob_namespace
-    _r = redis.StrictRedis(
-        host=host,
-        port=port,
-        db=db_number,
-        client_name=client_name
-    )
+    common_kwargs = {
+        "client_name": client_name,
+        "socket_connect_timeout": socket_connect_timeout,
+        "socket_timeout": socket_timeout,
+        "socket_keepalive": socket_keepalive,
+        "health_check_interval": health_check_interval,
+    }
+    common_kwargs = {k: v for k, v in common_kwargs.items() if v is not None}
+    if not nodes:
+        nodes = [{"host": host, "port": port, "unix_socket_path": unix_socket_path, "db_number": db_number,
+                  "replicas": replicas}]
+    nodes_kwargs = [_node_connection_kwargs(node, common_kwargs, host, port, db_number) for node in nodes]
+    replicas_kwargs = [
+        [_node_connection_kwargs(replica, common_kwargs, host, port, node_kwargs["db"])
+         for replica in node.get("replicas") or []]
+        for node, node_kwargs in zip(nodes, nodes_kwargs)
+    ]
+
+    global _r, _glob_namespace, _local, _local_namespaces, _compression_threshold, _compression_level, \
+        _namespace_version_ttl, _serializer, _namespace_serializers, _tracking, _tracking_namespaces, \
+        _clients, _loop_clients, _async_connection_args, _ring, _ring_nodes, _executor, _replica_clients, \
+        _read_your_writes, _breaker, _instrumentation, _chunk_size, _pipeline_chunks, _shared, _shared_namespaces, _hot_keys
+    _clients = [
+        redis.StrictRedis(connection_pool=_connection_pool(redis, node_kwargs, max_connections, pool_timeout))
+        for node_kwargs in nodes_kwargs
+    ]
+    # Asyncio clients are created once they're used from an event loop
+    _loop_clients = weakref.WeakKeyDictionary()
+    _async_connection_args = (nodes_kwargs, replicas_kwargs, max_connections, pool_timeout)
+    _replica_clients = [
+        [redis.StrictRedis(connection_pool=_connection_pool(redis, kwargs, max_connections, pool_timeout))
+         for kwargs in node_replicas_kwargs]
+        for node_replicas_kwargs in replicas_kwargs
+    ]
+    _read_your_writes = read_your_writes
+    with _recent_writes_lock:
+        _recent_writes.clear()
+    _r = _clients[0]
+    _ring, _ring_nodes = _hash_ring(nodes_kwargs)
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(len(_clients), "brainzutils-cache") if len(_clients) > 1 else None
 
     _glob_namespace = namespace + ":"
+    _namespace_versions.clear()
+    _namespace_version_ttl = namespace_version_ttl
+    _serializer = serializer or MsgpackSerializer()
+    _namespace_serializers = dict(namespace_serializers or {})
+    _compression_threshold = compression_threshold
+    _compression_level = compression_level
+
+    if circuit_breaker_failures:
+        _breaker = cache_breaker.CircuitBreaker(circuit_breaker_failures, circuit_breaker_latency,
+                                                circuit_breaker_reset_timeout, circuit_breaker_fail_silently)
+    else:
+        _breaker = None
+
+    _instrumentation = cache_stats.Instrumentation() if instrumentation else None
+    _hot_keys = cache_stats.HotKeys(hot_keys_sample_rate, hot_keys_top) if hot_keys_sample_rate else None
+    _chunk_size = chunk_size
+    _pipeline_chunks = pipeline_chunks
+
+    if local_cache_namespaces:
+        _local = _LocalCache(local_cache_max_entries, local_cache_max_bytes, local_cache_ttl)
+        _local_namespaces = frozenset(local_cache_namespaces)
+    else:
+        _local = None
+        _local_namespaces = frozenset()
+
+    if _shared is not None:
+        _shared.close()
+    if shared_cache_namespaces:
+        if cache_shared.fcntl is None:
+            raise RuntimeError("The shared cache requires the fcntl module")
+        if shared_cache_path is None:
+            shared_cache_path = _shared_cache_path(namespace, nodes_kwargs, shared_cache_size, shared_cache_slot_size)
+        _shared = cache_shared.SharedCache(shared_cache_path, shared_cache_size, shared_cache_slot_size, shared_cache_ttl)
+        _shared_namespaces = frozenset(shared_cache_namespaces)
+    else:
+        _shared = None
+        _shared_namespaces = frozenset()
+
+    if _tracking is not None:
+        _tracking.stop()
+    if client_tracking_namespaces:
+        # Invalidation messages are received as pub/sub messages, which needs the RESP2 protocol.
+        # Health checks would send commands on the subscribed connection, so they're disabled.
+        _tracking = cache_tracking.TrackingCache(
+            [_listener_connection_factory(node_kwargs) for node_kwargs in nodes_kwargs],
+            # Keys of a namespace start with "ns:" or, once it's invalidated, "ns@<version>:". Both
+            # separators are needed, as Redis rejects prefixes that overlap, like "release" and
+            # "release_group".
+            list(dict.fromkeys(_glob_namespace + ns + separator
+                               for ns in client_tracking_namespaces for separator in (":", "@"))),
+            client_tracking_max_entries,
+            lambda value, namespace: _decode_val(value, namespace=namespace),
+        )
+        _tracking_namespaces = frozenset(client_tracking_namespaces)
+    else:
+        _tracking = None
+        _tracking_namespaces = frozenset()
+
+
+def _node_connection_kwargs(node, common_kwargs, host, port, db_number):
+    """Returns connection arguments for a node given as a dict, with defaults from init."""
+    node_kwargs = dict(common_kwargs, db=node.get("db_number", db_number))
+    if node.get("unix_socket_path"):
+        node_kwargs["path"] = node["unix_socket_path"]
+    else:
+        node_kwargs.update(host=node.get("host", host), port=node.get("port", port))
+    return node_kwargs
+
+
+def _connection_pool(module, connection_kwargs, max_connections, pool_timeout):
+    """Creates a connection pool for either the redis or the redis.asyncio module."""
+    if "path" in connection_kwargs:
+        connection_kwargs = dict(connection_kwargs, connection_class=module.UnixDomainSocketConnection)
+    if pool_timeout is None:
+        return module.ConnectionPool(max_connections=max_connections, **connection_kwargs)
+    return module.BlockingConnectionPool(max_connections=max_connections or 50, timeout=pool_timeout,
+                                         **connection_kwargs)
+
+
+def _async_clients():
+    """Returns the asyncio clients of all nodes and the clients of their replicas for the running event loop."""
+    _use_redis()
+    loop = asyncio.get_running_loop()
+    clients = _loop_clients.get(loop)
+    if clients is None:
+        nodes_kwargs, replicas_kwargs, max_connections, pool_timeout = _async_connection_args
+        with _loop_clients_lock:
+            clients = _loop_clients.setdefault(loop, (
+                [redis.asyncio.StrictRedis(
+                    connection_pool=_connection_pool(redis.asyncio, node_kwargs, max_connections, pool_timeout))
+                 for node_kwargs in nodes_kwargs],
+                [[redis.asyncio.StrictRedis(
+                    connection_pool=_connection_pool(redis.asyncio, kwargs, max_connections, pool_timeout))
+                  for kwargs in node_replicas_kwargs]
+                 for node_replicas_kwargs in replicas_kwargs],
+            ))
+    return clients
+
+
+def _listener_connection_factory(connection_kwargs):
+    """Returns a function that creates connections for receiving invalidation messages."""
+    # Invalidation messages are received as pub/sub messages, which needs the RESP2 protocol.
+    # Health checks would send commands on the subscribed connection, so they're disabled.
+    connection_kwargs = dict(connection_kwargs, protocol=2)
+    connection_kwargs.pop("health_check_interval", None)
+    connection_class = redis.UnixDomainSocketConnection if "path" in connection_kwargs else redis.Connection
+    return lambda: connection_class(**connection_kwargs)
+
+
+def _reinit_after_fork():
+    global _tracking, _executor, _shared, _compute_locks_lock, _recent_writes_lock, _loop_clients_lock
+    if _init_args is None:
+        return
+    # Threads of the parent don't exist in the child and their locks may be held, so
+    # objects that use them are dropped instead of being stopped. Connections of the
+    # parent are left alone, redis-py only closes them in the process that opened them.
+    _tracking = None
+    _executor = None
+    _shared = None
+    _compute_locks_lock = threading.Lock()
+    _compute_locks.clear()
+    _recent_writes_lock = threading.Lock()
+    _loop_clients_lock = threading.Lock()
+    init(**_init_args)
+
+
+os.register_at_fork(after_in_child=_reinit_after_fork)
+
+
+##########
+# SHARDING
+##########
+
+# Number of points of each node on the consistent hashing ring
+RING_POINTS_PER_NODE = 160
+
+
+def _hash_ring(nodes_kwargs):
+    """Builds the consistent hashing ring for the given nodes.
+
+    Points are derived from the address of the nodes, not from their order.
+
+    Returns:
+        Sorted hashes of the points and the index of the node of each point.
+    """
+    points = []
+    for index, node_kwargs in enumerate(nodes_kwargs):
+        address = node_kwargs.get("path") or "%s:%s" % (node_kwargs["host"], node_kwargs["port"])
+        name = "%s/%s" % (address, node_kwargs["db"])
+        for i in range(RING_POINTS_PER_NODE):
+            points.append((_key_hash("%s-%d" % (name, i)), index))
+    points.sort()
+    return [point for point, _ in points], [index for _, index in points]
 
 
-def init_required(f):
+def _key_hash(key):
+    if not isinstance(key, bytes):
+        key = key.encode(CONTENT_ENCODING)
+    return int.from_bytes(hashlib.md5(key).digest()[:4], "big")
+
+
+def _node_index(prepared_key):
+    """Returns the index of the node that stores a key."""
+    if len(_clients) == 1:
+        return 0
+    return _ring_nodes[bisect.bisect(_ring, _key_hash(prepared_key)) % len(_ring)]
+
+
+def _client(prepared_key):
+    """Returns the client of the primary of the node that stores a key, for commands that modify it."""
+    _use_redis()
+    _mark_written([prepared_key])
+    return _clients[_node_index(prepared_key)]
+
+
+def _aclient(prepared_key):
+    """Async version of _client."""
+    _mark_written([prepared_key])
+    return _async_clients()[0][_node_index(prepared_key)]
+
+
+def _read_client(prepared_key):
+    """Returns a client for read-only commands for a key, a replica if possible."""
+    return _read_node_client(_node_index(prepared_key), [prepared_key], _clients, _replica_clients)
+
+
+def _aread_client(prepared_key):
+    """Async version of _read_client."""
+    return _read_node_client(_node_index(prepared_key), [prepared_key], *_async_clients())
+
+
+def _read_node_client(node, prepared_keys, clients, replica_clients):
+    """Picks a random replica of a node, or the primary if the node has no replicas or
+    some of the keys were recently written by this process."""
+    _use_redis()
+    replicas = replica_clients[node] if replica_clients else None
+    if not replicas or _recently_written(prepared_keys):
+        return clients[node]
+    return random.choice(replicas)
+
+
+def _mark_written(prepared_keys):
+    if not _read_your_writes:
+        return
+    now = time.monotonic()
+    with _recent_writes_lock:
+        # All keys are kept for the same time, so the oldest entries expire first
+        while _recent_writes:
+            prepared_key, until = _recent_writes.popitem(last=False)
+            if until > now:
+                _recent_writes[prepared_key] = until
+                _recent_writes.move_to_end(prepared_key, last=False)
+                break
+        for prepared_key in prepared_keys:
+            _recent_writes.pop(prepared_key, None)
+            _recent_writes[prepared_key] = now + _read_your_writes
+
+
+def _recently_written(prepared_keys):
+    if not _read_your_writes or not _recent_writes:
+        return False
+    now = time.monotonic()
+    with _recent_writes_lock:
+        return any(_recent_writes.get(prepared_key, 0) > now for prepared_key in prepared_keys)
+
+
+def _group_by_node(prepared_keys):
+    """Groups keys by the node that stores them.
+
+    Returns:
+        A dict of node index/list of indexes of its keys.
+    """
+    if len(_clients) == 1:
+        return {0: list(range(len(prepared_keys)))}
+    groups = {}
+    for i, prepared_key in enumerate(prepared_keys):
+        groups.setdefault(_node_index(prepared_key), []).append(i)
+    return groups
+
+
+def _fan_out(fn, groups):
+    """Calls ``fn(node index, indexes)`` for every group of _group_by_node, in parallel if there are several.
+
+    Returns:
+        A dict of node index/result of the call.
+    """
+    _use_redis()
+    if len(groups) == 1:
+        node, indexes = next(iter(groups.items()))
+        return {node: fn(node, indexes)}
+    futures = {node: _executor.submit(fn, node, indexes) for node, indexes in groups.items()}
+    return {node: future.result() for node, future in futures.items()}
+
+
+async def _afan_out(fn, groups):
+    """Async version of _fan_out, ``fn`` needs to be a coroutine function."""
+    results = await asyncio.gather(*(fn(node, indexes) for node, indexes in groups.items()))
+    return dict(zip(groups.keys(), results))
+
+
+def _merge(groups, results, count):
+    """Puts results of _fan_out for lists of keys back in the order of the keys."""
+    values = [None] * count
+    for node, indexes in groups.items():
+        for i, value in zip(indexes, results[node]):
+            values[i] = value
+    return values
+
+
+def _mget(prepared_keys, replica=True):
+    """Gets values of keys, from replicas if ``replica`` is True and the nodes have them."""
+    groups = _group_by_node(prepared_keys)
+
+    def mget(node, indexes):
+        node_keys = [prepared_keys[i] for i in indexes]
+        if not replica:
+            return _chunked_mget(_clients[node], node_keys)
+        return _chunked_mget(_read_node_client(node, node_keys, _clients, _replica_clients), node_keys)
+
+    return _merge(groups, _fan_out(mget, groups), len(prepared_keys))
+
+
+async def _amget(prepared_keys, replica=True):
+    groups = _group_by_node(prepared_keys)
+
+    async def mget(node, indexes):
+        node_keys = [prepared_keys[i] for i in indexes]
+        if not replica:
+            return await _achunked_mget(_async_clients()[0][node], node_keys)
+        return await _achunked_mget(_read_node_client(node, node_keys, *_async_clients()), node_keys)
+
+    return _merge(groups, await _afan_out(mget, groups), len(prepared_keys))
+
+
+def _set_items(items, nx=False, xx=False):
+    """Writes items prepared with _prep_items, see set_many."""
+    groups = _group_by_node([prepared_key for prepared_key, _, _ in items])
+    _mark_written([prepared_key for prepared_key, _, _ in items])
+
+    def set_node_items(node, indexes):
+        return _chunked_set(_clients[node], [items[i] for i in indexes], nx, xx)
+
+    return all(_fan_out(set_node_items, groups).values())
+
+
+async def _aset_items(items, nx=False, xx=False):
+    groups = _group_by_node([prepared_key for prepared_key, _, _ in items])
+    _mark_written([prepared_key for prepared_key, _, _ in items])
+
+    async def set_node_items(node, indexes):
+        return await _achunked_set(_async_clients()[0][node], [items[i] for i in indexes], nx, xx)
+
+    return all((await _afan_out(set_node_items, groups)).values())
+
+
+def _delete(prepared_keys):
+    groups = _group_by_node(prepared_keys)
+    _mark_written(prepared_keys)
+    results = _fan_out(lambda node, indexes: _chunked_delete(_clients[node], [prepared_keys[i] for i in indexes]),
+                       groups)
+    return sum(results.values())
+
+
+async def _adelete(prepared_keys):
+    groups = _group_by_node(prepared_keys)
+    _mark_written(prepared_keys)
+
+    async def delete_node_keys(node, indexes):
+        return await _achunked_delete(_async_clients()[0][node], [prepared_keys[i] for i in indexes])
+
+    return sum((await _afan_out(delete_node_keys, groups)).values())
+
+
+def _chunks(seq):
+    """Splits a list into chunks of at most chunk_size items."""
+    if not _chunk_size or len(seq) <= _chunk_size:
+        return [seq]
+    return [seq[i:i + _chunk_size] for i in range(0, len(seq), _chunk_size)]
+
+
+def _chunked_mget(client, keys):
+    chunks = _chunks(keys)
+    if len(chunks) == 1:
+        return client.mget(keys)
+    if _pipeline_chunks:
+        pipe = client.pipeline(transaction=False)
+        for chunk in chunks:
+            pipe.mget(chunk)
+        results = pipe.execute()
+    else:
+        results = [client.mget(chunk) for chunk in chunks]
+    return [value for result in results for value in result]
+
+
+async def _achunked_mget(client, keys):
+    chunks = _chunks(keys)
+    if len(chunks) == 1:
+        return await client.mget(keys)
+    if _pipeline_chunks:
+        async with client.pipeline(transaction=False) as pipe:
+            for chunk in chunks:
+                pipe.mget(chunk)
+            results = await pipe.execute()
+    else:
+        results = [await client.mget(chunk) for chunk in chunks]
+    return [value for result in results for value in result]
+
+
+def _chunked_set(client, items, nx, xx):
+    """Writes items of a node with MSET, or with SET commands in a transaction if they
+    need an expiration time or a condition."""
+    chunks = _chunks(items)
+    use_mset = not nx and not xx and not any(ttl for _, _, ttl in items)
+    if _pipeline_chunks and len(chunks) > 1:
+        pipe = client.pipeline(transaction=False)
+        for chunk in chunks:
+            if use_mset:
+                pipe.mset({prepared_key: value for prepared_key, value, _ in chunk})
+            else:
+                _pipeline_set(pipe, chunk, nx, xx)
+        return all(pipe.execute())
+    result = True
+    for chunk in chunks:
+        if use_mset:
+            result = client.mset({prepared_key: value for prepared_key, value, _ in chunk}) and result
+        else:
+            pipe = client.pipeline(transaction=True)
+            _pipeline_set(pipe, chunk, nx, xx)
+            result = all(pipe.execute()) and result
+    return result
+
+
+async def _achunked_set(client, items, nx, xx):
+    chunks = _chunks(items)
+    use_mset = not nx and not xx and not any(ttl for _, _, ttl in items)
+    if _pipeline_chunks and len(chunks) > 1:
+        async with client.pipeline(transaction=False) as pipe:
+            for chunk in chunks:
+                if use_mset:
+                    pipe.mset({prepared_key: value for prepared_key, value, _ in chunk})
+                else:
+                    _pipeline_set(pipe, chunk, nx, xx)
+            return all(await pipe.execute())
+    result = True
+    for chunk in chunks:
+        if use_mset:
+            result = await client.mset({prepared_key: value for prepared_key, value, _ in chunk}) and result
+        else:
+            async with client.pipeline(transaction=True) as pipe:
+                _pipeline_set(pipe, chunk, nx, xx)
+                result = all(await pipe.execute()) and result
+    return result
+
+
+def _chunked_delete(client, keys):
+    chunks = _chunks(keys)
+    if _pipeline_chunks and len(chunks) > 1:
+        pipe = client.pipeline(transaction=False)
+        for chunk in chunks:
+            pipe.delete(*chunk)
+        return sum(pipe.execute())
+    return sum(client.delete(*chunk) for chunk in chunks)
+
+
+async def _achunked_delete(client, keys):
+    chunks = _chunks(keys)
+    if _pipeline_chunks and len(chunks) > 1:
+        async with client.pipeline(transaction=False) as pipe:
+            for chunk in chunks:
+                pipe.delete(*chunk)
+            return sum(await pipe.execute())
+    return sum([await client.delete(*chunk) for chunk in chunks])
+
+
+#################
+# CIRCUIT BREAKER
+#################
+
+def _returns(factory):
+    """Returns a function that ignores its arguments and returns a new value from factory."""
+    return lambda *args, **kwargs: factory()
+
+
+def _circuit_open():
+    return _breaker is not None and _breaker.state != cache_breaker.CircuitBreaker.CLOSED
+
+
+# Set by _command for the current call, functions that pick a Redis client mark it as used, so
+# that the circuit breaker can ignore calls that were answered from the in-process caches
+_redis_used = contextvars.ContextVar("brainzutils_cache_redis_used", default=None)
+
+
+def _use_redis():
+    used = _redis_used.get()
+    if used is not None:
+        used[0] = True
+
+
+def circuit_breaker_stats():
+    """Returns the state of the circuit breaker.
+
+    Returns:
+        A dictionary with the state ("closed", "open" or "half_open"), the number of consecutive
+        failures, the number of times the circuit breaker opened and the number of short-circuited
+        calls, or None if the circuit breaker is disabled.
+    """
+    if _breaker is None:
+        return None
+    return _breaker.stats()
+
+
+#################
+# INSTRUMENTATION
+#################
+
+# Name of the command that is being executed, so that nested calls aren't counted again
+_current_command = contextvars.ContextVar("brainzutils_cache_command", default=None)
+
+
+def _record_payload(values):
+    """Records the total size of values that were sent to or received from Redis by the current command."""
+    instrumentation = _instrumentation
+    if instrumentation is not None:
+        size = sum(len(value) for value in values if value is not None)
+        instrumentation.record_payload(_current_command.get(), size)
+
+
+def _record_lookups(namespace, result):
+    instrumentation = _instrumentation
+    if instrumentation is not None:
+        misses = sum(1 for value in result.values() if value is None)
+        instrumentation.record_lookups(namespace, len(result) - misses, misses)
+
+
+def command_stats(reset=False):
+    """Returns statistics of commands and namespaces recorded with the ``instrumentation`` option of :meth:`init`.
+
+    Commands are the public functions of this module that access Redis, a command that calls
+    another one (e.g. :meth:`get` calling :meth:`get_many`) is only counted once. Histograms are
+    dicts with the number of values, their sum, a list of (upper bound, count) pairs of the buckets
+    and upper bounds of the buckets that contain the median and the 99th percentile.
+
+    Args:
+        reset: True to reset the statistics after taking the snapshot.
+
+    Returns:
+        A dict with ``commands``, a dict of the command names with the number of calls and of calls
+        that failed because Redis was unavailable, a histogram of latencies in seconds and a histogram
+        of the sizes of written or read values in bytes (for commands that get or set values), and
+        ``namespaces``, a dict of the namespaces ("" without a namespace) with the number of hits
+        and misses of get commands and their hit ratio. None if instrumentation is disabled.
+    """
+    if _instrumentation is None:
+        return None
+    return _instrumentation.snapshot(reset)
+
+
+def emit_command_stats(metric_name="brainzutils_cache"):
+    """Writes statistics of commands and namespaces with :mod:`brainzutils.metrics` and resets them.
+
+    Call this periodically, e.g. from a background job, to submit the statistics since the
+    last call. The metrics module needs to be initialized.
+
+    Args:
+        metric_name: Name of the metrics, they're tagged with the command or namespace.
+    """
+    # pylint: disable=import-outside-toplevel
+    from brainzutils import metrics
+    stats = command_stats(reset=True)
+    if stats is None:
+        return
+    for command, command_stat in stats["commands"].items():
+        fields = {}
+        if "calls" in command_stat:
+            fields.update(calls=command_stat["calls"], errors=command_stat["errors"],
+                          latency_sum=float(command_stat["latency"]["sum"]))
+            # One field per bucket of the histogram, e.g. latency_le_0.001
+            for bound, count in command_stat["latency"]["buckets"]:
+                fields["latency_le_%g" % bound] = count
+        if "payload" in command_stat:
+            fields.update(payload_count=command_stat["payload"]["count"], payload_bytes=command_stat["payload"]["sum"])
+        metrics.set(metric_name, tags={"command": command}, **fields)
+    for namespace, namespace_stat in stats["namespaces"].items():
+        metrics.set(metric_name, tags={"namespace": namespace or "none"},
+                    hits=namespace_stat["hits"], misses=namespace_stat["misses"])
+
+
+def hot_keys(reset=False):
+    """Returns the most frequently read keys of every namespace, see the ``hot_keys_sample_rate``
+    option of :meth:`init`.
+
+    Only reads with the get functions are counted, including reads that are answered from the
+    local, shared or client side caches. The numbers of reads are estimates: they're extrapolated
+    from the sample and may be too high for keys that share counters with other keys.
+
+    Args:
+        reset: True to start counting from zero after taking the snapshot.
+
+    Returns:
+        A dict of namespaces ("" without a namespace) and lists of (key, estimated number of reads)
+        pairs, most frequently read keys first, or None if hot key detection is disabled.
+    """
+    if _hot_keys is None:
+        return None
+    return _hot_keys.snapshot(reset)
+
+
+def _command(miss=_returns(lambda: None)):
+    """Decorator for public functions that access Redis, for the circuit breaker and instrumentation.
+
+    Args:
+        miss: Function that is called with the arguments of a call that is short-circuited
+          by the circuit breaker and returns its result.
+    """
+    def decorator(f):
+        name = f.__name__
+
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def decorated(*args, **kwargs):
+                breaker, instrumentation = _breaker, _instrumentation
+                if (breaker is None and instrumentation is None) or _current_command.get() is not None:
+                    return await f(*args, **kwargs)
+                if breaker is not None and not breaker.allow():
+                    return breaker.short_circuit(miss, args, kwargs)
+                token = _current_command.set(name)
+                used = [False]
+                used_token = _redis_used.set(used)
+                start = time.perf_counter()
+                error = False
+                try:
+                    return await f(*args, **kwargs)
+                except cache_breaker.BREAKER_ERRORS:
+                    error = True
+                    raise
+                finally:
+                    _redis_used.reset(used_token)
+                    _current_command.reset(token)
+                    _record_call(breaker, instrumentation, name, time.perf_counter() - start, error, used[0])
+        else:
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                breaker, instrumentation = _breaker, _instrumentation
+                if (breaker is None and instrumentation is None) or _current_command.get() is not None:
+                    return f(*args, **kwargs)
+                if breaker is not None and not breaker.allow():
+                    return breaker.short_circuit(miss, args, kwargs)
+                token = _current_command.set(name)
+                used = [False]
+                used_token = _redis_used.set(used)
+                start = time.perf_counter()
+                error = False
+                try:
+                    return f(*args, **kwargs)
+                except cache_breaker.BREAKER_ERRORS:
+                    error = True
+                    raise
+                finally:
+                    _redis_used.reset(used_token)
+                    _current_command.reset(token)
+                    _record_call(breaker, instrumentation, name, time.perf_counter() - start, error, used[0])
+
+        return decorated
+
+    return decorator
+
+
+def _record_call(breaker, instrumentation, name, duration, error, used):
+    if breaker is not None:
+        breaker.record(error, duration, used)
+    if instrumentation is not None:
+        instrumentation.record_call(name, duration, error)
+
+
+# Versions of namespaces that async functions got with the async client, see _async_namespace
+_pinned_versions = contextvars.ContextVar("brainzutils_cache_namespace_versions", default=None)
+
+
+def _async_namespace(f):
+    """Gets the version of the namespace of an async function with the async client before
+    the function is called, so that preparing its keys doesn't block the event loop."""
+    index = list(inspect.signature(f).parameters).index("namespace")
+
     @wraps(f)
-    def decorated(*args, **kwargs):
-        if not _r:
-            raise RuntimeError("Cache module needs to be initialized before "
-                               "use! See documentation for more info.")
-        return f(*args, **kwargs)
+    async def decorated(*args, **kwargs):
+        namespace = kwargs["namespace"] if "namespace" in kwargs else args[index] if len(args) > index else None
+        if not namespace:
+            return await f(*args, **kwargs)
+        token = _pinned_versions.set({**(_pinned_versions.get() or {}),
+                                      namespace: await _anamespace_version(namespace)})
+        try:
+            return await f(*args, **kwargs)
+        finally:
+            _pinned_versions.reset(token)
+
+    return decorated
+
+
+def init_required(f):
+    # Async functions are wrapped with async functions, so that they're still recognized as such
+    if asyncio.iscoroutinefunction(f):
+        @wraps(f)
+        async def decorated(*args, **kwargs):
+            _check_initialized()
+            return await f(*args, **kwargs)
+    elif inspect.isasyncgenfunction(f):
+        @wraps(f)
+        async def decorated(*args, **kwargs):
+            _check_initialized()
+            async for item in f(*args, **kwargs):
+                yield item
+    else:
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            _check_initialized()
+            return f(*args, **kwargs)
 
     return decorated
 
 
+def _check_initialized():
+    if not _r:
+        raise RuntimeError("Cache module needs to be initialized before "
+                           "use! See documentation for more info.")
+
+
 # pylint: disable=redefined-builtin
 @init_required
-def set(key, val, expirein, namespace=None, encode=True):
+@_command(_returns(bool))
+def set(key, val, expirein, namespace=None, encode=True, nx=False, xx=False, compute_time=None):
     """Set a key to a given value.
 
     Args:
@@ -90,6 +969,10 @@ def set(key, val, expirein, namespace=None, encode=True):
         expirein (int): The time after which this value should expire, in seconds.
         namespace (str): Optional namespace in which key needs to be defined.
         encode: True if the value should be encoded with msgpack, False otherwise
+        nx (bool): Only set the key if it does not already exist.
+        xx (bool): Only set the key if it already exists.
+        compute_time (float): The time it took to compute the value, in seconds, see
+          :meth:`set_many`.
 
     Returns:
         True if stored successfully.
@@ -99,11 +982,15 @@ def set(key, val, expirein, namespace=None, encode=True):
         mapping={key: val},
         expirein=expirein,
         namespace=namespace,
-        encode=encode
+        encode=encode,
+        nx=nx,
+        xx=xx,
+        compute_time=compute_time,
     )
 
 
 @init_required
+@_command()
 def get(key, namespace=None, decode=True):
     """Retrieve an item.
 
@@ -120,6 +1007,7 @@ def get(key, namespace=None, decode=True):
 
 
 @init_required
+@_command(_returns(int))
 def delete(key, namespace=None):
     """Delete an item.
 
@@ -135,6 +1023,7 @@ def delete(key, namespace=None):
 
 
 @init_required
+@_command(_returns(bool))
 def expire(key, expirein, namespace=None):
     """Set the expiration time for an item
 
@@ -147,10 +1036,13 @@ def expire(key, expirein, namespace=None):
           True if the timeout was set, False otherwise
     """
     # Note that key is encoded before deletion request.
-    return _r.pexpire(_prep_key(key, namespace), expirein * 1000)
+    prepared_key = _prep_key(key, namespace)
+    _local_delete_many([prepared_key], namespace)
+    return _client(prepared_key).pexpire(prepared_key, expirein * 1000)
 
 
 @init_required
+@_command(_returns(bool))
 def expireat(key, timeat, namespace=None):
     """Set the absolute expiration time for an item
 
@@ -163,32 +1055,61 @@ def expireat(key, timeat, namespace=None):
           True if the timeout was set, False otherwise
     """
     # Note that key is encoded before deletion request.
-    return _r.pexpireat(_prep_key(key, namespace), timeat * 1000)
+    prepared_key = _prep_key(key, namespace)
+    _local_delete_many([prepared_key], namespace)
+    return _client(prepared_key).pexpireat(prepared_key, timeat * 1000)
 
 
 @init_required
-def set_many(mapping, expirein, namespace=None, encode=True):
+@_command(_returns(bool))
+def set_many(mapping, expirein, namespace=None, encode=True, nx=False, xx=False, compute_time=None,
+             absent_expirein=None, tags=None):
     """Set multiple keys doing just one query.
 
+    If no expiration and no conditions are requested, a single MSET is sent. Otherwise
+    every key is written with its own ``SET ... PX`` command inside a MULTI/EXEC
+    pipeline, so values and their expiration times are stored atomically in one
+    round trip.
+
     Args:
         mapping (dict): A dict of key/value pairs to set.
-        expirein (int): The time after which this value should expire, in seconds.
+        expirein (int or dict): The time after which the values should expire, in seconds.
+          Either a single value used for all keys or a dict of key/expiration pairs to set
+          a different expiration time for each key. Keys with an expiration time of 0 or
+          None (or missing from the dict) never expire.
         namespace (str): Namespace for the keys.
         encode: True if the values should be encoded with msgpack, False otherwise
+        nx (bool): Only set keys that do not already exist.
+        xx (bool): Only set keys that already exist.
+        compute_time (float or dict): The time it took to compute the values, in seconds. Either a
+          single value or a dict of key/time pairs. If set, the values are stored together with their
+          compute and expiration times, which allows :meth:`get_with_refresh` to recompute them
+          before they expire. Requires ``encode``.
+        absent_expirein (int): If set, :data:`ABSENT` values expire after this many seconds instead
+          of ``expirein``, so that items that start to exist are picked up sooner.
+        tags (list or dict): Tags of the items, either a list of tags for all items or a dict of
+          key/list of tags pairs. All items with a tag can be deleted with :meth:`invalidate_tags`.
 
     Returns:
-        True on success.
+        True if all keys were stored, False if some of them were skipped
+        because of the ``nx`` or ``xx`` condition.
     """
-    # TODO: Fix return value
-    result = _r.mset(_prep_dict(mapping, namespace, encode))
-    if expirein:
-        for key in list(mapping.keys()):
-            expire(key, expirein, namespace)
+    if nx and xx:
+        raise ValueError("nx and xx are mutually exclusive")
 
+    items = _prep_items(mapping, expirein, namespace, encode, compute_time, absent_expirein)
+    _record_payload([value for _, value, _ in items])
+    if tags:
+        # Tags are added first, so that all stored items can be found by invalidate_tags
+        _add_tags(_tagged_keys(mapping, items, tags))
+    result = _set_items(items, nx, xx)
+
+    _local_set_many(items, namespace, nx or xx)
     return result
 
 
 @init_required
+@_command(lambda keys, *args, **kwargs: dict.fromkeys(keys))
 def get_many(keys, namespace=None, decode=True):
     """Retrieve multiple keys doing just one query.
 
@@ -198,25 +1119,78 @@ def get_many(keys, namespace=None, decode=True):
         decode (bool): True if values should be decoded with msgpack, False otherwise
 
     Returns:
-        A dictionary of key/value pairs that were available.
+        A dictionary of key/value pairs that were available. Keys that are not in the
+        cache have the value None and keys that were stored as :data:`ABSENT` have the
+        value ABSENT (when ``decode`` is True).
     """
-    result = {}
-    for i, value in enumerate(_r.mget(_prep_keys_list(keys, namespace))):
-        result[keys[i]] = _decode_val(value) if decode else value
+    if _hot_keys is not None:
+        _hot_keys.record(namespace, keys)
+    prepared_keys = _prep_keys_list(keys, namespace)
+    if _tracking_enabled(namespace):
+        generation, values, missing = _tracking.get_many(prepared_keys, decode, namespace)
+        if missing:
+            fetched = _mget([prepared_keys[i] for i in missing], replica=False)
+            _record_payload(fetched)
+            _tracking.fill(values, missing, fetched, prepared_keys, decode, namespace, generation)
+        result = dict(zip(keys, values))
+    else:
+        values, missing = _local_get_many(prepared_keys, namespace)
+        if missing:
+            fetched = _mget([prepared_keys[i] for i in missing])
+            _record_payload(fetched)
+            _local_fill(values, missing, fetched, prepared_keys, namespace)
+        result = _decode_many(keys, values, decode, namespace)
+    _record_lookups(namespace, result)
     return result
 
 
 @init_required
+def get_many_iter(keys, namespace=None, decode=True, chunk_size=None):
+    """Retrieve many keys in chunks, yielding items as soon as their chunk is retrieved.
+
+    This avoids keeping all keys and values of very large batches in memory at once,
+    e.g. for exporting data. Every chunk is retrieved with :meth:`get_many`.
+
+    Args:
+        keys: An iterable of keys that need to be retrieved.
+        namespace (str): Namespace for the keys.
+        decode (bool): True if values should be decoded, False otherwise.
+        chunk_size (int): Number of keys per chunk, the ``chunk_size`` option of :meth:`init` by default.
+
+    Yields:
+        (key, value) pairs in the order of the keys, see :meth:`get_many` for the values.
+    """
+    for chunk in _iter_chunks(keys, chunk_size):
+        yield from get_many(chunk, namespace, decode).items()
+
+
+def _iter_chunks(iterable, chunk_size):
+    chunk_size = chunk_size or _chunk_size
+    if not chunk_size:
+        chunk = list(iterable)
+        if chunk:
+            yield chunk
+        return
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, chunk_size)):
+        yield chunk
+
+
+@init_required
+@_command(_returns(int))
 def delete_many(keys, namespace=None):
     """Delete multiple keys.
 
     Returns:
         Number of keys that were deleted.
     """
-    return _r.delete(*_prep_keys_list(keys, namespace))
+    prepared_keys = _prep_keys_list(keys, namespace)
+    _local_delete_many(prepared_keys, namespace)
+    return _delete(prepared_keys)
 
 
 @init_required
+@_command(_returns(int))
 def increment(key, amount=1, namespace=None):
     """ Increment the value for given key using the INCR command.
 
@@ -228,10 +1202,13 @@ def increment(key, amount=1, namespace=None):
     Returns:
         An integer equal to the value after increment
     """
-    return _r.incr(_prep_keys_list([key], namespace)[0], amount=amount)
+    prepared_key = _prep_key(key, namespace)
+    _local_delete_many([prepared_key], namespace)
+    return _client(prepared_key).incr(prepared_key, amount=amount)
 
 
 @init_required
+@_command(_returns(int))
 def hincrby(name, key, amount, namespace=None):
     """Increment a hashes key by a given amount using HINCRBY
 
@@ -244,24 +1221,31 @@ def hincrby(name, key, amount, namespace=None):
     Returns:
         An integer equal to the value after increment
     """
-    return _r.hincrby(_prep_keys_list([name], namespace)[0], key, amount)
+    prepared_name = _prep_key(name, namespace)
+    return _client(prepared_name).hincrby(prepared_name, key, amount)
 
 
 @init_required
-def hgetall(name, namespace=None):
+@_command(_returns(dict))
+def hgetall(name, namespace=None, decode=False):
     """Get all keys and values for a hash using HGETALL
 
     Args:
         name: Name of the hash
         namespace: Namespace for the name
+        decode: True to decode keys as strings and values that were encoded by :meth:`hset_many`,
+          False to return bytes
 
     Returns:
         A dictionary of {key: value} items for all keys in the hash
     """
-    return _r.hgetall(_prep_keys_list([name], namespace)[0])
+    prepared_name = _prep_key(name, namespace)
+    result = _read_client(prepared_name).hgetall(prepared_name)
+    return _decode_hash(result, namespace) if decode else result
 
 
 @init_required
+@_command(_returns(list))
 def hkeys(name, namespace=None):
     """Get all keys for a hash using HKEYS
 
@@ -272,10 +1256,12 @@ def hkeys(name, namespace=None):
     Returns:
         A list of [key] values for all keys in the hash
     """
-    return _r.hkeys(_prep_keys_list([name], namespace)[0])
+    prepared_name = _prep_key(name, namespace)
+    return _read_client(prepared_name).hkeys(prepared_name)
 
 
 @init_required
+@_command(_returns(int))
 def hset(name, key, value, namespace=None):
     """Set the value of a key in a hash using HSET.
 
@@ -288,10 +1274,12 @@ def hset(name, key, value, namespace=None):
     Returns:
         number of fields that were added to the hash.
     """
-    return _r.hset(_prep_keys_list([name], namespace)[0], key, value)
+    prepared_name = _prep_key(name, namespace)
+    return _client(prepared_name).hset(prepared_name, key, value)
 
 
 @init_required
+@_command(_returns(int))
 def hdel(name, keys, namespace=None):
     """Delete the specified keys from a hash using HDEL.
     Note that the ``keys`` argument must be a list. This differs from the underlying redis
@@ -307,16 +1295,109 @@ def hdel(name, keys, namespace=None):
     """
     if not isinstance(keys, list):
         keys = [keys]
-    return _r.hdel(_prep_keys_list([name], namespace)[0], *keys)
+    prepared_name = _prep_key(name, namespace)
+    return _client(prepared_name).hdel(prepared_name, *keys)
 
 
 @init_required
+@_command(_returns(bool))
+def hset_many(name, mapping, expirein, encode=True, namespace=None):
+    """Set multiple keys of a hash in one query, see :meth:`hset_multi`.
+
+    Args:
+        name: Name of the hash
+        mapping (dict): A dict of key/value pairs to set in the hash
+        expirein (int): The time after which the hash should expire, in seconds, 0 or None to keep
+          the current expiration time of the hash
+        encode: True if the values should be encoded, False otherwise
+        namespace: Namespace for the name
+
+    Returns:
+        True
+    """
+    return hset_multi({name: mapping}, expirein, encode, namespace)
+
+
+@init_required
+@_command(lambda name, keys, *args, **kwargs: dict.fromkeys(keys))
+def hmget(name, keys, decode=True, namespace=None):
+    """Get the values of some keys of a hash using HMGET.
+
+    Args:
+        name: Name of the hash
+        keys (list): Keys of the items in the hash
+        decode: True if the values should be decoded, False otherwise
+        namespace: Namespace for the name
+
+    Returns:
+        A dictionary of {key: value} items, the value is None for keys that are not in the hash
+    """
+    return hmget_multi({name: keys}, decode, namespace)[name]
+
+
+@init_required
+@_command(_returns(bool))
+def hset_multi(hashes, expirein, encode=True, namespace=None):
+    """Set keys of multiple hashes using HMSET, with one transaction per node.
+
+    Args:
+        hashes (dict): A dict of hash names and dicts of key/value pairs to set in them
+        expirein (int): The time after which the hashes should expire, in seconds, 0 or None to keep
+          their current expiration times
+        encode: True if the values should be encoded, False otherwise
+        namespace: Namespace for the names
+
+    Returns:
+        True
+    """
+    prepared_hashes = list(_prep_hashes(hashes, encode, namespace).items())
+    groups = _group_by_node([prepared_name for prepared_name, _ in prepared_hashes])
+
+    def set_node_hashes(node, indexes):
+        pipe = _clients[node].pipeline(transaction=True)
+        _pipeline_hset(pipe, [prepared_hashes[i] for i in indexes], expirein)
+        return pipe.execute()
+
+    _fan_out(set_node_hashes, groups)
+    return True
+
+
+@init_required
+@_command(lambda hashes, *args, **kwargs: {name: dict.fromkeys(keys) for name, keys in hashes.items()})
+def hmget_multi(hashes, decode=True, namespace=None):
+    """Get the values of some keys of multiple hashes using HMGET, with one pipeline per node.
+
+    Args:
+        hashes (dict): A dict of hash names and lists of keys of the items in them
+        decode: True if the values should be decoded, False otherwise
+        namespace: Namespace for the names
+
+    Returns:
+        A dictionary of hash names and {key: value} dictionaries, see :meth:`hmget`
+    """
+    names = list(hashes)
+    prepared_names = _prep_keys_list(names, namespace)
+    groups = _group_by_node(prepared_names)
+
+    def hmget_node(node, indexes):
+        node_names = [prepared_names[i] for i in indexes]
+        pipe = _read_node_client(node, node_names, _clients, _replica_clients).pipeline(transaction=False)
+        for i in indexes:
+            pipe.hmget(prepared_names[i], list(hashes[names[i]]))
+        return pipe.execute()
+
+    results = _merge(groups, _fan_out(hmget_node, groups), len(names))
+    return {name: _decode_hmget(hashes[name], values, decode, namespace) for name, values in zip(names, results)}
+
+
+@init_required
+@_command(_returns(int))
 def sadd(name, keys, expirein, encode=True, namespace=None):
     """Add the specified keys to the set stored at name using SADD
     Note that it is not possible to expire a single value stored in a set.  The ``expirein``
     argument will set the expiration period of the entire set stored at ``name``. Therefore,
     any additions to a set will reset its expiry to the value of ``expirein`` passed in
-    last call.
+    last call. The members are added and the expiration time is set in a single round trip.
     Args:
         name: Name of the set
         keys: keys to add to the set
@@ -328,18 +1409,89 @@ def sadd(name, keys, expirein, encode=True, namespace=None):
         the number of elements that were added to the set, not including all the elements already present into the set.
     """
     prepared_name = _prep_key(name, namespace)
-    if not isinstance(keys, list) and not isinstance(keys, builtins.set):
-        keys = {keys}
+    keys = _prep_members(keys, encode, namespace)
+    pipe = _client(prepared_name).pipeline(transaction=True)
+    pipe.sadd(prepared_name, *keys)
+    pipe.pexpire(prepared_name, expirein * 1000)
+    result, _ = pipe.execute()
+    return result
 
-    if encode:
-        keys = {_encode_val(key) for key in keys}
 
-    result = _r.sadd(prepared_name, *keys)
-    expire(name, expirein, namespace)
-    return result
+@init_required
+@_command(_returns(int))
+def srem(name, keys, encode=True, namespace=None):
+    """Remove the specified keys from the set stored at name using SREM.
+
+    Args:
+        name: Name of the set
+        keys: keys to remove from the set
+        encode: True if the keys were encoded when they were added, False otherwise
+        namespace: namespace for the name
+
+    Returns:
+        the number of keys that were removed from the set
+    """
+    prepared_name = _prep_key(name, namespace)
+    return _client(prepared_name).srem(prepared_name, *_prep_members(keys, encode, namespace))
+
+
+@init_required
+@_command(_returns(bool))
+def sismember(name, key, encode=True, namespace=None):
+    """Check if a key is a member of the set stored at name using SISMEMBER.
+
+    Args:
+        name: Name of the set
+        key: key to check
+        encode: True if the keys were encoded when they were added, False otherwise
+        namespace: namespace for the name
+
+    Returns:
+        True if the key is a member of the set
+    """
+    prepared_name = _prep_key(name, namespace)
+    member = _encode_val(key, namespace) if encode else key
+    return bool(_read_client(prepared_name).sismember(prepared_name, member))
+
+
+@init_required
+@_command(lambda name, keys, *args, **kwargs: [False] * len(keys))
+def smismember(name, keys, encode=True, namespace=None):
+    """Check which keys are members of the set stored at name using SMISMEMBER.
+
+    On servers that don't support SMISMEMBER (before Redis 6.2), SISMEMBER commands
+    are sent in a single pipeline instead.
+
+    Args:
+        name: Name of the set
+        keys (list): keys to check
+        encode: True if the keys were encoded when they were added, False otherwise
+        namespace: namespace for the name
+
+    Returns:
+        A list of booleans that are True for keys that are members of the set, in the same order as keys
+    """
+    global _smismember_supported
+    prepared_name = _prep_key(name, namespace)
+    members = [_encode_val(key, namespace) if encode else key for key in keys]
+    if not members:
+        return []
+    client = _read_client(prepared_name)
+    if _smismember_supported:
+        try:
+            return [bool(result) for result in client.smismember(prepared_name, members)]
+        except redis.exceptions.ResponseError as e:
+            if "unknown command" not in str(e).lower():
+                raise
+            _smismember_supported = False
+    pipe = client.pipeline(transaction=False)
+    for member in members:
+        pipe.sismember(prepared_name, member)
+    return [bool(result) for result in pipe.execute()]
 
 
 @init_required
+@_command(_returns(set))
 def smembers(name, decode=True, namespace=None):
     """Returns all the members of the set value stored at name.
     Args:
@@ -350,75 +1502,1168 @@ def smembers(name, decode=True, namespace=None):
     Returns:
         all members of the set
     """
-    keys = _r.smembers(_prep_key(name, namespace))
+    prepared_name = _prep_key(name, namespace)
+    keys = _read_client(prepared_name).smembers(prepared_name)
     if decode:
-        keys = {_decode_val(key) for key in keys}
+        keys = {_decode_val(key, namespace=namespace) for key in keys}
     return keys
 
 
 @init_required
-def flush_all():
-    _r.flushdb()
+def sscan_iter(name, decode=True, count=1000, namespace=None):
+    """Iterate over the members of the set stored at name using SSCAN.
 
+    Unlike :meth:`smembers`, this doesn't load the whole set at once. Members that are
+    added or removed during the iteration may or may not be returned, and members may
+    be returned more than once.
+
+    Args:
+        name: Name of the set
+        decode: True if the members should be decoded, False otherwise
+        count: Number of members that Redis examines in each step of the iteration
+        namespace: namespace for the name
+
+    Yields:
+        members of the set
+    """
+    prepared_name = _prep_key(name, namespace)
+    for key in _read_client(prepared_name).sscan_iter(prepared_name, count=count):
+        yield _decode_val(key, namespace=namespace) if decode else key
 
-def gen_key(key, *attributes):
-    """Helper function that generates a key with attached attributes.
+
+@init_required
+@_command(_returns(list))
+def lrange(name, start=0, end=-1, decode=True, namespace=None):
+    """Return values of the list stored at name between start and end (inclusive) using LRANGE.
 
     Args:
-        key: Original key.
-        attributes: Attributes that will be appended a key.
+        name: Name of the list
+        start: index of the first value, negative indexes count from the end of the list
+        end: index of the last value, negative indexes count from the end of the list
+        decode: True if the values should be decoded, False otherwise
+        namespace: namespace for the name
 
     Returns:
-        Key that can be used with cache.
+        a list of values
     """
-    if not isinstance(key, str):
-        key = str(key)
-    key = key.encode(ENCODING_ASCII, errors='xmlcharrefreplace').decode(ENCODING_ASCII)
+    prepared_name = _prep_key(name, namespace)
+    values = _read_client(prepared_name).lrange(prepared_name, start, end)
+    return [_decode_val(value, namespace=namespace) for value in values] if decode else values
 
-    for attr in attributes:
-        if not isinstance(attr, str):
-            attr = str(attr)
-        key += '_' + attr.encode(ENCODING_ASCII, errors='xmlcharrefreplace').decode(ENCODING_ASCII)
 
-    key = key.replace(' ', '_')  # spaces are not allowed
+@init_required
+def scan_keys(namespace=None, pattern="*", count=1000):
+    """Iterate over keys in a namespace using SCAN.
 
-    return key
+    Unlike KEYS, SCAN doesn't block Redis for the whole iteration. Keys that are
+    added or removed during the iteration may or may not be returned.
 
+    Args:
+        namespace: Namespace of the keys. Without a namespace, keys of all namespaces
+          (in the global namespace) are returned, prefixed with their namespace.
+        pattern: Glob-style pattern that the keys need to match.
+        count: Number of keys that Redis examines in each step of the iteration.
 
-def _prep_dict(dictionary, namespace=None, encode=True):
-    """Wrapper for _prep_key and _encode_val functions that works with dictionaries."""
-    return {_prep_key(key, namespace): _encode_val(value) if encode else value
-            for key, value in dictionary.items()}
+    Yields:
+        Keys that match the pattern, in the same form that is used in other functions.
+    """
+    prefix = _prep_key("", namespace)
+    for prepared_key in _scan_prepared_keys(namespace, pattern, count):
+        yield prepared_key[len(prefix):]
 
 
-def _prep_key(key, namespace=None):
-    """Prepares a key for use with Redis."""
-    if namespace:
-        key = "%s:%s" % (namespace, key)
-    if not isinstance(key, bytes):
-        key = key.encode(ENCODING_ASCII, errors='xmlcharrefreplace').decode(ENCODING_ASCII)
-    return _glob_namespace + key
+@init_required
+def delete_pattern(pattern="*", namespace=None, count=1000):
+    """Delete all keys in a namespace that match a pattern.
 
+    Keys are found with SCAN (see :meth:`scan_keys`) and removed in batches with UNLINK,
+    which frees memory in the background, so that Redis isn't blocked by large deletions.
+    On servers that don't support UNLINK (before Redis 4.0) DEL is used instead.
 
-def _prep_keys_list(l, namespace=None):
-    """Wrapper for _prep_key function that works with lists.
+    Args:
+        pattern: Glob-style pattern that the keys need to match.
+        namespace: Namespace of the keys.
+        count: Number of keys that are examined in each step of the iteration and maximum
+          number of keys that are deleted with a single command.
 
     Returns:
-        Prepared keys in the same order.
+        Number of keys that were deleted.
     """
-    return [_prep_key(k, namespace) for k in l]
+    deleted = 0
+    batch = []
+    for prepared_key in _scan_prepared_keys(namespace, pattern, count):
+        batch.append(prepared_key)
+        if len(batch) >= count:
+            deleted += _unlink(batch, namespace)
+            batch = []
+    if batch:
+        deleted += _unlink(batch, namespace)
+    return deleted
+
+
+def _scan_prepared_keys(namespace, pattern, count):
+    # Escape glob characters of the prefix, the global namespace isn't validated
+    prefix = re.sub(r"([*?\[\]\\])", r"\\\1", _prep_key("", namespace))
+    _use_redis()
+    for client in _clients:
+        for prepared_key in client.scan_iter(match=prefix + pattern, count=count):
+            yield prepared_key.decode(ENCODING_ASCII)
+
+
+def _unlink(prepared_keys, namespace):
+    global _unlink_supported
+    _local_delete_many(prepared_keys, namespace)
+    if _unlink_supported:
+        groups = _group_by_node(prepared_keys)
+        _mark_written(prepared_keys)
+        try:
+            results = _fan_out(
+                lambda node, indexes: _clients[node].unlink(*[prepared_keys[i] for i in indexes]),
+                groups,
+            )
+            return sum(results.values())
+        except redis.exceptions.ResponseError as e:
+            if "unknown command" not in str(e).lower():
+                raise
+            _unlink_supported = False
+    return _delete(prepared_keys)
 
 
-def _encode_val(value):
-    if value is None:
-        return value
-    return msgpack.packb(value, use_bin_type=True, default=_msgpack_default)
+@init_required
+def pool_stats():
+    """Returns statistics of the connection pools of the (synchronous) Redis clients.
 
+    Returns:
+        A dictionary with the maximum number of connections and the number of connections
+        that were created, are in use and are available for reuse, summed over all nodes.
+    """
+    stats = {"max_connections": 0, "created": 0, "in_use": 0, "available": 0}
+    for client in _clients:
+        pool = client.connection_pool
+        if isinstance(pool, redis.BlockingConnectionPool):
+            created = len(pool._connections)
+            # The queue is filled with None placeholders for connections that weren't created yet
+            available = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+        else:
+            created = pool._created_connections
+            available = len(pool._available_connections)
+        stats["max_connections"] += pool.max_connections
+        stats["created"] += created
+        stats["in_use"] += created - available
+        stats["available"] += available
+    return stats
 
-def _decode_val(value):
+
+@init_required
+def flush_all():
+    if _local is not None:
+        _local.clear()
+    if _shared is not None:
+        _shared.clear()
+    if _tracking is not None:
+        _tracking.invalidate(None)
+    _namespace_versions.clear()
+    for client in _clients:
+        client.flushdb()
+
+
+@init_required
+def reset():
+    """Closes all connections and reinitializes the module with the options of the last :meth:`init` call.
+
+    This drops the in-process caches and statistics. Connections of asyncio clients are not
+    closed, as this function can be called outside of their event loop, see :meth:`aclose`.
+
+    Child processes are reinitialized the same way automatically after a fork, so that
+    they don't use the connections, background threads or locks of their parent.
+    """
+    for clients in [_clients] + _replica_clients:
+        for client in clients:
+            client.connection_pool.disconnect()
+    init(**_init_args)
+
+
+@init_required
+async def aclose():
+    """Closes the connections of the asyncio clients of the running event loop.
+
+    Connections of redis.asyncio can only be used from the event loop that opened them, so
+    every event loop gets its own clients. They're dropped once the event loop is garbage
+    collected, but their connections are only closed by this function, so it should be
+    called before the event loop is closed, e.g. at the end of the coroutine passed to
+    :func:`asyncio.run`. Clients are created again if the cache is used afterwards.
+    """
+    clients, replica_clients = _loop_clients.pop(asyncio.get_running_loop(), ([], []))
+    for client in itertools.chain(clients, *replica_clients):
+        await client.aclose()
+
+
+LOCK_SUFFIX = ":lock"
+STALE_SUFFIX = ":stale"
+
+
+@init_required
+def get_or_compute(key, fn, expirein, namespace=None, lock_timeout=10, wait_timeout=5, stale_ttl=0, beta=0):
+    """Retrieve an item, computing and storing it if it's not in the cache.
+
+    Only one caller computes a missing item at a time: threads of this process wait for
+    each other and callers in other processes are excluded with a short lock in Redis.
+    Callers that don't get the lock wait up to ``wait_timeout`` seconds for the item to
+    show up in the cache, and compute it themselves if it doesn't.
+
+    If ``stale_ttl`` is set, a copy of the item is kept for that many seconds after the
+    item expires. It's returned to callers that would otherwise wait while the item is
+    being recomputed.
+
+    If ``beta`` is set, the item is stored with the time it took to compute it and may be
+    recomputed before it expires, see :meth:`get_with_refresh`. Callers that decide to
+    recompute the item early do so only if nobody else is computing it already, and
+    return the current value otherwise.
+
+    Args:
+        key: Key of the item.
+        fn: Function without arguments that computes the value of the item. ``None``
+          results are not stored.
+        expirein (int): The time after which the value should expire, in seconds.
+        namespace: Optional namespace in which key needs to be defined.
+        lock_timeout (int): The time after which the lock expires if the caller computing
+          the item doesn't release it, in seconds.
+        wait_timeout (int): Maximum time to wait for another caller to compute the item, in seconds.
+        stale_ttl (int): The time for which a stale copy of the item is kept, in seconds.
+        beta (float): Factor for recomputing the item before it expires, 0 to disable it.
+          Values larger than 1 favour earlier recomputation.
+
+    Returns:
+        The value of the item.
+    """
+    if _circuit_open():
+        return fn()
+    prepared_key = _prep_key(key, namespace)
+    if beta:
+        value, refresh = get_with_refresh(key, namespace, beta)
+        if value is not None and refresh:
+            lock = _client(prepared_key + LOCK_SUFFIX).lock(prepared_key + LOCK_SUFFIX, timeout=lock_timeout)
+            if lock.acquire(blocking=False):
+                try:
+                    return _compute_and_set(key, fn, expirein, namespace, stale_ttl, beta)
+                finally:
+                    _release_lock(lock)
+    else:
+        value = get(key, namespace)
+    if value is not None:
+        return value
+
+    with _compute_locks_lock:
+        local_lock = _compute_locks.setdefault(prepared_key, threading.Lock())
+
+    # Threads waiting for another thread of this process get the stale copy right away
+    if stale_ttl and local_lock.locked():
+        value = get(key + STALE_SUFFIX, namespace)
+        if value is not None:
+            return value
+
+    deadline = time.monotonic() + wait_timeout
+    if not local_lock.acquire(timeout=wait_timeout):
+        return _compute_and_set(key, fn, expirein, namespace, stale_ttl, beta)
+    try:
+        # Another thread might have computed the item while we were waiting for the lock
+        value = get(key, namespace)
+        if value is not None:
+            return value
+
+        lock = _client(prepared_key + LOCK_SUFFIX).lock(prepared_key + LOCK_SUFFIX, timeout=lock_timeout)
+        if lock.acquire(blocking=False):
+            try:
+                return _compute_and_set(key, fn, expirein, namespace, stale_ttl, beta)
+            finally:
+                _release_lock(lock)
+
+        if stale_ttl:
+            value = get(key + STALE_SUFFIX, namespace)
+            if value is not None:
+                return value
+
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = get(key, namespace)
+            if value is not None:
+                return value
+
+        return _compute_and_set(key, fn, expirein, namespace, stale_ttl, beta)
+    finally:
+        local_lock.release()
+
+
+def _compute_and_set(key, fn, expirein, namespace, stale_ttl, beta):
+    start = time.monotonic()
+    value = fn()
+    compute_time = time.monotonic() - start if beta else None
+    if value is not None:
+        mapping = {key: value}
+        expiration = {key: expirein}
+        if stale_ttl and expirein:
+            mapping[key + STALE_SUFFIX] = value
+            expiration[key + STALE_SUFFIX] = expirein + stale_ttl
+        set_many(mapping, expirein=expiration, namespace=namespace, compute_time=compute_time)
+    return value
+
+
+def _release_lock(lock):
+    try:
+        lock.release()
+    except redis.exceptions.LockError:
+        # The lock expired while computing the item
+        pass
+
+
+@init_required
+def get_with_refresh(key, namespace=None, beta=1.0):
+    """Retrieve an item and decide whether it should be recomputed before it expires.
+
+    This implements probabilistic early expiration ("XFetch"): for items that were stored
+    with their compute time (see the ``compute_time`` argument of :meth:`set_many`), the
+    probability of recomputing an item rises as it gets closer to its expiration time, and
+    items that take longer to compute are recomputed earlier. This way a single caller
+    usually refreshes a popular item before it expires, instead of all callers missing it
+    at once.
+
+    Args:
+        key: Key of the item that needs to be retrieved.
+        namespace: Optional namespace in which key was defined.
+        beta (float): Values larger than 1 favour earlier recomputation, smaller values later.
+
+    Returns:
+        A tuple of the stored value (None if it's not found) and a boolean that is
+        True if the caller should recompute the item.
+    """
+    value = _decode_val(get(key, namespace, decode=False), refreshable=True, namespace=namespace)
+    if value is None:
+        return None, True
+    if not isinstance(value, _RefreshableValue):
+        return value, False
+    if value.expires_at is None:
+        return value.value, False
+    # 1 - random() is in (0, 1], so the logarithm is defined and not positive
+    refresh = time.time() - value.compute_time * beta * math.log(1.0 - random.random()) >= value.expires_at
+    return value.value, refresh
+
+
+#######
+# ASYNC
+#######
+
+# The following functions are asyncio versions of the functions above. They use separate
+# clients based on redis.asyncio for every event loop, with the same key preparation, encoding
+# and local cache.
+
+@init_required
+@_command(_returns(bool))
+@_async_namespace
+async def aset(key, val, expirein, namespace=None, encode=True, nx=False, xx=False, compute_time=None):
+    """Async version of :meth:`set`."""
+    return await aset_many({key: val}, expirein=expirein, namespace=namespace, encode=encode, nx=nx, xx=xx,
+                           compute_time=compute_time)
+
+
+@init_required
+@_command()
+@_async_namespace
+async def aget(key, namespace=None, decode=True):
+    """Async version of :meth:`get`."""
+    return (await aget_many([key], namespace, decode)).get(key)
+
+
+@init_required
+@_command(_returns(int))
+@_async_namespace
+async def adelete(key, namespace=None):
+    """Async version of :meth:`delete`."""
+    return await adelete_many([key], namespace)
+
+
+@init_required
+@_command(_returns(bool))
+@_async_namespace
+async def aexpire(key, expirein, namespace=None):
+    """Async version of :meth:`expire`."""
+    prepared_key = _prep_key(key, namespace)
+    _local_delete_many([prepared_key], namespace)
+    return await _aclient(prepared_key).pexpire(prepared_key, expirein * 1000)
+
+
+@init_required
+@_command(_returns(bool))
+@_async_namespace
+async def aset_many(mapping, expirein, namespace=None, encode=True, nx=False, xx=False, compute_time=None,
+                    absent_expirein=None, tags=None):
+    """Async version of :meth:`set_many`."""
+    if nx and xx:
+        raise ValueError("nx and xx are mutually exclusive")
+
+    items = _prep_items(mapping, expirein, namespace, encode, compute_time, absent_expirein)
+    _record_payload([value for _, value, _ in items])
+    if tags:
+        await _aadd_tags(_tagged_keys(mapping, items, tags))
+    result = await _aset_items(items, nx, xx)
+
+    _local_set_many(items, namespace, nx or xx)
+    return result
+
+
+@init_required
+@_command(lambda keys, *args, **kwargs: dict.fromkeys(keys))
+@_async_namespace
+async def aget_many(keys, namespace=None, decode=True):
+    """Async version of :meth:`get_many`."""
+    if _hot_keys is not None:
+        _hot_keys.record(namespace, keys)
+    prepared_keys = _prep_keys_list(keys, namespace)
+    if _tracking_enabled(namespace):
+        generation, values, missing = _tracking.get_many(prepared_keys, decode, namespace)
+        if missing:
+            fetched = await _amget([prepared_keys[i] for i in missing], replica=False)
+            _record_payload(fetched)
+            _tracking.fill(values, missing, fetched, prepared_keys, decode, namespace, generation)
+        result = dict(zip(keys, values))
+    else:
+        values, missing = _local_get_many(prepared_keys, namespace)
+        if missing:
+            fetched = await _amget([prepared_keys[i] for i in missing])
+            _record_payload(fetched)
+            _local_fill(values, missing, fetched, prepared_keys, namespace)
+        result = _decode_many(keys, values, decode, namespace)
+    _record_lookups(namespace, result)
+    return result
+
+
+@init_required
+async def aget_many_iter(keys, namespace=None, decode=True, chunk_size=None):
+    """Async version of :meth:`get_many_iter`."""
+    for chunk in _iter_chunks(keys, chunk_size):
+        for item in (await aget_many(chunk, namespace, decode)).items():
+            yield item
+
+
+@init_required
+@_command(_returns(int))
+@_async_namespace
+async def adelete_many(keys, namespace=None):
+    """Async version of :meth:`delete_many`."""
+    prepared_keys = _prep_keys_list(keys, namespace)
+    _local_delete_many(prepared_keys, namespace)
+    return await _adelete(prepared_keys)
+
+
+@init_required
+@_command(_returns(int))
+@_async_namespace
+async def aincrement(key, amount=1, namespace=None):
+    """Async version of :meth:`increment`."""
+    prepared_key = _prep_key(key, namespace)
+    _local_delete_many([prepared_key], namespace)
+    return await _aclient(prepared_key).incr(prepared_key, amount=amount)
+
+
+@init_required
+@_command(_returns(int))
+@_async_namespace
+async def ahincrby(name, key, amount, namespace=None):
+    """Async version of :meth:`hincrby`."""
+    prepared_name = _prep_key(name, namespace)
+    return await _aclient(prepared_name).hincrby(prepared_name, key, amount)
+
+
+@init_required
+@_command(_returns(dict))
+@_async_namespace
+async def ahgetall(name, namespace=None, decode=False):
+    """Async version of :meth:`hgetall`."""
+    prepared_name = _prep_key(name, namespace)
+    result = await _aread_client(prepared_name).hgetall(prepared_name)
+    return _decode_hash(result, namespace) if decode else result
+
+
+@init_required
+@_command(_returns(list))
+@_async_namespace
+async def ahkeys(name, namespace=None):
+    """Async version of :meth:`hkeys`."""
+    prepared_name = _prep_key(name, namespace)
+    return await _aread_client(prepared_name).hkeys(prepared_name)
+
+
+@init_required
+@_command(_returns(int))
+@_async_namespace
+async def ahset(name, key, value, namespace=None):
+    """Async version of :meth:`hset`."""
+    prepared_name = _prep_key(name, namespace)
+    return await _aclient(prepared_name).hset(prepared_name, key, value)
+
+
+@init_required
+@_command(_returns(int))
+@_async_namespace
+async def ahdel(name, keys, namespace=None):
+    """Async version of :meth:`hdel`."""
+    if not isinstance(keys, list):
+        keys = [keys]
+    prepared_name = _prep_key(name, namespace)
+    return await _aclient(prepared_name).hdel(prepared_name, *keys)
+
+
+@init_required
+@_command(_returns(bool))
+@_async_namespace
+async def ahset_many(name, mapping, expirein, encode=True, namespace=None):
+    """Async version of :meth:`hset_many`."""
+    return await ahset_multi({name: mapping}, expirein, encode, namespace)
+
+
+@init_required
+@_command(lambda name, keys, *args, **kwargs: dict.fromkeys(keys))
+@_async_namespace
+async def ahmget(name, keys, decode=True, namespace=None):
+    """Async version of :meth:`hmget`."""
+    return (await ahmget_multi({name: keys}, decode, namespace))[name]
+
+
+@init_required
+@_command(_returns(bool))
+@_async_namespace
+async def ahset_multi(hashes, expirein, encode=True, namespace=None):
+    """Async version of :meth:`hset_multi`."""
+    prepared_hashes = list(_prep_hashes(hashes, encode, namespace).items())
+    groups = _group_by_node([prepared_name for prepared_name, _ in prepared_hashes])
+
+    async def set_node_hashes(node, indexes):
+        async with _async_clients()[0][node].pipeline(transaction=True) as pipe:
+            _pipeline_hset(pipe, [prepared_hashes[i] for i in indexes], expirein)
+            return await pipe.execute()
+
+    await _afan_out(set_node_hashes, groups)
+    return True
+
+
+@init_required
+@_command(lambda hashes, *args, **kwargs: {name: dict.fromkeys(keys) for name, keys in hashes.items()})
+@_async_namespace
+async def ahmget_multi(hashes, decode=True, namespace=None):
+    """Async version of :meth:`hmget_multi`."""
+    names = list(hashes)
+    prepared_names = _prep_keys_list(names, namespace)
+    groups = _group_by_node(prepared_names)
+
+    async def hmget_node(node, indexes):
+        node_names = [prepared_names[i] for i in indexes]
+        client = _read_node_client(node, node_names, *_async_clients())
+        async with client.pipeline(transaction=False) as pipe:
+            for i in indexes:
+                pipe.hmget(prepared_names[i], list(hashes[names[i]]))
+            return await pipe.execute()
+
+    results = _merge(groups, await _afan_out(hmget_node, groups), len(names))
+    return {name: _decode_hmget(hashes[name], values, decode, namespace) for name, values in zip(names, results)}
+
+
+@init_required
+@_command(_returns(int))
+@_async_namespace
+async def asadd(name, keys, expirein, encode=True, namespace=None):
+    """Async version of :meth:`sadd`."""
+    keys = _prep_members(keys, encode, namespace)
+    prepared_name = _prep_key(name, namespace)
+    async with _aclient(prepared_name).pipeline(transaction=True) as pipe:
+        pipe.sadd(prepared_name, *keys)
+        pipe.pexpire(prepared_name, expirein * 1000)
+        result, _ = await pipe.execute()
+    return result
+
+
+@init_required
+@_command(_returns(set))
+@_async_namespace
+async def asmembers(name, decode=True, namespace=None):
+    """Async version of :meth:`smembers`."""
+    prepared_name = _prep_key(name, namespace)
+    keys = await _aread_client(prepared_name).smembers(prepared_name)
+    if decode:
+        keys = {_decode_val(key, namespace=namespace) for key in keys}
+    return keys
+
+
+@init_required
+@_command(_returns(int))
+@_async_namespace
+async def asrem(name, keys, encode=True, namespace=None):
+    """Async version of :meth:`srem`."""
+    prepared_name = _prep_key(name, namespace)
+    return await _aclient(prepared_name).srem(prepared_name, *_prep_members(keys, encode, namespace))
+
+
+@init_required
+@_command(_returns(bool))
+@_async_namespace
+async def asismember(name, key, encode=True, namespace=None):
+    """Async version of :meth:`sismember`."""
+    prepared_name = _prep_key(name, namespace)
+    member = _encode_val(key, namespace) if encode else key
+    return bool(await _aread_client(prepared_name).sismember(prepared_name, member))
+
+
+@init_required
+@_command(lambda name, keys, *args, **kwargs: [False] * len(keys))
+@_async_namespace
+async def asmismember(name, keys, encode=True, namespace=None):
+    """Async version of :meth:`smismember`."""
+    global _smismember_supported
+    prepared_name = _prep_key(name, namespace)
+    members = [_encode_val(key, namespace) if encode else key for key in keys]
+    if not members:
+        return []
+    client = _aread_client(prepared_name)
+    if _smismember_supported:
+        try:
+            return [bool(result) for result in await client.smismember(prepared_name, members)]
+        except redis.exceptions.ResponseError as e:
+            if "unknown command" not in str(e).lower():
+                raise
+            _smismember_supported = False
+    async with client.pipeline(transaction=False) as pipe:
+        for member in members:
+            pipe.sismember(prepared_name, member)
+        return [bool(result) for result in await pipe.execute()]
+
+
+@init_required
+async def asscan_iter(name, decode=True, count=1000, namespace=None):
+    """Async version of :meth:`sscan_iter`."""
+    prepared_name = await _aprep_key(name, namespace)
+    async for key in _aread_client(prepared_name).sscan_iter(prepared_name, count=count):
+        yield _decode_val(key, namespace=namespace) if decode else key
+
+
+@init_required
+@_command(_returns(list))
+@_async_namespace
+async def alrange(name, start=0, end=-1, decode=True, namespace=None):
+    """Async version of :meth:`lrange`."""
+    prepared_name = _prep_key(name, namespace)
+    values = await _aread_client(prepared_name).lrange(prepared_name, start, end)
+    return [_decode_val(value, namespace=namespace) for value in values] if decode else values
+
+
+def gen_key(key, *attributes):
+    """Helper function that generates a key with attached attributes.
+
+    Args:
+        key: Original key.
+        attributes: Attributes that will be appended a key.
+
+    Returns:
+        Key that can be used with cache.
+    """
+    if not isinstance(key, str):
+        key = str(key)
+    key = key.encode(ENCODING_ASCII, errors='xmlcharrefreplace').decode(ENCODING_ASCII)
+
+    for attr in attributes:
+        if not isinstance(attr, str):
+            attr = str(attr)
+        key += '_' + attr.encode(ENCODING_ASCII, errors='xmlcharrefreplace').decode(ENCODING_ASCII)
+
+    key = key.replace(' ', '_')  # spaces are not allowed
+
+    return key
+
+
+# Escapes for the parts of keys generated by :meth:`cached`. They're joined with "_", kwargs are
+# added as "name=value" and gen_key replaces spaces and non-ASCII characters, so all of these
+# are escaped to keep the keys of different calls apart.
+_KEY_PART_ESCAPES = str.maketrans({"\\": "\\\\", "_": "\\u", " ": "\\s", "=": "\\e", "&": "\\a"})
+
+
+def _key_part(value):
+    return str(value).translate(_KEY_PART_ESCAPES)
+
+
+def cached(namespace=None, expirein=0, key_prefix=None, batch=False, absent_expirein=None):
+    """Decorator that caches return values of a function.
+
+    Cache keys are generated with :meth:`gen_key` from ``key_prefix`` (the function's
+    module and qualified name by default) and the arguments of the call, so all arguments need
+    to have a stable string representation. ``None`` results are not cached, unless
+    ``absent_expirein`` is set: then they're cached as :data:`ABSENT` for that many
+    seconds and the function isn't called for them again until they expire.
+
+    With ``batch=True`` the decorated function must take a list of items as its first
+    argument and return a dict of item/value pairs. Every item is cached separately:
+    only items that are missing from the cache are passed to the function and all
+    lookups and writes are done with :meth:`get_many` and :meth:`set_many`. Items that
+    the function doesn't return are treated like ``None`` results and items that are
+    cached as absent are left out of the result::
+
+        @cache.cached(namespace="release_group", expirein=3600, batch=True)
+        def fetch_multiple_release_groups(mbids, includes=None):
+            ...
+
+    The decorated function gets an ``invalidate`` method that takes the same arguments
+    as the function and deletes the corresponding items from the cache, and a ``make_key``
+    method that returns the key for the given arguments (for batch functions, for a single item).
+
+    Args:
+        namespace (str): Namespace for the keys.
+        expirein (int): The time after which the values should expire, in seconds.
+        key_prefix (str): Prefix for the keys, defaults to the module and qualified name of the function.
+        batch (bool): True if the function fetches multiple items at once, see above.
+        absent_expirein (int): The time for which ``None`` results are cached, in seconds.
+    """
+    def decorator(f):
+        prefix = key_prefix or "%s.%s" % (f.__module__, f.__qualname__)
+
+        def make_key(*args, **kwargs):
+            return gen_key(prefix, *map(_key_part, args),
+                           *("%s=%s" % (_key_part(k), _key_part(v)) for k, v in sorted(kwargs.items())))
+
+        if batch:
+            @wraps(f)
+            def decorated(items, *args, **kwargs):
+                keys = {item: make_key(item, *args, **kwargs) for item in items}
+                values = get_many(list(keys.values()), namespace=namespace)
+
+                result, missing = {}, []
+                for item, key in keys.items():
+                    if values[key] is None:
+                        missing.append(item)
+                    elif values[key] is not ABSENT:
+                        result[item] = values[key]
+
+                if missing:
+                    computed = f(missing, *args, **kwargs)
+                    mapping = {keys[item]: value for item, value in computed.items()
+                               if item in keys and value is not None}
+                    if absent_expirein is not None:
+                        mapping.update((keys[item], ABSENT) for item in missing if computed.get(item) is None)
+                    if mapping:
+                        set_many(mapping, expirein=expirein, namespace=namespace, absent_expirein=absent_expirein)
+                    result.update(computed)
+                return result
+
+            def invalidate(items, *args, **kwargs):
+                return delete_many([make_key(item, *args, **kwargs) for item in items], namespace=namespace)
+        else:
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                key = make_key(*args, **kwargs)
+                value = get(key, namespace=namespace)
+                if value is ABSENT:
+                    return None
+                if value is None:
+                    value = f(*args, **kwargs)
+                    if value is not None:
+                        set(key, value, expirein=expirein, namespace=namespace)
+                    elif absent_expirein is not None:
+                        set(key, ABSENT, expirein=absent_expirein, namespace=namespace)
+                return value
+
+            def invalidate(*args, **kwargs):
+                return delete(make_key(*args, **kwargs), namespace=namespace)
+
+        decorated.invalidate = invalidate
+        decorated.make_key = make_key
+        return decorated
+
+    return decorator
+
+
+def _prep_dict(dictionary, namespace=None, encode=True):
+    """Wrapper for _prep_key and _encode_val functions that works with dictionaries."""
+    return {_prep_key(key, namespace): _encode_val(value, namespace) if encode else value
+            for key, value in dictionary.items()}
+
+
+def _prep_key(key, namespace=None):
+    """Prepares a key for use with Redis."""
+    if namespace:
+        version = _namespace_version(namespace)
+        if version:
+            key = "%s@%d:%s" % (namespace, version, key)
+        else:
+            key = "%s:%s" % (namespace, key)
+    if not isinstance(key, bytes):
+        key = key.encode(ENCODING_ASCII, errors='xmlcharrefreplace').decode(ENCODING_ASCII)
+    return _glob_namespace + key
+
+
+def _prep_keys_list(l, namespace=None):
+    """Wrapper for _prep_key function that works with lists.
+
+    Returns:
+        Prepared keys in the same order.
+    """
+    return [_prep_key(k, namespace) for k in l]
+
+
+def _prep_items(mapping, expirein, namespace=None, encode=True, compute_time=None, absent_expirein=None):
+    """Prepares items for set_many.
+
+    Returns:
+        A list of (prepared key, value, expiration time) tuples.
+    """
+    now = time.time()
+    items = []
+    for key, value in mapping.items():
+        ttl = expirein.get(key) if isinstance(expirein, dict) else expirein
+        delta = compute_time.get(key) if isinstance(compute_time, dict) else compute_time
+        if value is ABSENT:
+            ttl = ttl if absent_expirein is None else absent_expirein
+            items.append((_prep_key(key, namespace), _ABSENT_VALUE, ttl))
+        elif not encode:
+            items.append((_prep_key(key, namespace), value, ttl))
+        elif delta is None:
+            items.append((_prep_key(key, namespace), _encode_val(value, namespace), ttl))
+        else:
+            value = _RefreshableValue(value, delta, now + ttl if ttl else None)
+            items.append((_prep_key(key, namespace), _encode_val(value, namespace), ttl))
+    return items
+
+
+def _pipeline_set(pipe, items, nx=False, xx=False):
+    """Queues SET commands for items prepared with _prep_items in a pipeline."""
+    for prepared_key, value, ttl in items:
+        pipe.set(prepared_key, value, px=int(ttl * 1000) if ttl else None, nx=nx, xx=xx)
+
+
+def _prep_members(keys, encode, namespace):
+    """Prepares members of a set, a single member or a list or set of them."""
+    if not isinstance(keys, list) and not isinstance(keys, builtins.set):
+        keys = {keys}
+    if encode:
+        keys = {_encode_val(key, namespace) for key in keys}
+    return keys
+
+
+def _prep_hashes(hashes, encode, namespace):
+    """Prepares names and values of hashes for hset_multi."""
+    return {
+        _prep_key(name, namespace): {
+            key: _encode_val(value, namespace) if encode else value for key, value in mapping.items()
+        }
+        for name, mapping in hashes.items()
+    }
+
+
+def _pipeline_hset(pipe, prepared_hashes, expirein):
+    """Queues commands that set keys of hashes prepared with _prep_hashes in a pipeline."""
+    for prepared_name, mapping in prepared_hashes:
+        if not mapping:
+            continue
+        # HMSET instead of HSET with multiple keys, which requires Redis 4.0
+        pipe.execute_command("HMSET", prepared_name, *[item for pair in mapping.items() for item in pair])
+        if expirein:
+            pipe.pexpire(prepared_name, int(expirein * 1000))
+
+
+def _decode_hmget(keys, values, decode, namespace):
+    return {key: _decode_val(value, namespace=namespace) if decode else value for key, value in zip(keys, values)}
+
+
+def _decode_hash(result, namespace):
+    """Decodes the result of HGETALL for hashes written by hset_many."""
+    return {key.decode(CONTENT_ENCODING): _decode_val(value, namespace=namespace) for key, value in result.items()}
+
+
+def _decode_many(keys, values, decode=True, namespace=None):
+    """Builds the result of get_many from values in the same order as keys."""
+    result = {}
+    for i, value in enumerate(values):
+        result[keys[i]] = _decode_val(value, namespace=namespace) if decode else value
+    return result
+
+
+def _encode_val(value, namespace=None):
+    """Encodes a value with the serializer of the namespace.
+
+    Compressed values and values stored with their compute and expiration times are
+    wrapped in msgpack ext types, regardless of the serializer.
+    """
+    if value is None:
+        return value
+    serializer = _namespace_serializers.get(namespace, _serializer)
+    if isinstance(value, _RefreshableValue):
+        packed = msgpack.packb(msgpack.ExtType(TYPE_REFRESHABLE_CODE, msgpack.packb([
+            value.compute_time,
+            value.expires_at,
+            serializer.dumps(value.value),
+        ], use_bin_type=True)))
+    else:
+        packed = serializer.dumps(value)
+        # Other formats may start with the same bytes as the ext types above (e.g. CBOR tags),
+        # such values are wrapped so that they aren't mistaken for one
+        if packed[:1] and packed[0] in _EXT_TYPE_MARKERS and not isinstance(serializer, MsgpackSerializer):
+            packed = msgpack.packb(msgpack.ExtType(TYPE_SERIALIZED_CODE, packed))
+    if _compression_threshold is not None and len(packed) > _compression_threshold:
+        compressed = zlib.compress(packed, _compression_level)
+        # Incompressible data is stored as is
+        if len(compressed) < len(packed):
+            return msgpack.packb(msgpack.ExtType(TYPE_COMPRESSED_CODE, compressed))
+    return packed
+
+
+def _decode_val(value, refreshable=False, namespace=None):
+    """Decodes a value encoded with _encode_val.
+
+    Values that were stored with their compute and expiration times are returned as
+    _RefreshableValue if ``refreshable`` is True, and as plain values otherwise.
+    """
     if value is None:
         return value
-    return msgpack.unpackb(value, raw=False, ext_hook=_msgpack_ext_hook)
+    value = _unwrap_val(value, _namespace_serializers.get(namespace, _serializer))
+    if isinstance(value, _RefreshableValue) and not refreshable:
+        return value.value
+    return value
+
+
+# First bytes of msgpack ext types
+_EXT_TYPE_MARKERS = frozenset(b"\xc7\xc8\xc9\xd4\xd5\xd6\xd7\xd8")
+
+
+def _unwrap_val(data, serializer):
+    """Decodes data with the serializer after unwrapping compressed and refreshable values."""
+    if data[0] in _EXT_TYPE_MARKERS:
+        try:
+            ext = msgpack.unpackb(data)
+        except ValueError:
+            # Output of another serializer that was stored before it was wrapped
+            ext = None
+        if isinstance(ext, msgpack.ExtType):
+            if ext.code == TYPE_SERIALIZED_CODE:
+                return serializer.loads(ext.data)
+            if ext.code == TYPE_COMPRESSED_CODE:
+                return _unwrap_val(zlib.decompress(ext.data), serializer)
+            if ext.code == TYPE_ABSENT_CODE:
+                return ABSENT
+            if ext.code == TYPE_REFRESHABLE_CODE:
+                compute_time, expires_at, payload = msgpack.unpackb(ext.data, raw=False)
+                return _RefreshableValue(serializer.loads(payload), compute_time, expires_at)
+    return serializer.loads(data)
+
+
+#############
+# LOCAL CACHE
+#############
+
+class _LocalCache:
+    """Bounded in-process LRU cache of raw (encoded) values with per-item expiry.
+
+    Values are kept exactly as they are returned by Redis so that callers can't
+    modify cached items and the usual decoding still applies on every read.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()  # key -> (value, expiry time)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored for ``key`` or None if it's missing or expired."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[1] <= time.monotonic():
+                self._remove(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, expirein=None):
+        """Store ``value`` for at most ``expirein`` seconds (capped by the cache's ttl).
+
+        Values that Redis wouldn't return as-is (anything but bytes) are not cached.
+        """
+        with self._lock:
+            self._remove(key)
+            if not isinstance(value, bytes) or len(value) > self.max_bytes:
+                return
+            ttl = min(expirein, self.ttl) if expirein else self.ttl
+            self._items[key] = (value, time.monotonic() + ttl)
+            self._size += len(value)
+            while len(self._items) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._items),
+                "bytes": self._size,
+            }
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= len(item[0])
+
+
+def _local_enabled(namespace):
+    """Checks if items in the namespace should be stored in the local cache."""
+    return _local is not None and namespace in _local_namespaces
+
+
+def _local_get_many(prepared_keys, namespace):
+    """Looks up prepared keys in the local cache and the shared cache.
+
+    Returns:
+        A list of values in the same order as the keys (None for missing values)
+        and a list of indexes of the keys that need to be fetched from Redis.
+    """
+    local, shared = _local_enabled(namespace), _shared_enabled(namespace)
+    if not local and not shared:
+        return [None] * len(prepared_keys), list(range(len(prepared_keys)))
+    if local:
+        values = [_local.get(prepared_key) for prepared_key in prepared_keys]
+    else:
+        values = [None] * len(prepared_keys)
+    if shared:
+        for i, value in enumerate(values):
+            if value is None:
+                value = values[i] = _shared.get(prepared_keys[i])
+                if local and value is not None:
+                    _local.set(prepared_keys[i], value)
+    return values, [i for i, value in enumerate(values) if value is None]
+
+
+def _local_fill(values, missing, fetched, prepared_keys, namespace):
+    """Puts values fetched from Redis into the result of _local_get_many and the in-process
+    and shared caches."""
+    local, shared = _local_enabled(namespace), _shared_enabled(namespace)
+    for i, value in zip(missing, fetched):
+        values[i] = value
+        if value is not None:
+            if local:
+                _local.set(prepared_keys[i], value)
+            if shared:
+                _shared.set(prepared_keys[i], value)
+
+
+def _local_set_many(items, namespace, drop=False):
+    """Updates the local cache after items prepared with _prep_items were written.
+
+    If ``drop`` is True the items are removed from the local cache instead, this is
+    used when it's not known which of the items were actually written.
+    """
+    if _tracking_enabled(namespace):
+        # Don't wait for the invalidation message, so that the process can read its own writes
+        _tracking.invalidate([prepared_key for prepared_key, _, _ in items])
+    for cache in (_local if _local_enabled(namespace) else None, _shared if _shared_enabled(namespace) else None):
+        if cache is None:
+            continue
+        for prepared_key, value, ttl in items:
+            if drop:
+                cache.delete(prepared_key)
+            else:
+                cache.set(prepared_key, value, ttl)
+
+
+def _local_delete_many(prepared_keys, namespace):
+    if _tracking_enabled(namespace):
+        _tracking.invalidate(prepared_keys)
+    if _local_enabled(namespace):
+        for prepared_key in prepared_keys:
+            _local.delete(prepared_key)
+    if _shared_enabled(namespace):
+        for prepared_key in prepared_keys:
+            _shared.delete(prepared_key)
+
+
+def local_cache_stats():
+    """Returns statistics of the in-process cache.
+
+    Returns:
+        A dictionary with the number of hits, misses and evictions as well as the
+        current number of entries and their size in bytes, or None if the local
+        cache is disabled.
+    """
+    if _local is None:
+        return None
+    return _local.stats()
+
+
+#####################
+# SHARED MEMORY CACHE
+#####################
+
+def _shared_cache_path(namespace, nodes_kwargs, size, slot_size):
+    """Returns the default path of the shared cache, which is only shared by processes of the same
+    user that use the same global namespace, Redis databases and size options."""
+    servers = [namespace] + ["%s:%s/%s" % (kwargs.get("path") or kwargs["host"], kwargs.get("port", ""), kwargs["db"])
+                             for kwargs in nodes_kwargs]
+    digest = hashlib.sha1("\n".join(servers).encode(CONTENT_ENCODING)).hexdigest()[:16]
+    return os.path.join(
+        "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+        "brainzutils-cache-%d-%s-%d-%d" % (os.geteuid(), digest, size, slot_size),
+    )
+
+
+def _shared_enabled(namespace):
+    """Checks if items in the namespace should be stored in the shared cache."""
+    return _shared is not None and namespace in _shared_namespaces
+
+
+def shared_cache_stats():
+    """Returns statistics of the cache in shared memory.
+
+    Returns:
+        A dictionary with the number of hits, misses and evictions of this process as well as
+        the current number of entries and the total number of slots, or None if the shared cache
+        is disabled.
+    """
+    if _shared is None:
+        return None
+    return _shared.stats()
+
+
+#####################
+# CLIENT SIDE CACHING
+#####################
+
+def _tracking_enabled(namespace):
+    """Checks if items in the namespace should be cached using client side caching."""
+    return _tracking is not None and namespace in _tracking_namespaces
+
+
+def client_tracking_stats():
+    """Returns statistics of client side caching.
+
+    Returns:
+        A dictionary with the number of hits, misses and invalidations, the current number
+        of entries and whether the connection for invalidation messages is up, or None if
+        client side caching is disabled.
+    """
+    if _tracking is None:
+        return None
+    return _tracking.stats()
 
 
 ############
@@ -431,20 +2676,576 @@ def validate_namespace(namespace):
         raise ValueError("Invalid namespace. Must match regex /[a-zA-Z0-9_-]+$/.")
 
 
+@init_required
+def invalidate_namespace(namespace):
+    """Invalidates all items in a namespace.
+
+    This increments the version of the namespace, which is a part of all keys in
+    it, so the items that were stored before are no longer found. It's a single
+    command regardless of the number of items; old items are removed by Redis
+    once they expire (or evicted, if Redis is configured with an eviction policy).
+
+    Other processes see the new version after up to ``namespace_version_ttl`` seconds
+    (see :meth:`init`).
+
+    Args:
+        namespace: Namespace to invalidate.
+
+    Returns:
+        The new version of the namespace.
+    """
+    version_key = _namespace_version_key(namespace)
+    version = _client(version_key).incr(version_key)
+    _namespace_versions[namespace] = (version, time.monotonic() + _namespace_version_ttl)
+    return version
+
+
+def _namespace_version(namespace):
+    """Returns the current version of a namespace, 0 if it was never invalidated."""
+    pinned = _pinned_versions.get()
+    if pinned is not None and namespace in pinned:
+        return pinned[namespace]
+    version = _namespace_versions.get(namespace)
+    now = time.monotonic()
+    if version is None or version[1] <= now:
+        version_key = _namespace_version_key(namespace)
+        _use_redis()
+        value = _clients[_node_index(version_key)].get(version_key)
+        version = (int(value or 0), now + _namespace_version_ttl)
+        _namespace_versions[namespace] = version
+    return version[0]
+
+
+async def _anamespace_version(namespace):
+    """Async version of _namespace_version."""
+    version = _namespace_versions.get(namespace)
+    now = time.monotonic()
+    if version is None or version[1] <= now:
+        version_key = _namespace_version_key(namespace)
+        value = await _async_clients()[0][_node_index(version_key)].get(version_key)
+        version = (int(value or 0), now + _namespace_version_ttl)
+        _namespace_versions[namespace] = version
+    return version[0]
+
+
+async def _aprep_key(key, namespace=None):
+    """Async version of _prep_key, for functions that aren't wrapped with _async_namespace."""
+    if not namespace:
+        return _prep_key(key, namespace)
+    token = _pinned_versions.set({**(_pinned_versions.get() or {}),
+                                  namespace: await _anamespace_version(namespace)})
+    try:
+        return _prep_key(key, namespace)
+    finally:
+        _pinned_versions.reset(token)
+
+
+def _namespace_version_key(namespace):
+    # "@" can't be used in namespaces, so this doesn't clash with keys of a namespace
+    return "%s@version:%s" % (_glob_namespace, namespace)
+
+
+######
+# TAGS
+######
+
+@init_required
+@_command(_returns(int))
+def invalidate_tags(tags, count=1000):
+    """Delete all items that were stored with any of the given tags, see :meth:`set_many`.
+
+    Keys of every tag are kept in a Redis set, which is renamed before it's read, so that items
+    tagged during the invalidation are kept in a new set. Keys are read with SSCAN and deleted
+    in batches, like in :meth:`delete_pattern`.
+
+    Args:
+        tags (list): Tags of the items.
+        count: Number of keys that are read in each step of SSCAN and maximum number of keys
+          that are deleted with a single command.
+
+    Returns:
+        Number of items that were deleted.
+    """
+    deleted = 0
+    for tag in tags:
+        tag_key = _tag_key(tag)
+        client = _client(tag_key)
+        invalidated_key = "%s:invalidated:%s" % (tag_key, uuid.uuid4().hex)
+        try:
+            client.rename(tag_key, invalidated_key)
+        except redis.exceptions.ResponseError:
+            # The tag has no items
+            continue
+        batch = []
+        for prepared_key in client.sscan_iter(invalidated_key, count=count):
+            batch.append(prepared_key.decode(CONTENT_ENCODING))
+            if len(batch) >= count:
+                deleted += _delete_tagged(batch)
+                batch = []
+        if batch:
+            deleted += _delete_tagged(batch)
+        client.delete(invalidated_key)
+    return deleted
+
+
+def _delete_tagged(prepared_keys):
+    # Items with a tag may belong to any namespace
+    for cache in (_local, _shared):
+        if cache is not None:
+            for prepared_key in prepared_keys:
+                cache.delete(prepared_key)
+    if _tracking is not None:
+        _tracking.invalidate(prepared_keys)
+    return _unlink(prepared_keys, None)
+
+
+def _tag_key(tag):
+    # "@" can't be used in namespaces, so this doesn't clash with keys of a namespace
+    return "%s@tag:%s" % (_glob_namespace, tag)
+
+
+def _tagged_keys(mapping, items, tags):
+    """Collects keys of items prepared with _prep_items by tag.
+
+    Returns:
+        A dict of tag keys and (list of prepared keys, expiration time in milliseconds) pairs,
+        the expiration time is the largest one of the items, None if some of them don't expire.
+    """
+    tagged = {}
+    for key, (prepared_key, _, ttl) in zip(mapping, items):
+        for tag in tags.get(key, ()) if isinstance(tags, dict) else tags:
+            prepared_keys, max_ttl = tagged.get(_tag_key(tag), ([], 0))
+            prepared_keys.append(prepared_key)
+            max_ttl = None if max_ttl is None or not ttl else max(max_ttl, int(ttl * 1000))
+            tagged[_tag_key(tag)] = (prepared_keys, max_ttl)
+    return tagged
+
+
+def _add_tags(tagged):
+    """Adds keys to the sets of their tags, which expire with the last of their items."""
+    all_tag_keys = list(tagged)
+    groups = _group_by_node(all_tag_keys)
+
+    def add_node_tags(node, indexes):
+        tag_keys = [all_tag_keys[i] for i in indexes]
+        pipe = _clients[node].pipeline(transaction=True)
+        for tag_key in tag_keys:
+            pipe.exists(tag_key)
+            pipe.sadd(tag_key, *tagged[tag_key][0])
+            pipe.pttl(tag_key)
+        results = pipe.execute()
+        pipe = _clients[node].pipeline(transaction=False)
+        if _queue_tag_expiration(pipe, tag_keys, tagged, results):
+            pipe.execute()
+
+    _fan_out(add_node_tags, groups)
+
+
+async def _aadd_tags(tagged):
+    all_tag_keys = list(tagged)
+    groups = _group_by_node(all_tag_keys)
+
+    async def add_node_tags(node, indexes):
+        tag_keys = [all_tag_keys[i] for i in indexes]
+        async with _async_clients()[0][node].pipeline(transaction=True) as pipe:
+            for tag_key in tag_keys:
+                pipe.exists(tag_key)
+                pipe.sadd(tag_key, *tagged[tag_key][0])
+                pipe.pttl(tag_key)
+            results = await pipe.execute()
+        async with _async_clients()[0][node].pipeline(transaction=False) as pipe:
+            if _queue_tag_expiration(pipe, tag_keys, tagged, results):
+                await pipe.execute()
+
+    await _afan_out(add_node_tags, groups)
+
+
+def _queue_tag_expiration(pipe, tag_keys, tagged, results):
+    """Queues commands that extend the expiration time of tag sets if their new items expire later.
+
+    Args:
+        results: Results of EXISTS, SADD and PTTL for every tag key.
+
+    Returns:
+        True if any commands were queued.
+    """
+    queued = False
+    for i, tag_key in enumerate(tag_keys):
+        existed, current_ttl = results[3 * i], results[3 * i + 2]
+        ttl = tagged[tag_key][1]
+        if not existed:
+            if ttl:
+                pipe.pexpire(tag_key, ttl)
+                queued = True
+        elif current_ttl >= 0:
+            # An existing set without an expiration time already outlives all its items
+            if ttl is None:
+                pipe.persist(tag_key)
+                queued = True
+            elif ttl > current_ttl:
+                pipe.pexpire(tag_key, ttl)
+                queued = True
+    return queued
+
+
+#############
+# LUA SCRIPTS
+#############
+
+# Operations that need several commands are done by Lua scripts, see brainzutils.cache_scripts
+
+def register_script(name, source):
+    """Add a Lua script to the registry, so that it can be run with :meth:`run_script`.
+
+    A script that was already registered with the same name is replaced.
+
+    Args:
+        name (str): Name of the script.
+        source (str): Lua source of the script. Names of the keys are passed in KEYS and
+          the other arguments in ARGV, like with EVAL.
+    """
+    cache_scripts.SCRIPTS[name] = cache_scripts.Script(source)
+
+
+@init_required
+@_command()
+def run_script(name, keys, args=(), namespace=None):
+    """Run a script of the registry with EVALSHA.
+
+    The keys are prepared like keys of the other functions, so they must all belong to the
+    same namespace and, if keys are distributed between multiple nodes, to the same node.
+    Items that the script reads may be modified by it, so they are dropped from the local
+    caches of this process.
+
+    Args:
+        name (str): Name of the script, see :meth:`register_script`.
+        keys (list): Keys of the items that the script accesses.
+        args (list): Other arguments of the script.
+        namespace: Optional namespace of the keys.
+
+    Returns:
+        The result of the script, as returned by Redis.
+    """
+    prepared_keys = _prep_keys_list(keys, namespace)
+    return cache_scripts.SCRIPTS[name].run(_script_client(prepared_keys, namespace, _clients), prepared_keys, args)
+
+
+def _script_client(prepared_keys, namespace, clients):
+    nodes = {_node_index(prepared_key) for prepared_key in prepared_keys}
+    if len(nodes) > 1:
+        raise ValueError("All keys of a script must be stored on the same node")
+    _use_redis()
+    _mark_written(prepared_keys)
+    _local_delete_many(prepared_keys, namespace)
+    return clients[nodes.pop() if nodes else 0]
+
+
+@init_required
+@_command(_returns(int))
+def incr_expire(key, expirein, amount=1, namespace=None):
+    """Increment the value for given key and set its expiration time if it has none.
+
+    Unlike calling :meth:`increment` and :meth:`expire`, the expiration time is only set
+    when the increment creates the item, so later increments don't extend it. This is what
+    fixed window counters, like rate limits, need.
+
+    Args:
+        key: Key of the item that needs to be incremented
+        expirein: the number of seconds after which a new item should expire, 0 for none
+        amount: the amount to increment the value by
+        namespace: Namespace for the key
+
+    Returns:
+        An integer equal to the value after increment
+    """
+    return run_script("incr_expire", [key], [amount, int(expirein * 1000)], namespace=namespace)
+
+
+@init_required
+@_command()
+def getex_refresh(key, expirein, namespace=None, decode=True):
+    """Retrieve an item and reset its expiration time, like GETEX on newer versions of Redis.
+
+    Args:
+        key: Key of the item that needs to be retrieved.
+        expirein: the number of seconds after which the item should expire, 0 to keep its
+          current expiration time
+        namespace: Optional namespace in which key was defined.
+        decode (bool): True if value should be decoded with msgpack, False otherwise
+
+    Returns:
+        Stored value or None if it's not found.
+    """
+    value = run_script("getex_refresh", [key], [int(expirein * 1000)], namespace=namespace)
+    return _decode_val(value, namespace=namespace) if decode else value
+
+
+@init_required
+@_command(_returns(bool))
+def cas(key, expected, val, expirein, namespace=None, encode=True):
+    """Set a key to a given value if its current value is the expected one (compare-and-set).
+
+    Values are compared in their encoded form, so ``expected`` must be encoded to the same
+    bytes as the stored value. Values stored with ``compute_time`` never match.
+
+    Args:
+        key (str): Key of the item.
+        expected: The value that the item must have, None if it must not exist.
+        val: New value of the item.
+        expirein (int): The time after which the new value should expire, in seconds, 0 for never.
+        namespace (str): Optional namespace in which key needs to be defined.
+        encode: True if the values should be encoded with msgpack, False otherwise
+
+    Returns:
+        True if the value was set, False if the item had another value.
+    """
+    if encode:
+        expected = _encode_val(expected, namespace)
+        val = _encode_val(val, namespace)
+    args = ["0", ""] if expected is None else ["1", expected]
+    return bool(run_script("cas", [key], args + [val, int(expirein * 1000)], namespace=namespace))
+
+
+@init_required
+@_command(_returns(int))
+def rpush_capped(name, values, max_length, expirein=0, encode=True, namespace=None):
+    """Append values to the list stored at name and keep only its last ``max_length`` values.
+
+    Args:
+        name: Name of the list
+        values (list): values to append to the list
+        max_length (int): maximum number of values in the list, older values are removed
+        expirein: the number of seconds after which the list should expire, 0 to keep its
+          current expiration time
+        encode: True if the values should be encoded with msgpack, False otherwise
+        namespace: namespace for the name
+
+    Returns:
+        the length of the list after the values were appended
+    """
+    if max_length < 1:
+        raise ValueError("max_length must be positive")
+    values = list(values)[-max_length:]
+    if encode:
+        values = [_encode_val(value, namespace) for value in values]
+    return run_script("rpush_capped", [name], [max_length, int(expirein * 1000)] + values, namespace=namespace)
+
+
+@init_required
+@_command()
+@_async_namespace
+async def arun_script(name, keys, args=(), namespace=None):
+    """Async version of :meth:`run_script`."""
+    prepared_keys = _prep_keys_list(keys, namespace)
+    client = _script_client(prepared_keys, namespace, _async_clients()[0])
+    return await cache_scripts.SCRIPTS[name].arun(client, prepared_keys, args)
+
+
+@init_required
+@_command(_returns(int))
+@_async_namespace
+async def aincr_expire(key, expirein, amount=1, namespace=None):
+    """Async version of :meth:`incr_expire`."""
+    return await arun_script("incr_expire", [key], [amount, int(expirein * 1000)], namespace=namespace)
+
+
+@init_required
+@_command()
+@_async_namespace
+async def agetex_refresh(key, expirein, namespace=None, decode=True):
+    """Async version of :meth:`getex_refresh`."""
+    value = await arun_script("getex_refresh", [key], [int(expirein * 1000)], namespace=namespace)
+    return _decode_val(value, namespace=namespace) if decode else value
+
+
+@init_required
+@_command(_returns(bool))
+@_async_namespace
+async def acas(key, expected, val, expirein, namespace=None, encode=True):
+    """Async version of :meth:`cas`."""
+    if encode:
+        expected = _encode_val(expected, namespace)
+        val = _encode_val(val, namespace)
+    args = ["0", ""] if expected is None else ["1", expected]
+    return bool(await arun_script("cas", [key], args + [val, int(expirein * 1000)], namespace=namespace))
+
+
+@init_required
+@_command(_returns(int))
+@_async_namespace
+async def arpush_capped(name, values, max_length, expirein=0, encode=True, namespace=None):
+    """Async version of :meth:`rpush_capped`."""
+    if max_length < 1:
+        raise ValueError("max_length must be positive")
+    values = list(values)[-max_length:]
+    if encode:
+        values = [_encode_val(value, namespace) for value in values]
+    return await arun_script("rpush_capped", [name], [max_length, int(expirein * 1000)] + values,
+                             namespace=namespace)
+
+
 ######################
 # CUSTOM SERIALIZATION
 ######################
 
+# Datetime as an ISO 8601 string, only decoded for values written by older versions
 TYPE_DATETIME_CODE = 1
+# A complete encoded value compressed with zlib
+TYPE_COMPRESSED_CODE = 2
+# An encoded value together with its compute and expiration time
+TYPE_REFRESHABLE_CODE = 3
+TYPE_UUID_CODE = 4
+TYPE_DATE_CODE = 5
+TYPE_DATETIME_EPOCH_CODE = 6
+TYPE_DECIMAL_CODE = 7
+# The ABSENT sentinel
+TYPE_ABSENT_CODE = 8
+# Output of a serializer other than msgpack that starts like a msgpack ext type
+TYPE_SERIALIZED_CODE = 9
+# Codes below this one are reserved for brainzutils
+MIN_CUSTOM_TYPE_CODE = 16
+
+
+class _RefreshableValue:
+    """A cached value with the time it took to compute it and its expiration timestamp."""
+    __slots__ = ("value", "compute_time", "expires_at")
+
+    def __init__(self, value, compute_time, expires_at):
+        self.value = value
+        self.compute_time = compute_time
+        self.expires_at = expires_at
+
+
+class _Absent:
+    """Type of the ABSENT sentinel."""
+    __slots__ = ()
+
+    def __repr__(self):
+        return "ABSENT"
+
+    def __reduce__(self):
+        return "ABSENT"
+
+
+# Stored instead of items that are known not to exist (negative caching). get functions return
+# it instead of None, so callers can tell an item that doesn't exist from one that isn't cached.
+ABSENT = _Absent()
+_ABSENT_VALUE = msgpack.packb(msgpack.ExtType(TYPE_ABSENT_CODE, b""))
+
+
+class MsgpackSerializer:
+    """Serializes values with msgpack.
+
+    Besides the types that msgpack supports natively, ``uuid.UUID`` (16 bytes),
+    ``datetime.date`` (days), ``datetime.datetime`` (microseconds since the epoch
+    and UTC offset) and ``decimal.Decimal`` values are stored as compact msgpack
+    ext types. Support for more types can be added with :meth:`register`.
+    """
+
+    def __init__(self):
+        self._encoders = {}  # type -> (code, function)
+        self._decoders = {TYPE_DATETIME_CODE: _decode_datetime_iso}
+        # datetime needs to come before its base class date, see _default
+        self._register(TYPE_DATETIME_EPOCH_CODE, datetime.datetime, _encode_datetime, _decode_datetime)
+        self._register(TYPE_DATE_CODE, datetime.date, _encode_date, _decode_date)
+        self._register(TYPE_UUID_CODE, uuid.UUID, _encode_uuid, _decode_uuid)
+        self._register(TYPE_DECIMAL_CODE, decimal.Decimal, _encode_decimal, _decode_decimal)
+
+    def register(self, code, cls, encode, decode):
+        """Adds support for values of an additional type.
+
+        Args:
+            code (int): msgpack ext type code, between ``MIN_CUSTOM_TYPE_CODE`` and 127.
+            cls: The type, instances of its subclasses are encoded too.
+            encode: Function that converts a value to bytes.
+            decode: Function that converts bytes back to a value.
+        """
+        if not MIN_CUSTOM_TYPE_CODE <= code <= 127:
+            raise ValueError("Ext type code must be between %d and 127" % MIN_CUSTOM_TYPE_CODE)
+        self._register(code, cls, encode, decode)
+
+    def _register(self, code, cls, encode, decode):
+        self._encoders[cls] = (code, encode)
+        self._decoders[code] = decode
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True, default=self._default)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False, ext_hook=self._ext_hook)
+
+    def _default(self, obj):
+        encoder = self._encoders.get(type(obj))
+        if encoder is None:
+            for cls, cls_encoder in self._encoders.items():
+                if isinstance(obj, cls):
+                    encoder = cls_encoder
+                    break
+            else:
+                raise TypeError("Unknown type: %r" % (obj,))
+        code, encode = encoder
+        return msgpack.ExtType(code, encode(obj))
+
+    def _ext_hook(self, code, data):
+        decode = self._decoders.get(code)
+        if decode is None:
+            return msgpack.ExtType(code, data)
+        return decode(data)
+
+
+class JSONSerializer:
+    """Serializes values as JSON, e.g. for items that are also read by non-Python clients."""
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode(CONTENT_ENCODING)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_UTC = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def _encode_datetime(value):
+    offset = value.utcoffset()
+    if offset is None:
+        return struct.pack(">q", (value - _EPOCH) // _MICROSECOND)
+    return struct.pack(">qi", (value - _EPOCH_UTC) // _MICROSECOND, int(offset.total_seconds()))
+
+
+def _decode_datetime(data):
+    if len(data) == 8:
+        return _EPOCH + struct.unpack(">q", data)[0] * _MICROSECOND
+    microseconds, offset = struct.unpack(">qi", data)
+    tz = datetime.timezone(datetime.timedelta(seconds=offset))
+    return (_EPOCH_UTC + microseconds * _MICROSECOND).astimezone(tz)
+
+
+def _decode_datetime_iso(data):
+    return datetime.datetime.fromisoformat(data.decode(CONTENT_ENCODING))
+
+
+def _encode_date(value):
+    return struct.pack(">i", value.toordinal())
+
+
+def _decode_date(data):
+    return datetime.date.fromordinal(struct.unpack(">i", data)[0])
+
+
+def _encode_uuid(value):
+    return value.bytes
+
+
+def _decode_uuid(data):
+    return uuid.UUID(bytes=data)
 
 
-def _msgpack_default(obj):
-    if isinstance(obj, datetime.datetime):
-        return msgpack.ExtType(TYPE_DATETIME_CODE, obj.isoformat().encode(CONTENT_ENCODING))
-    raise TypeError("Unknown type: %r" % (obj,))
+def _encode_decimal(value):
+    return str(value).encode(ENCODING_ASCII)
 
 
-def _msgpack_ext_hook(code, data):
-    if code == TYPE_DATETIME_CODE:
-        return datetime.datetime.fromisoformat(data.decode(CONTENT_ENCODING))
-    return msgpack.ExtType(code, data)
+def _decode_decimal(data):
+    return decimal.Decimal(data.decode(ENCODING_ASCII))
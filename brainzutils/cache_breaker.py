@@ -0,0 +1,89 @@
+"""
+Circuit breaker of :mod:`brainzutils.cache`.
+
+It counts calls to Redis that fail or are too slow and short-circuits calls for a while
+once there were too many of them, see the ``circuit_breaker_*`` options of
+:meth:`brainzutils.cache.init`.
+"""
+import threading
+import time
+
+import redis
+
+
+# Errors that count as failures for the circuit breaker
+BREAKER_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+
+class CircuitOpenError(redis.exceptions.ConnectionError):
+    """Raised instead of calling Redis while the circuit breaker is open, see :meth:`brainzutils.cache.init`."""
+
+
+class CircuitBreaker:
+    """Tracks failures of calls to Redis and decides whether calls should be short-circuited."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, max_failures, latency, reset_timeout, fail_silently):
+        self.max_failures = max_failures
+        self.latency = latency
+        self.reset_timeout = reset_timeout
+        self.fail_silently = fail_silently
+        self.state = self.CLOSED
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0
+        self._probing = False
+        self._trips = 0
+        self._short_circuited = 0
+
+    def allow(self):
+        """Checks if a call can go to Redis. After the reset timeout, a single call is let
+        through as a probe and all others are short-circuited until it's finished."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self._short_circuited += 1
+            return False
+
+    def record(self, error, duration, used=True):
+        """Records the result of a call, ``used`` is False if it didn't send any commands to Redis."""
+        failed = error or (self.latency is not None and duration > self.latency)
+        with self._lock:
+            self._probing = False
+            if not used:
+                # Calls answered from the in-process caches say nothing about Redis, a probe
+                # like that only lets the next call through as a probe
+                return
+            if not failed:
+                # Calls that started before the circuit breaker opened don't close it
+                if self.state != self.OPEN:
+                    self.state = self.CLOSED
+                    self._failures = 0
+                return
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.max_failures):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._trips += 1
+
+    def short_circuit(self, miss, args, kwargs):
+        if not self.fail_silently:
+            raise CircuitOpenError("Circuit breaker is open, Redis is unavailable")
+        return miss(*args, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self._failures,
+                "trips": self._trips,
+                "short_circuited": self._short_circuited,
+            }
@@ -0,0 +1,87 @@
+"""
+Registry of the Lua scripts of :mod:`brainzutils.cache`, see
+:meth:`brainzutils.cache.register_script`.
+
+Operations that need several commands are done by Lua scripts, so that they are atomic
+and take a single round trip. Scripts are run with EVALSHA and are loaded into a node
+the first time that it doesn't know them, e.g. after a restart or a SCRIPT FLUSH.
+"""
+import hashlib
+
+import redis
+
+
+class Script:
+    """A Lua script of the registry, see :meth:`brainzutils.cache.register_script`."""
+
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    def run(self, client, keys, args):
+        try:
+            return client.evalsha(self.sha, len(keys), *keys, *args)
+        except redis.exceptions.NoScriptError:
+            client.script_load(self.source)
+            return client.evalsha(self.sha, len(keys), *keys, *args)
+
+    async def arun(self, client, keys, args):
+        try:
+            return await client.evalsha(self.sha, len(keys), *keys, *args)
+        except redis.exceptions.NoScriptError:
+            await client.script_load(self.source)
+            return await client.evalsha(self.sha, len(keys), *keys, *args)
+
+
+# Scripts by name, including the scripts that are registered by users
+SCRIPTS = {}
+
+SCRIPTS["incr_expire"] = Script("""
+local value = redis.call('INCRBY', KEYS[1], ARGV[1])
+if tonumber(ARGV[2]) > 0 and redis.call('PTTL', KEYS[1]) == -1 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return value
+""")
+
+SCRIPTS["getex_refresh"] = Script("""
+local value = redis.call('GET', KEYS[1])
+if value and tonumber(ARGV[1]) > 0 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[1])
+end
+return value
+""")
+
+SCRIPTS["cas"] = Script("""
+local current = redis.call('GET', KEYS[1])
+if ARGV[1] == '1' then
+    if current ~= ARGV[2] then
+        return 0
+    end
+elseif current then
+    return 0
+end
+if tonumber(ARGV[4]) > 0 then
+    redis.call('SET', KEYS[1], ARGV[3], 'PX', ARGV[4])
+else
+    redis.call('SET', KEYS[1], ARGV[3])
+end
+return 1
+""")
+
+# Values are pushed in batches, unpack can't return more than a few thousand of them
+SCRIPTS["rpush_capped"] = Script("""
+local length = redis.call('LLEN', KEYS[1])
+for i = 3, #ARGV, 1000 do
+    length = redis.call('RPUSH', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+local max_length = tonumber(ARGV[1])
+if length > max_length then
+    redis.call('LTRIM', KEYS[1], -max_length, -1)
+    length = max_length
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return length
+""")
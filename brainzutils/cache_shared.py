@@ -0,0 +1,228 @@
+"""
+Cache in shared memory of :mod:`brainzutils.cache`, which is used by all processes on a host,
+see the ``shared_cache_*`` options of :meth:`brainzutils.cache.init`.
+"""
+import contextlib
+import hashlib
+import mmap
+import os
+import stat
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows, the shared cache isn't available
+    fcntl = None
+
+
+# Number of slots in a bucket of the shared cache, every key can be stored in any slot of one bucket
+SHARED_CACHE_WAYS = 8
+
+# Magic, version, slot size, number of buckets, number of slots per bucket
+_HEADER = struct.Struct("<4sIIII")
+_MAGIC = b"BZUC"
+_HEADER_SIZE = 64
+# Position of the clock hand
+_BUCKET_HEADER = struct.Struct("<B7x")
+# Hash of the key (0 for free slots), expiration timestamp, length of the value, length of the key,
+# referenced bit for the clock algorithm
+_SLOT_HEADER = struct.Struct("<QdIHBx")
+_SLOT_HASH = struct.Struct("<Q")
+
+
+class SharedCache:
+    """Cache of raw (encoded) values in a memory-mapped file that is shared by all processes on a host.
+
+    The file contains a fixed-size hash table of buckets with SHARED_CACHE_WAYS slots, a key can
+    be stored in any slot of the bucket given by its hash. If all slots of a bucket are taken, an
+    item that wasn't read recently is evicted with the clock algorithm. Buckets are locked with
+    fcntl record locks for other processes and with thread locks within the process.
+
+    Expiration times are wall clock timestamps, as they're shared between processes.
+    """
+
+    def __init__(self, path, size, slot_size, ttl):
+        self.path = path
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bucket_size = _BUCKET_HEADER.size + SHARED_CACHE_WAYS * slot_size
+        self.buckets = max(1, (size - _HEADER_SIZE) // self._bucket_size)
+        self._thread_locks = [threading.Lock() for _ in range(64)]
+
+        # The file may be in a directory that other users can write to, so it mustn't be a symlink
+        # or a file of another user, who could put values into it
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            file_stat = os.fstat(self._fd)
+            if file_stat.st_uid != os.geteuid() or file_stat.st_mode & 0o022 \
+                    or not stat.S_ISREG(file_stat.st_mode):
+                raise PermissionError("Shared cache %s must be a file of this user that others can't write to"
+                                      % path)
+            file_size = _HEADER_SIZE + self.buckets * self._bucket_size
+            header = _HEADER.pack(_MAGIC, 1, slot_size, self.buckets, SHARED_CACHE_WAYS)
+            # The first process creates the file, the others wait until it's done
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                existing = os.pread(self._fd, _HEADER.size, 0)
+                if not existing.strip(b"\0"):
+                    os.ftruncate(self._fd, file_size)
+                    os.pwrite(self._fd, header, 0)
+                elif existing != header:
+                    raise ValueError("Shared cache %s was created with different size options" % path)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            self._mm = mmap.mmap(self._fd, file_size)
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def get(self, key):
+        """Return the value stored for ``key`` or None if it's missing or expired."""
+        key = key.encode("utf-8")
+        key_hash = self._hash(key)
+        bucket = key_hash % self.buckets
+        with self._locked(bucket):
+            offset = self._find(bucket, key_hash, key)
+            if offset is not None:
+                _, expires_at, value_length, key_length, _ = _SLOT_HEADER.unpack_from(self._mm, offset)
+                if expires_at > time.time():
+                    self._mm[offset + _SLOT_HEADER.size - 2] = 1
+                    self.hits += 1
+                    start = offset + _SLOT_HEADER.size + key_length
+                    return self._mm[start:start + value_length]
+                self._free(offset)
+        self.misses += 1
+        return None
+
+    def set(self, key, value, expirein=None):
+        """Store ``value`` for at most ``expirein`` seconds (capped by the cache's ttl).
+
+        Values that don't fit into a slot are not cached.
+        """
+        key = key.encode("utf-8")
+        key_hash = self._hash(key)
+        bucket = key_hash % self.buckets
+        fits = isinstance(value, bytes) and _SLOT_HEADER.size + len(key) + len(value) <= self.slot_size
+        with self._locked(bucket):
+            offset = self._find(bucket, key_hash, key)
+            if not fits:
+                if offset is not None:
+                    self._free(offset)
+                return
+            if offset is None:
+                offset = self._victim(bucket)
+            ttl = min(expirein, self.ttl) if expirein else self.ttl
+            # A process can be killed in the middle of writing, so the slot is freed first and
+            # the hash, which makes the slot used, is written last
+            self._free(offset)
+            start = offset + _SLOT_HEADER.size
+            self._mm[start:start + len(key) + len(value)] = key + value
+            _SLOT_HEADER.pack_into(self._mm, offset, 0, time.time() + ttl, len(value), len(key), 0)
+            _SLOT_HASH.pack_into(self._mm, offset, key_hash)
+
+    def delete(self, key):
+        key = key.encode("utf-8")
+        key_hash = self._hash(key)
+        bucket = key_hash % self.buckets
+        with self._locked(bucket):
+            offset = self._find(bucket, key_hash, key)
+            if offset is not None:
+                self._free(offset)
+
+    def clear(self):
+        with self._locked(None):
+            for bucket in range(self.buckets):
+                for way in range(SHARED_CACHE_WAYS):
+                    self._free(self._slot(bucket, way))
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+    def stats(self):
+        entries = 0
+        now = time.time()
+        for bucket in range(self.buckets):
+            for way in range(SHARED_CACHE_WAYS):
+                key_hash, expires_at, _, _, _ = _SLOT_HEADER.unpack_from(self._mm, self._slot(bucket, way))
+                if key_hash and expires_at > now:
+                    entries += 1
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "slots": self.buckets * SHARED_CACHE_WAYS,
+        }
+
+    @staticmethod
+    def _hash(key):
+        # The built-in hash() of strings differs between processes
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+    def _slot(self, bucket, way):
+        return (_HEADER_SIZE + bucket * self._bucket_size + _BUCKET_HEADER.size
+                + way * self.slot_size)
+
+    def _find(self, bucket, key_hash, key):
+        """Returns the offset of the slot that contains key, None if it's not in the cache."""
+        for way in range(SHARED_CACHE_WAYS):
+            offset = self._slot(bucket, way)
+            slot_hash, _, _, key_length, _ = _SLOT_HEADER.unpack_from(self._mm, offset)
+            if slot_hash == key_hash and key_length == len(key):
+                start = offset + _SLOT_HEADER.size
+                if self._mm[start:start + key_length] == key:
+                    return offset
+        return None
+
+    def _victim(self, bucket):
+        """Returns the offset of a free or expired slot of the bucket, or evicts an item
+        that wasn't read since the clock hand passed it the last time."""
+        now = time.time()
+        for way in range(SHARED_CACHE_WAYS):
+            offset = self._slot(bucket, way)
+            slot_hash, expires_at, _, _, _ = _SLOT_HEADER.unpack_from(self._mm, offset)
+            if not slot_hash or expires_at <= now:
+                return offset
+        bucket_offset = _HEADER_SIZE + bucket * self._bucket_size
+        hand = _BUCKET_HEADER.unpack_from(self._mm, bucket_offset)[0]
+        while True:
+            offset = self._slot(bucket, hand)
+            referenced_offset = offset + _SLOT_HEADER.size - 2
+            hand = (hand + 1) % SHARED_CACHE_WAYS
+            if not self._mm[referenced_offset]:
+                _BUCKET_HEADER.pack_into(self._mm, bucket_offset, hand)
+                self.evictions += 1
+                return offset
+            self._mm[referenced_offset] = 0
+
+    def _free(self, offset):
+        _SLOT_HEADER.pack_into(self._mm, offset, 0, 0, 0, 0, 0)
+
+    @contextlib.contextmanager
+    def _locked(self, bucket):
+        """Locks a bucket, or the whole cache if bucket is None."""
+        if bucket is None:
+            thread_locks = self._thread_locks
+            # Locks the whole file
+            start, length = 0, 0
+        else:
+            thread_locks = [self._thread_locks[bucket % len(self._thread_locks)]]
+            # Locks a byte per bucket, it doesn't need to be inside of the file
+            start, length = bucket + 1, 1
+        for lock in thread_locks:
+            lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+        finally:
+            for lock in thread_locks:
+                lock.release()
@@ -0,0 +1,158 @@
+"""
+Statistics of :mod:`brainzutils.cache`: latencies and payload sizes of commands, hit ratios of
+namespaces and the most frequently read keys. See :meth:`brainzutils.cache.command_stats` and
+:meth:`brainzutils.cache.hot_keys`.
+"""
+import bisect
+import math
+import random
+import threading
+
+# Upper bounds of the buckets of latency histograms, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# Upper bounds of the buckets of payload size histograms, in bytes
+PAYLOAD_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    """Counts values in buckets with fixed upper bounds, the last bucket has no upper bound."""
+
+    __slots__ = ("bounds", "counts", "total")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def percentile(self, q, count):
+        """Returns the upper bound of the bucket that contains the q-th quantile."""
+        seen = 0
+        for bound, bucket_count in zip(self.bounds, self.counts):
+            seen += bucket_count
+            if seen >= q * count:
+                return bound
+        return math.inf
+
+    def snapshot(self):
+        count = sum(self.counts)
+        return {
+            "count": count,
+            "sum": self.total,
+            "buckets": list(zip(self.bounds + (math.inf,), self.counts)),
+            "p50": self.percentile(0.5, count) if count else None,
+            "p99": self.percentile(0.99, count) if count else None,
+        }
+
+
+class Instrumentation:
+    """Statistics of commands and namespaces, see command_stats."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # command -> [calls, errors]
+        self._latencies = {}  # command -> Histogram
+        self._payloads = {}  # command -> Histogram
+        self._lookups = {}  # namespace -> [hits, misses]
+
+    def record_call(self, command, duration, error):
+        with self._lock:
+            calls = self._calls.get(command)
+            if calls is None:
+                calls = self._calls[command] = [0, 0]
+                self._latencies[command] = Histogram(LATENCY_BUCKETS)
+            calls[0] += 1
+            calls[1] += error
+            self._latencies[command].add(duration)
+
+    def record_payload(self, command, size):
+        with self._lock:
+            histogram = self._payloads.get(command)
+            if histogram is None:
+                histogram = self._payloads[command] = Histogram(PAYLOAD_BUCKETS)
+            histogram.add(size)
+
+    def record_lookups(self, namespace, hits, misses):
+        with self._lock:
+            lookups = self._lookups.setdefault(namespace or "", [0, 0])
+            lookups[0] += hits
+            lookups[1] += misses
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            commands = {
+                command: {"calls": calls, "errors": errors, "latency": self._latencies[command].snapshot()}
+                for command, (calls, errors) in self._calls.items()
+            }
+            for command, histogram in self._payloads.items():
+                commands.setdefault(command, {})["payload"] = histogram.snapshot()
+            namespaces = {
+                namespace: {"hits": hits, "misses": misses, "hit_ratio": hits / (hits + misses) if hits + misses else None}
+                for namespace, (hits, misses) in self._lookups.items()
+            }
+            if reset:
+                self._calls.clear()
+                self._latencies.clear()
+                self._payloads.clear()
+                self._lookups.clear()
+        return {"commands": commands, "namespaces": namespaces}
+
+
+class HotKeys:
+    """Finds the most frequently read keys of every namespace from a sample of the reads.
+
+    Numbers of reads are estimated with a count-min sketch per namespace, and the keys
+    with the highest estimates are kept in a small table.
+    """
+
+    SKETCH_WIDTH = 2048
+    SKETCH_DEPTH = 4
+
+    def __init__(self, sample_rate, top):
+        self.sample_rate = sample_rate
+        self.top = top
+        self._lock = threading.Lock()
+        self._namespaces = {}  # namespace -> (sketch, {key: estimated count})
+
+    def record(self, namespace, keys):
+        if self.sample_rate < 1:
+            keys = [key for key in keys if random.random() < self.sample_rate]
+            if not keys:
+                return
+        with self._lock:
+            namespace_keys = self._namespaces.get(namespace or "")
+            if namespace_keys is None:
+                sketch = [[0] * self.SKETCH_WIDTH for _ in range(self.SKETCH_DEPTH)]
+                namespace_keys = self._namespaces[namespace or ""] = (sketch, {})
+            sketch, top = namespace_keys
+            for key in keys:
+                estimate = None
+                # Every row hashes the key with its own number, so that keys which collide in one
+                # row don't collide in the others. Hashes of small ints are the ints themselves,
+                # so different bits of a single hash wouldn't be independent.
+                for row, counters in enumerate(sketch):
+                    i = hash((row, key)) % self.SKETCH_WIDTH
+                    counters[i] += 1
+                    if estimate is None or counters[i] < estimate:
+                        estimate = counters[i]
+                if key in top or len(top) < self.top:
+                    top[key] = estimate
+                else:
+                    coldest = min(top, key=top.get)
+                    if estimate > top[coldest]:
+                        del top[coldest]
+                        top[key] = estimate
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            result = {
+                namespace: sorted(((key, round(count / min(self.sample_rate, 1))) for key, count in top.items()),
+                                  key=lambda item: item[1], reverse=True)
+                for namespace, (_, top) in self._namespaces.items()
+            }
+            if reset:
+                self._namespaces.clear()
+        return result
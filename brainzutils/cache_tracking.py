@@ -0,0 +1,168 @@
+"""
+Client side caching of :mod:`brainzutils.cache` with invalidation messages of Redis 6+,
+see the ``client_tracking_*`` options of :meth:`brainzutils.cache.init`.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+import redis
+
+INVALIDATION_CHANNEL = "__redis__:invalidate"
+
+# Marks items of the client side cache that weren't decoded yet
+_NOT_DECODED = object()
+
+
+class TrackingCache:
+    """In-process cache of values that Redis tells us about when they change.
+
+    For every node, a background thread keeps a connection on which key tracking is
+    enabled in broadcasting mode for the prefixes of all tracked namespaces, and which
+    is subscribed to the invalidation messages of these keys. Items are only cached
+    while all of these connections are up, and everything is dropped when one is lost.
+
+    To avoid caching a value that was changed while it was being fetched, callers
+    take the current generation before fetching values. Every invalidation starts
+    a new generation and values fetched in an older one aren't cached.
+
+    Values are decoded with ``decode_val``, a function that takes a raw value and
+    its namespace.
+    """
+
+    def __init__(self, connection_factories, prefixes, max_entries, decode_val):
+        self.max_entries = max_entries
+        self._decode_val = decode_val
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._connection_factories = connection_factories
+        self._prefixes = prefixes
+        self._items = OrderedDict()  # key -> [raw value, decoded value or _NOT_DECODED]
+        self._generation = 0
+        self._connected_nodes = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = None
+
+    @property
+    def _connected(self):
+        return len(self._connected_nodes) == len(self._connection_factories)
+
+    def get_many(self, prepared_keys, decode, namespace):
+        """Looks up prepared keys, starting the listener threads on first use.
+
+        Returns:
+            The current generation, a list of values in the same order as the keys
+            (None for missing values) and a list of indexes of the missing keys.
+        """
+        values = [None] * len(prepared_keys)
+        missing = []
+        with self._lock:
+            if self._threads is None:
+                self._threads = [
+                    threading.Thread(target=self._listen, args=(node,), name="brainzutils-cache-invalidations",
+                                     daemon=True)
+                    for node in range(len(self._connection_factories))
+                ]
+                for thread in self._threads:
+                    thread.start()
+            for i, prepared_key in enumerate(prepared_keys):
+                item = self._items.get(prepared_key)
+                if item is None:
+                    missing.append(i)
+                    continue
+                self._items.move_to_end(prepared_key)
+                if decode and item[1] is _NOT_DECODED:
+                    item[1] = self._decode_val(item[0], namespace)
+                values[i] = item[1] if decode else item[0]
+            self.hits += len(prepared_keys) - len(missing)
+            self.misses += len(missing)
+            return self._generation, values, missing
+
+    def fill(self, values, missing, fetched, prepared_keys, decode, namespace, generation):
+        """Puts values fetched from Redis into the result of get_many and, if they're still
+        up to date, into the cache."""
+        for i, raw in zip(missing, fetched):
+            values[i] = self._decode_val(raw, namespace) if decode else raw
+        with self._lock:
+            if not self._connected or generation != self._generation:
+                return
+            for i, raw in zip(missing, fetched):
+                if raw is not None:
+                    self._items[prepared_keys[i]] = [raw, values[i] if decode else _NOT_DECODED]
+                    self._items.move_to_end(prepared_keys[i])
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def invalidate(self, prepared_keys):
+        """Removes items from the cache, all of them if ``prepared_keys`` is None."""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            if prepared_keys is None:
+                self._items.clear()
+                return
+            for prepared_key in prepared_keys:
+                if isinstance(prepared_key, bytes):
+                    prepared_key = prepared_key.decode("ascii")
+                self._items.pop(prepared_key, None)
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            self._connected_nodes.clear()
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "connected": self._connected,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "entries": len(self._items),
+            }
+
+    def _set_connected(self, node, connected):
+        with self._lock:
+            if connected:
+                self._connected_nodes.add(node)
+            else:
+                self._connected_nodes.discard(node)
+            self._generation += 1
+            self._items.clear()
+
+    def _listen(self, node):
+        while not self._stopped.is_set():
+            connection = self._connection_factories[node]()
+            try:
+                connection.connect()
+                connection.send_command("CLIENT", "ID")
+                client_id = connection.read_response()
+                prefixes = [arg for prefix in self._prefixes for arg in ("PREFIX", prefix)]
+                connection.send_command("CLIENT", "TRACKING", "ON", "REDIRECT", client_id, "BCAST", *prefixes)
+                connection.read_response()
+                connection.send_command("SUBSCRIBE", INVALIDATION_CHANNEL)
+                connection.read_response()
+                self._set_connected(node, True)
+                while not self._stopped.is_set():
+                    if connection.can_read(timeout=1):
+                        message = connection.read_response()
+                        if message[0] == b"message":
+                            # The list of keys is None when the database was flushed
+                            self.invalidate(message[2])
+            except redis.exceptions.ResponseError as e:
+                # Servers before Redis 6 reply with an unknown (sub)command or syntax error
+                message = str(e).lower()
+                if message.startswith("unknown") or message.startswith("syntax error"):
+                    logging.warning("Redis server doesn't support client side caching, it's disabled", exc_info=True)
+                else:
+                    logging.error("Couldn't enable client side caching, it's disabled", exc_info=True)
+                return
+            except (redis.exceptions.RedisError, OSError):
+                logging.warning("Lost connection for cache invalidation messages", exc_info=True)
+            finally:
+                self._set_connected(node, False)
+                connection.disconnect()
+            self._stopped.wait(1)
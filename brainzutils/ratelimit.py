@@ -135,8 +135,8 @@ class RateLimit(object):
         self.key = key_prefix + str(self.reset)
         self.limit = limit
         self.per = per
-        self.current = cache.increment(self.key, namespace=ratelimit_cache_namespace)
-        cache.expireat(self.key, self.reset + self.expiration_window, namespace=ratelimit_cache_namespace)
+        self.current = cache.incr_expire(self.key, self.seconds_before_reset + self.expiration_window,
+                                         namespace=ratelimit_cache_namespace)
 
     remaining = property(lambda x: max(x.limit - x.current, 0))
     over_limit = property(lambda x: x.current > x.limit)
@@ -1,14 +1,22 @@
 # pylint: disable=protected-access
 
+import asyncio
 import datetime
+import decimal
+import inspect
 import os
+import pickle
+import sys
+import tempfile
+import threading
 import unittest
+import uuid
 from time import sleep, time
 
 from unittest import mock
 import redis
 
-from brainzutils import cache
+from brainzutils import cache, cache_shared, cache_stats
 
 
 class CacheTestCase(unittest.TestCase):
@@ -76,6 +84,229 @@ class CacheTestCase(unittest.TestCase):
         self.assertTrue(cache.set('some_other_time', dictionary, expirein=0))
         self.assertEqual(cache.get('some_other_time'), dictionary)
 
+    def test_compression(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, compression_threshold=100)
+        value = {"tracks": [{"title": "Track %d" % i, "length": 180000} for i in range(100)]}
+        self.assertTrue(cache.set("release", value, expirein=0))
+        self.assertTrue(cache.set("small", "small value", expirein=0))
+        self.assertTrue(cache.set("random", os.urandom(200), expirein=0))
+
+        raw = cache.get_many(["release", "small", "random"], decode=False)
+        self.assertLess(len(raw["release"]), len(cache.msgpack.packb(value)) / 2)
+        self.assertEqual(raw["small"], cache.msgpack.packb("small value"))
+        self.assertGreater(len(raw["random"]), 200)
+        self.assertEqual(cache.get("release"), value)
+
+        # Compressed values can be read when compression is disabled, and the other way around
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+        self.assertEqual(cache.get("release"), value)
+        self.assertTrue(cache.set("uncompressed", value, expirein=0))
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, compression_threshold=100)
+        self.assertEqual(cache.get("uncompressed"), value)
+
+    def test_ext_types(self):
+        value = {
+            "mbid": uuid.UUID("f27ec8db-af05-4f36-916e-3d57f91ecf5e"),
+            "date": datetime.date(1962, 10, 5),
+            "naive": datetime.datetime(2020, 1, 2, 3, 4, 5, 678901),
+            "aware": datetime.datetime(1960, 1, 2, 3, 4, 5, tzinfo=datetime.timezone(datetime.timedelta(hours=-5))),
+            "price": decimal.Decimal("12.34"),
+        }
+        self.assertTrue(cache.set("value", value, expirein=0))
+        decoded = cache.get("value")
+        self.assertEqual(decoded, value)
+        self.assertEqual(decoded["aware"].utcoffset(), datetime.timedelta(hours=-5))
+        self.assertIsInstance(decoded["date"], datetime.date)
+        self.assertNotIsInstance(decoded["date"], datetime.datetime)
+
+        # An UUID takes 18 bytes instead of 38 as a string
+        self.assertEqual(len(cache._encode_val(value["mbid"])), 18)
+
+    def test_legacy_datetime(self):
+        value = datetime.datetime(2020, 1, 2, 3, 4, 5)
+        cache._r.set(cache._prep_key("old"), cache.msgpack.packb(
+            cache.msgpack.ExtType(cache.TYPE_DATETIME_CODE, value.isoformat().encode("utf-8"))))
+        self.assertEqual(cache.get("old"), value)
+
+    def test_reset(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, local_cache_namespaces=["local"])
+        cache.set("a", 1, expirein=100, namespace="local")
+        client = cache._r
+        cache.reset()
+        self.assertIsNot(cache._r, client)
+        self.assertEqual(cache.local_cache_stats()["entries"], 0)
+        self.assertEqual(cache.get("a", namespace="local"), 1)
+        self.assertEqual(cache._glob_namespace, self.namespace + ":")
+
+    @unittest.skipUnless(hasattr(os, "fork"), "Requires os.fork")
+    def test_fork(self):
+        cache.set("a", 1, expirein=100)
+        client = cache._r
+        pid = os.fork()
+        if pid == 0:
+            # Child process, report failures with the exit code
+            try:
+                ok = cache._r is not client and cache.get("a") == 1 and cache.set("b", 2, expirein=100)
+            except BaseException:  # pylint: disable=broad-except
+                ok = False
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertIs(cache._r, client)
+        self.assertEqual(cache.get_many(["a", "b"]), {"a": 1, "b": 2})
+
+    def test_chunks(self):
+        for pipeline_chunks in (False, True):
+            cache.init(host=self.host, port=self.port, namespace=self.namespace, chunk_size=10,
+                       pipeline_chunks=pipeline_chunks)
+            mapping = {"key%d" % i: i for i in range(35)}
+            with mock.patch.object(cache._r, "mget", wraps=cache._r.mget) as mget:
+                self.assertTrue(cache.set_many(mapping, expirein=0))
+                self.assertTrue(cache.set_many(mapping, expirein=100))
+                self.assertEqual(cache.get_many(list(mapping.keys())), mapping)
+                self.assertEqual(mget.call_count, 0 if pipeline_chunks else 4)
+            self.assertGreater(cache._r.pttl(cache._prep_key("key34")), 0)
+            self.assertEqual(cache.delete_many(list(mapping.keys()) + ["missing"]), 35)
+
+    def test_get_many_iter(self):
+        cache.set_many({"key%d" % i: i for i in range(25)}, expirein=100)
+        keys = ("key%d" % i for i in range(30))
+        items = cache.get_many_iter(keys, chunk_size=10)
+        self.assertEqual(next(items), ("key0", 0))
+        self.assertEqual(list(items)[-6:], [("key24", 24)] + [("key%d" % i, None) for i in range(25, 30)])
+
+        async def collect():
+            return [item async for item in cache.aget_many_iter(["key1", "key2", "key30"], chunk_size=2)]
+
+        self.assertEqual(asyncio.run(collect()), [("key1", 1), ("key2", 2), ("key30", None)])
+
+    def test_tags(self):
+        cache.set_many({"rg1": 1, "rg2": 2}, expirein=100, namespace="release_group",
+                       tags={"rg1": ["artist1"], "rg2": ["artist1", "artist2"]})
+        cache.set_many({"rec1": 1}, expirein=0, namespace="recording", tags=["artist2"])
+        cache.set_many({"rec2": 2}, expirein=50, namespace="recording", tags=["artist1"])
+        tag_key = cache._tag_key("artist1")
+        self.assertGreater(cache._r.pttl(tag_key), 99000)
+        self.assertEqual(cache._r.pttl(cache._tag_key("artist2")), -1)
+        self.assertEqual(cache._r.scard(tag_key), 3)
+
+        self.assertEqual(cache.invalidate_tags(["artist1", "missing"], count=2), 3)
+        self.assertEqual(cache.get_many(["rg1", "rg2"], namespace="release_group"), {"rg1": None, "rg2": None})
+        self.assertEqual(cache.get("rec1", namespace="recording"), 1)
+        self.assertIsNone(cache.get("rec2", namespace="recording"))
+        self.assertFalse(cache._r.keys(tag_key + "*"))
+        self.assertEqual(cache.invalidate_tags(["artist2"]), 1)
+        self.assertIsNone(cache.get("rec1", namespace="recording"))
+
+    def test_tags_async(self):
+        async def run():
+            await cache.aset_many({"a": 1, "b": 2}, expirein=100, tags=["t"])
+            await cache.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(cache.invalidate_tags(["t"]), 2)
+        self.assertEqual(cache.get_many(["a", "b"]), {"a": None, "b": None})
+
+    def test_async_event_loops(self):
+        cache.set("a", 1, expirein=100)
+        # Every event loop gets its own clients
+        self.assertEqual(asyncio.run(cache.aget("a")), 1)
+        self.assertEqual(asyncio.run(cache.aget("a")), 1)
+
+        async def run():
+            self.assertEqual(await cache.aget("a"), 1)
+            await cache.aclose()
+            self.assertEqual(await cache.aget("a"), 1)
+            await cache.aclose()
+
+        asyncio.run(run())
+
+    def test_hash_many(self):
+        self.assertTrue(cache.hset_many("artist", {"name": "Björk", "tags": ["pop"], "rating": 5}, expirein=100))
+        self.assertGreater(cache._r.pttl(cache._prep_key("artist")), 99000)
+        self.assertEqual(cache.hmget("artist", ["name", "missing"]), {"name": "Björk", "missing": None})
+        self.assertEqual(cache.hgetall("artist", decode=True), {"name": "Björk", "tags": ["pop"], "rating": 5})
+        self.assertEqual(cache.hgetall("artist")[b"rating"], cache._encode_val(5))
+
+        self.assertTrue(cache.hset_multi({"a": {"x": 1}, "b": {"x": b"2", "y": b"3"}, "c": {}}, expirein=None,
+                                         encode=False, namespace="ns"))
+        self.assertEqual(cache._r.pttl(cache._prep_key("a", "ns")), -1)
+        self.assertEqual(cache.hmget_multi({"a": ["x"], "b": ["y", "x"], "c": ["x"]}, decode=False, namespace="ns"),
+                         {"a": {"x": b"1"}, "b": {"y": b"3", "x": b"2"}, "c": {"x": None}})
+
+    def test_absent(self):
+        self.assertTrue(cache.set_many({"a": 1, "b": cache.ABSENT}, expirein=100, absent_expirein=1))
+        self.assertEqual(cache.get_many(["a", "b", "c"]), {"a": 1, "b": cache.ABSENT, "c": None})
+        self.assertIs(cache.get("b"), cache.ABSENT)
+        self.assertGreater(cache._r.pttl(cache._prep_key("a")), 99000)
+        self.assertLessEqual(cache._r.pttl(cache._prep_key("b")), 1000)
+        self.assertIs(pickle.loads(pickle.dumps(cache.ABSENT)), cache.ABSENT)
+
+        # Without expiration times, ABSENT values still expire after absent_expirein
+        cache.set_many({"c": cache.ABSENT}, expirein=0, absent_expirein=1)
+        self.assertGreater(cache._r.pttl(cache._prep_key("c")), 0)
+
+    def test_cached_absent(self):
+        calls = []
+
+        @cache.cached(expirein=100, absent_expirein=100)
+        def fetch(mbid):
+            calls.append(mbid)
+            return None if mbid == "missing" else mbid.upper()
+
+        self.assertIsNone(fetch("missing"))
+        self.assertIsNone(fetch("missing"))
+        self.assertEqual(fetch("found"), "FOUND")
+        self.assertEqual(calls, ["missing", "found"])
+
+        @cache.cached(expirein=100, batch=True, absent_expirein=100)
+        def fetch_many(mbids):
+            calls.append(mbids)
+            return {mbid: mbid.upper() for mbid in mbids if mbid != "missing"}
+
+        self.assertEqual(fetch_many(["missing", "found"]), {"found": "FOUND"})
+        self.assertEqual(fetch_many(["missing", "found"]), {"found": "FOUND"})
+        self.assertEqual(calls[2:], [["missing", "found"]])
+
+    def test_custom_serializer(self):
+        class Point:
+            def __init__(self, x, y):
+                self.x, self.y = x, y
+
+        serializer = cache.MsgpackSerializer()
+        serializer.register(16, Point, lambda p: bytes([p.x, p.y]), lambda data: Point(data[0], data[1]))
+        with self.assertRaises(ValueError):
+            serializer.register(3, Point, bytes, bytes)
+
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, serializer=serializer,
+                   namespace_serializers={"json": cache.JSONSerializer()})
+        self.assertTrue(cache.set("point", Point(1, 2), expirein=0))
+        self.assertEqual(cache.get("point").y, 2)
+
+        self.assertTrue(cache.set("a", {"name": "Björk"}, expirein=0, namespace="json"))
+        self.assertEqual(cache.get("a", namespace="json"), {"name": "Björk"})
+        self.assertEqual(cache.get("a", namespace="json", decode=False), '{"name":"Björk"}'.encode("utf-8"))
+
+    def test_serializer_output_like_ext_type(self):
+        class TaggedSerializer:
+            """Writes a tag before the value, like CBOR does for some types."""
+
+            def dumps(self, value):
+                return b"\xd5\x03" + value.encode("ascii")
+
+            def loads(self, data):
+                return data[2:].decode("ascii")
+
+        cache.init(host=self.host, port=self.port, namespace=self.namespace,
+                   namespace_serializers={"tagged": TaggedSerializer()})
+        # "ab" looks like a refreshable value, "abc" like one with extra data
+        for value in ("ab", "abc"):
+            self.assertTrue(cache.set(value, value, expirein=0, namespace="tagged"))
+            self.assertEqual(cache.get(value, namespace="tagged"), value)
+        # Values written without the wrapper are still read
+        cache._r.set(cache._prep_key("old", namespace="tagged"), b"\xd5\x03abc")
+        self.assertEqual(cache.get("old", namespace="tagged"), "abc")
+
     def test_delete(self):
         key = "testing"
         self.assertTrue(cache.set(key, u"Пример", expirein=0))
@@ -114,6 +345,250 @@ class CacheTestCase(unittest.TestCase):
         self.assertTrue(cache.set_many(mapping, expirein=0))
         self.assertEqual(cache.get_many(list(mapping.keys())), mapping)
 
+    def test_many_expire(self):
+        mapping = {
+            "short": "Hello",
+            "long": "there",
+            "forever": "!",
+        }
+        self.assertTrue(cache.set_many(mapping, expirein=100, namespace="testing"))
+        for key in mapping:
+            self.assertAlmostEqual(cache._r.ttl(cache._prep_key(key, "testing")), 100, delta=1)
+
+        self.assertTrue(cache.set_many(mapping, expirein={"short": 1, "long": 100}))
+        self.assertAlmostEqual(cache._r.ttl(cache._prep_key("short")), 1, delta=1)
+        self.assertAlmostEqual(cache._r.ttl(cache._prep_key("long")), 100, delta=1)
+        self.assertEqual(cache._r.ttl(cache._prep_key("forever")), -1)
+        sleep(1.1)
+        self.assertEqual(cache.get_many(list(mapping.keys())), {"short": None, "long": "there", "forever": "!"})
+
+    def test_set_nx_xx(self):
+        self.assertFalse(cache.set("a", 1, expirein=0, xx=True))
+        self.assertIsNone(cache.get("a"))
+        self.assertTrue(cache.set("a", 1, expirein=0, nx=True))
+        self.assertFalse(cache.set("a", 2, expirein=0, nx=True))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertTrue(cache.set("a", 3, expirein=100, xx=True))
+        self.assertEqual(cache.get("a"), 3)
+
+        self.assertFalse(cache.set_many({"a": 4, "b": 5}, expirein=0, nx=True))
+        self.assertEqual(cache.get_many(["a", "b"]), {"a": 3, "b": 5})
+
+        with self.assertRaises(ValueError):
+            cache.set("a", 1, expirein=0, nx=True, xx=True)
+
+    def test_cached(self):
+        calls = []
+
+        @cache.cached(namespace="testing", expirein=100)
+        def square(x, offset=0):
+            calls.append(x)
+            return x * x + offset
+
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3, offset=1), 10)
+        self.assertEqual(calls, [3, 3])
+        self.assertEqual(cache.get(square.make_key(3), namespace="testing"), 9)
+
+        self.assertEqual(square.invalidate(3), 1)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(calls, [3, 3, 3])
+
+        # Functions with the same name in other modules don't share keys
+        def other_square(x):
+            return x * x
+        other_square.__qualname__ = square.__qualname__
+        other_square.__module__ = "other"
+        self.assertNotEqual(cache.cached(namespace="testing")(other_square).make_key(3), square.make_key(3))
+        self.assertTrue(square.make_key(3).startswith(__name__ + "."))
+
+    def test_cached_key_collisions(self):
+        @cache.cached(namespace="testing")
+        def join(*args, **kwargs):
+            return [list(args), kwargs]
+
+        calls = [(("a", "b"), {}), (("a_b",), {}), (("a b",), {}), (("offset=1",), {}),
+                 ((), {"offset": 1}), (("&#233;",), {}), (("\u00e9",), {}), (("a\\u",), {}),
+                 (("a\\", "u"), {})]
+        self.assertEqual(len({join.make_key(*args, **kwargs) for args, kwargs in calls}), len(calls))
+        for args, kwargs in calls:
+            self.assertEqual(join(*args, **kwargs), [list(args), kwargs])
+
+    def test_cached_batch(self):
+        calls = []
+
+        @cache.cached(namespace="testing", expirein=100, batch=True)
+        def fetch(ids, suffix=""):
+            calls.append(ids)
+            return {i: "item-%d%s" % (i, suffix) for i in ids if i != 404}
+
+        self.assertEqual(fetch([1, 2]), {1: "item-1", 2: "item-2"})
+        self.assertEqual(fetch([1, 2, 3, 404]), {1: "item-1", 2: "item-2", 3: "item-3"})
+        self.assertEqual(fetch([1], suffix="!"), {1: "item-1!"})
+        self.assertEqual(calls, [[1, 2], [3, 404], [1]])
+
+        fetch.invalidate([1, 2])
+        self.assertEqual(fetch([1, 2, 3]), {1: "item-1", 2: "item-2", 3: "item-3"})
+        self.assertEqual(calls[-1], [1, 2])
+
+    def test_pool_stats(self):
+        cache.get("a")
+        stats = cache.pool_stats()
+        self.assertEqual((stats["created"], stats["in_use"], stats["available"]), (1, 0, 1))
+
+    def test_blocking_pool(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, max_connections=2, pool_timeout=0.1)
+        cache.get("a")
+        self.assertEqual(cache.pool_stats(), {"max_connections": 2, "created": 1, "in_use": 0, "available": 1})
+
+        pool = cache._r.connection_pool
+        connections = [pool.get_connection(), pool.get_connection()]
+        self.assertEqual(cache.pool_stats()["in_use"], 2)
+        with self.assertRaises(redis.exceptions.ConnectionError):
+            cache.get("a")
+        for connection in connections:
+            pool.release(connection)
+        self.assertIsNone(cache.get("a"))
+
+    def test_get_or_compute(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            sleep(0.2)
+            return "computed"
+
+        threads = [threading.Thread(target=cache.get_or_compute, args=("a", compute, 100)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.get_or_compute("a", compute, 100), "computed")
+        self.assertEqual(len(calls), 1)
+
+    def test_get_or_compute_locked(self):
+        # Another process is computing the item
+        lock = cache._r.lock(cache._prep_key("a") + cache.LOCK_SUFFIX, timeout=10)
+        self.assertTrue(lock.acquire(blocking=False))
+
+        threading.Timer(0.2, cache.set, args=("a", "from other process", 100)).start()
+        self.assertEqual(cache.get_or_compute("a", lambda: "computed", 100), "from other process")
+
+        # The other process doesn't finish in time
+        self.assertEqual(cache.get_or_compute("b", lambda: "computed", 100, wait_timeout=0.1), "computed")
+
+        # A stale copy is returned without waiting
+        lock = cache._r.lock(cache._prep_key("c") + cache.LOCK_SUFFIX, timeout=10)
+        self.assertTrue(lock.acquire(blocking=False))
+        cache.set("c" + cache.STALE_SUFFIX, "stale", expirein=100)
+        self.assertEqual(cache.get_or_compute("c", lambda: "computed", 100, stale_ttl=100), "stale")
+
+    def test_get_or_compute_local_thread(self):
+        # Another thread of this process is computing the item
+        computing, finish = threading.Event(), threading.Event()
+
+        def compute():
+            computing.set()
+            finish.wait(10)
+            return "computed"
+
+        cache.set_many({"a" + cache.STALE_SUFFIX: "stale"}, expirein=100)
+        thread = threading.Thread(target=cache.get_or_compute, args=("a", compute, 100), kwargs={"stale_ttl": 100})
+        thread.start()
+        self.assertTrue(computing.wait(10))
+        try:
+            # The stale copy is returned without waiting for the thread
+            start = time()
+            self.assertEqual(cache.get_or_compute("a", lambda: "other", 100, stale_ttl=100), "stale")
+            self.assertLess(time() - start, 0.5)
+
+            # Without a stale copy the thread is only waited for up to wait_timeout
+            self.assertEqual(cache.get_or_compute("a", lambda: "other", 100, wait_timeout=0.1), "other")
+        finally:
+            finish.set()
+            thread.join()
+
+    def test_get_or_compute_stale_copy(self):
+        self.assertEqual(cache.get_or_compute("a", lambda: "computed", 1, stale_ttl=100), "computed")
+        sleep(1.1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("a" + cache.STALE_SUFFIX), "computed")
+
+    def test_get_with_refresh(self):
+        self.assertEqual(cache.get_with_refresh("a"), (None, True))
+        cache.set("a", "plain", expirein=100)
+        self.assertEqual(cache.get_with_refresh("a"), ("plain", False))
+
+        cache.set_many({"a": "slow", "b": "fast"}, expirein=100, compute_time={"a": 60, "b": 0.01})
+        cache.set("c", "single", expirein=100, compute_time=60)
+        self.assertEqual(cache.get_many(["a", "b"]), {"a": "slow", "b": "fast"})
+        with mock.patch.object(cache.random, "random", return_value=0.9):
+            # -log(0.1) * 60 > 100 seconds until expiry
+            self.assertEqual(cache.get_with_refresh("a"), ("slow", True))
+            self.assertEqual(cache.get_with_refresh("c"), ("single", True))
+            self.assertEqual(cache.get_with_refresh("b"), ("fast", False))
+            self.assertEqual(cache.get_with_refresh("a", beta=0.1), ("slow", False))
+
+    def test_get_or_compute_early_refresh(self):
+        self.assertEqual(cache.get_or_compute("a", lambda: "first", 100, beta=1), "first")
+        cache.set_many({"a": "first"}, expirein=100, compute_time=60)
+        with mock.patch.object(cache.random, "random", return_value=0.9):
+            self.assertEqual(cache.get_or_compute("a", lambda: "second", 100, beta=1), "second")
+            self.assertEqual(cache.get_or_compute("a", lambda: "third", 100, beta=1), "second")
+
+            # Somebody else is recomputing the item already
+            cache.set_many({"a": "second"}, expirein=100, compute_time=60)
+            lock = cache._r.lock(cache._prep_key("a") + cache.LOCK_SUFFIX, timeout=10)
+            self.assertTrue(lock.acquire(blocking=False))
+            self.assertEqual(cache.get_or_compute("a", lambda: "third", 100, beta=1), "second")
+
+    def test_invalidate_namespace(self):
+        cache.set("a", 1, namespace="testing", expirein=0)
+        cache.set("a", 2, namespace="other", expirein=0)
+        cache.set("a", 3, expirein=0)
+
+        self.assertEqual(cache.invalidate_namespace("testing"), 1)
+        self.assertEqual(cache.get_many(["a"], namespace="testing"), {"a": None})
+        self.assertEqual(cache.get("a", namespace="other"), 2)
+        self.assertEqual(cache.get("a"), 3)
+
+        cache.set("a", 4, namespace="testing", expirein=0)
+        self.assertEqual(cache.get("a", namespace="testing"), 4)
+        self.assertEqual(cache._prep_key("a", namespace="testing"), "NS_TEST:testing@1:a")
+
+    def test_invalidate_namespace_other_process(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, namespace_version_ttl=1)
+        cache.set("a", 1, namespace="testing", expirein=0)
+        # Another process invalidates the namespace
+        cache._r.incr(cache._namespace_version_key("testing"))
+        self.assertEqual(cache.get("a", namespace="testing"), 1)
+        sleep(1.1)
+        self.assertIsNone(cache.get("a", namespace="testing"))
+
+    def test_scan_keys(self):
+        cache.set_many({"a1": 1, "a2": 2, "b1": 3}, namespace="testing", expirein=0)
+        cache.set("a3", 4, namespace="other", expirein=0)
+        self.assertEqual(sorted(cache.scan_keys("testing", count=1)), ["a1", "a2", "b1"])
+        self.assertEqual(sorted(cache.scan_keys("testing", pattern="a*")), ["a1", "a2"])
+        self.assertEqual(sorted(cache.scan_keys(pattern="*:a*")), ["other:a3", "testing:a1", "testing:a2"])
+
+        cache.invalidate_namespace("testing")
+        self.assertEqual(list(cache.scan_keys("testing")), [])
+
+    def test_delete_pattern(self):
+        cache.set_many({"a%d" % i: i for i in range(10)}, namespace="testing", expirein=0)
+        cache.set_many({"b1": 1, "a1": 1}, namespace="other", expirein=0)
+        self.assertEqual(cache.delete_pattern("a*", namespace="testing", count=3), 10)
+        self.assertEqual(list(cache.scan_keys("testing")), [])
+        self.assertEqual(sorted(cache.scan_keys("other")), ["a1", "b1"])
+
+        with mock.patch.object(cache._r, "unlink", side_effect=redis.exceptions.ResponseError("unknown command")):
+            self.assertEqual(cache.delete_pattern(namespace="other"), 2)
+        self.assertFalse(cache._unlink_supported)
+        cache._unlink_supported = True
+
     def test_increment(self):
         cache.set("a", 1, encode=False, expirein=0)
         self.assertEqual(cache.increment("a"), 2)
@@ -140,6 +615,784 @@ class CacheTestCase(unittest.TestCase):
         cache.sadd("myset", ["a", "f", "d"], expirein=1000)
         cache.sadd("myset", "z", expirein=1000)
         self.assertEqual({"a", "b", "c", "d", "f", "z"}, cache.smembers("myset"))
+        self.assertAlmostEqual(cache._r.ttl(cache._prep_key("myset")), 1000, delta=1)
+
+    def test_set_members(self):
+        cache.sadd("myset", [1, "a", "b"], expirein=100)
+        self.assertEqual(sorted(map(str, cache.sscan_iter("myset", count=1))), ["1", "a", "b"])
+        self.assertTrue(cache.sismember("myset", "a"))
+        self.assertFalse(cache.sismember("myset", "c"))
+        self.assertEqual(cache.smismember("myset", ["a", "c", 1]), [True, False, True])
+        self.assertEqual(cache.smismember("myset", []), [])
+        self.assertEqual(cache.srem("myset", ["a", "c"]), 1)
+        self.assertEqual(cache.smembers("myset"), {1, "b"})
+        self.assertEqual(cache.smismember("myset", ["a", 1]), [False, True])
+
+        # Fallback for servers without SMISMEMBER
+        with mock.patch.object(cache, "_smismember_supported", False):
+            self.assertEqual(cache.smismember("myset", ["a", 1]), [False, True])
+
+    def test_incr_expire(self):
+        self.assertEqual(cache.incr_expire("counter", expirein=100), 1)
+        cache.expire("counter", 50)
+        # Later increments don't extend the expiration time
+        self.assertEqual(cache.incr_expire("counter", expirein=100, amount=2), 3)
+        self.assertAlmostEqual(cache._r.ttl(cache._prep_key("counter")), 50, delta=1)
+        self.assertEqual(cache.incr_expire("persistent", expirein=0), 1)
+        self.assertEqual(cache._r.ttl(cache._prep_key("persistent")), -1)
+
+    def test_getex_refresh(self):
+        cache.set("a", {"b": 1}, expirein=10)
+        self.assertEqual(cache.getex_refresh("a", expirein=100), {"b": 1})
+        self.assertAlmostEqual(cache._r.ttl(cache._prep_key("a")), 100, delta=1)
+        self.assertIsNone(cache.getex_refresh("missing", expirein=100))
+        self.assertEqual(cache.getex_refresh("a", expirein=0), {"b": 1})
+        self.assertAlmostEqual(cache._r.ttl(cache._prep_key("a")), 100, delta=1)
+        self.assertFalse(cache._r.exists(cache._prep_key("missing")))
+
+    def test_cas(self):
+        self.assertTrue(cache.cas("a", None, [1], expirein=100))
+        self.assertFalse(cache.cas("a", None, [2], expirein=100))
+        self.assertFalse(cache.cas("a", [2], [3], expirein=100))
+        self.assertTrue(cache.cas("a", [1], [3], expirein=0))
+        self.assertEqual(cache.get("a"), [3])
+        self.assertEqual(cache._r.ttl(cache._prep_key("a")), -1)
+        self.assertTrue(cache.cas("b", None, b"raw", expirein=100, encode=False))
+        self.assertTrue(cache.cas("b", b"raw", b"new", expirein=100, encode=False))
+        self.assertEqual(cache.get("b", decode=False), b"new")
+
+    def test_rpush_capped(self):
+        self.assertEqual(cache.rpush_capped("list", [1, 2, 3], max_length=5, expirein=100), 3)
+        self.assertEqual(cache.rpush_capped("list", range(4, 13), max_length=5), 5)
+        self.assertEqual(cache.lrange("list"), [8, 9, 10, 11, 12])
+        self.assertEqual(cache.lrange("list", 0, 1), [8, 9])
+        self.assertAlmostEqual(cache._r.ttl(cache._prep_key("list")), 100, delta=1)
+        self.assertEqual(cache.rpush_capped("big", range(3000), max_length=2500), 2500)
+        self.assertEqual(cache.lrange("big", -1), [2999])
+        with self.assertRaises(ValueError):
+            cache.rpush_capped("list", [1], max_length=0)
+
+    def test_scripts(self):
+        cache.register_script("test_set_get", "redis.call('SET', KEYS[1], ARGV[1]); return redis.call('GET', KEYS[1])")
+        self.assertEqual(cache.run_script("test_set_get", ["a"], ["b"], namespace="testing"), b"b")
+        self.assertEqual(cache.get("a", namespace="testing", decode=False), b"b")
+        # Scripts are loaded again if the server doesn't know them
+        cache._r.script_flush()
+        self.assertEqual(cache.run_script("test_set_get", ["a"], ["c"], namespace="testing"), b"c")
+        self.assertEqual(cache.incr_expire("counter", expirein=100), 1)
+
+
+class AsyncCacheTestCase(unittest.IsolatedAsyncioTestCase):
+    """Testing the asyncio versions of the cache functions."""
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = 6379
+    namespace = "NS_TEST"
+
+    async def asyncSetUp(self):
+        cache.init(
+            host=self.host,
+            port=self.port,
+            namespace=self.namespace,
+        )
+        cache.flush_all()
+
+    async def asyncTearDown(self):
+        await cache.aclose()
+
+    async def test_single(self):
+        self.assertTrue(await cache.aset("test", {"a": [1, 2]}, expirein=0, namespace="testing"))
+        self.assertEqual(await cache.aget("test", namespace="testing"), {"a": [1, 2]})
+        # Values are shared with the synchronous functions
+        self.assertEqual(cache.get("test", namespace="testing"), {"a": [1, 2]})
+        self.assertEqual(await cache.adelete("test", namespace="testing"), 1)
+        self.assertIsNone(await cache.aget("test", namespace="testing"))
+
+    async def test_many(self):
+        mapping = {"test1": "Hello", "test2": "there"}
+        self.assertTrue(await cache.aset_many(mapping, expirein=100))
+        self.assertAlmostEqual(cache._r.ttl(cache._prep_key("test1")), 100, delta=1)
+        self.assertEqual(await cache.aget_many(list(mapping.keys())), mapping)
+        self.assertFalse(await cache.aset_many({"test1": "Hi"}, expirein=0, nx=True))
+        self.assertEqual(await cache.adelete_many(list(mapping.keys())), 2)
+
+    async def test_coroutine_functions(self):
+        self.assertTrue(asyncio.iscoroutinefunction(cache.aget))
+        self.assertTrue(inspect.iscoroutinefunction(cache.aset_many))
+        self.assertTrue(inspect.isasyncgenfunction(cache.asscan_iter))
+        with mock.patch("brainzutils.cache.aget", autospec=True) as aget:
+            aget.return_value = 1
+            self.assertEqual(await cache.aget("a"), 1)
+
+        with mock.patch.object(cache, "_r", None):
+            with self.assertRaises(RuntimeError):
+                await cache.aget("a")
+            with self.assertRaises(RuntimeError):
+                [key async for key in cache.asscan_iter("a")]
+
+    async def test_namespace_version(self):
+        cache.invalidate_namespace("testing")
+        cache._r.incr(cache._namespace_version_key("testing"))
+        cache._namespace_versions.clear()
+        # The version is read with the async client, the event loop isn't blocked
+        with mock.patch.object(cache._r, "get", side_effect=AssertionError("sync GET")):
+            self.assertTrue(await cache.aset("a", 1, expirein=100, namespace="testing"))
+            self.assertEqual(await cache.aget("a", namespace="testing"), 1)
+            self.assertEqual(await cache.asadd("myset", "b", expirein=100, namespace="testing"), 1)
+            self.assertEqual([key async for key in cache.asscan_iter("myset", namespace="testing")], ["b"])
+        self.assertTrue(cache._r.exists(cache._prep_key("a", namespace="testing")))
+        self.assertIn("testing@2:a", cache._prep_key("a", namespace="testing"))
+
+    async def test_compute_time(self):
+        self.assertTrue(await cache.aset("a", "slow", expirein=100, compute_time=60))
+        with mock.patch.object(cache.random, "random", return_value=0.9):
+            self.assertEqual(cache.get_with_refresh("a"), ("slow", True))
+
+    async def test_concurrent(self):
+        await asyncio.gather(*(cache.aset(str(i), i, expirein=100) for i in range(10)))
+        values = await asyncio.gather(*(cache.aget(str(i)) for i in range(10)))
+        self.assertEqual(values, list(range(10)))
+
+    async def test_increment(self):
+        await cache.aset("a", 1, encode=False, expirein=0)
+        self.assertEqual(await cache.aincrement("a", amount=2), 3)
+
+    async def test_hash(self):
+        self.assertEqual(await cache.ahset("hash", "a", 1), 1)
+        self.assertEqual(await cache.ahincrby("hash", "a", 2), 3)
+        self.assertEqual(await cache.ahkeys("hash"), [b"a"])
+        self.assertEqual(await cache.ahgetall("hash"), {b"a": b"3"})
+        self.assertTrue(await cache.ahset_many("encoded", {"a": [1]}, expirein=100))
+        self.assertEqual(await cache.ahmget("encoded", ["a", "b"]), {"a": [1], "b": None})
+        self.assertEqual(await cache.ahgetall("encoded", decode=True), {"a": [1]})
+        self.assertEqual(await cache.ahdel("hash", "a"), 1)
+
+    async def test_set(self):
+        self.assertEqual(await cache.asadd("myset", {"a", "b"}, expirein=100), 2)
+        self.assertEqual(await cache.asadd("myset", "c", expirein=100), 1)
+        self.assertEqual(await cache.asmembers("myset"), {"a", "b", "c"})
+        self.assertAlmostEqual(cache._r.ttl(cache._prep_key("myset")), 100, delta=1)
+        self.assertEqual(await cache.asmismember("myset", ["a", "d"]), [True, False])
+        self.assertTrue(await cache.asismember("myset", "b"))
+        self.assertEqual(await cache.asrem("myset", "b"), 1)
+        self.assertEqual(sorted([key async for key in cache.asscan_iter("myset")]), ["a", "c"])
+
+    async def test_scripts(self):
+        cache._r.script_flush()
+        self.assertEqual(await cache.aincr_expire("counter", expirein=100, amount=2), 2)
+        self.assertAlmostEqual(cache._r.ttl(cache._prep_key("counter")), 100, delta=1)
+        self.assertTrue(await cache.acas("a", None, "x", expirein=10))
+        self.assertEqual(await cache.agetex_refresh("a", expirein=100), "x")
+        self.assertAlmostEqual(cache._r.ttl(cache._prep_key("a")), 100, delta=1)
+        self.assertEqual(await cache.arpush_capped("list", [1, 2, 3], max_length=2), 2)
+        self.assertEqual(await cache.alrange("list"), [2, 3])
+
+
+class LocalCacheTestCase(unittest.TestCase):
+    """Testing the in-process cache in front of redis."""
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = 6379
+    namespace = "NS_TEST"
+
+    def setUp(self):
+        cache.init(
+            host=self.host,
+            port=self.port,
+            namespace=self.namespace,
+            local_cache_namespaces=["local"],
+            local_cache_max_entries=3,
+            local_cache_max_bytes=100,
+            local_cache_ttl=1,
+        )
+        cache.flush_all()
+
+    def tearDown(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+
+    def test_get_from_local(self):
+        cache.set("a", "local value", expirein=0, namespace="local")
+        cache.set("a", "remote value", expirein=0, namespace="remote")
+        # Change the values behind the back of the local cache
+        cache._r.set(cache._prep_key("a", "local"), cache._encode_val("changed"))
+        cache._r.set(cache._prep_key("a", "remote"), cache._encode_val("changed"))
+
+        self.assertEqual(cache.get("a", namespace="local"), "local value")
+        self.assertEqual(cache.get("a", namespace="remote"), "changed")
+        self.assertEqual(cache.local_cache_stats()["hits"], 1)
+
+        # Values expire from the local cache after local_cache_ttl
+        sleep(1.1)
+        self.assertEqual(cache.get("a", namespace="local"), "changed")
+
+    def test_get_many_fills_local(self):
+        cache._r.mset({cache._prep_key("a", "local"): cache._encode_val(1)})
+        self.assertEqual(cache.get_many(["a", "b"], namespace="local"), {"a": 1, "b": None})
+        stats = cache.local_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (0, 2, 1))
+
+        self.assertEqual(cache.get_many(["a", "b"], namespace="local"), {"a": 1, "b": None})
+        stats = cache.local_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 3, 1))
+
+    def test_delete(self):
+        cache.set_many({"a": 1, "b": 2}, expirein=0, namespace="local")
+        cache.delete_many(["a", "b"], namespace="local")
+        self.assertEqual(cache.local_cache_stats()["entries"], 0)
+        self.assertIsNone(cache.get("a", namespace="local"))
+
+    def test_limits(self):
+        cache.set_many({"a": 1, "b": 2, "c": 3, "d": 4}, expirein=0, namespace="local")
+        stats = cache.local_cache_stats()
+        self.assertEqual((stats["entries"], stats["evictions"]), (3, 1))
+
+        cache.set("big", "x" * 80, expirein=0, namespace="local")
+        stats = cache.local_cache_stats()
+        self.assertLessEqual(stats["bytes"], 100)
+        self.assertEqual(cache.get("big", namespace="local"), "x" * 80)
+
+    def test_disabled(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+        self.assertIsNone(cache.local_cache_stats())
+
+
+class ShardingTestCase(unittest.TestCase):
+    """Testing distribution of keys between multiple nodes."""
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = 6379
+    namespace = "NS_TEST"
+    # Different databases of the same server stand in for different servers
+    nodes = [{"db_number": 1}, {"db_number": 2}]
+
+    def setUp(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, nodes=self.nodes)
+        cache.flush_all()
+
+    def tearDown(self):
+        cache.flush_all()
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+
+    def test_many(self):
+        mapping = {"key%d" % i: i for i in range(100)}
+        self.assertTrue(cache.set_many(mapping, expirein=100, namespace="testing"))
+        sizes = [client.dbsize() for client in cache._clients]
+        self.assertEqual(sum(sizes), 100)
+        self.assertTrue(all(size > 20 for size in sizes))
+
+        self.assertEqual(cache.get_many(list(mapping.keys()), namespace="testing"), mapping)
+        self.assertEqual(cache.get("key1", namespace="testing"), 1)
+        self.assertEqual(sorted(cache.scan_keys("testing")), sorted(mapping.keys()))
+        self.assertEqual(cache.delete_many(list(mapping.keys()), namespace="testing"), 100)
+
+    def test_consistent_hashing(self):
+        keys = [cache._prep_key("key%d" % i) for i in range(1000)]
+        nodes = [cache._node_index(key) for key in keys]
+
+        # The order of the nodes doesn't matter
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, nodes=list(reversed(self.nodes)))
+        self.assertEqual([1 - cache._node_index(key) for key in keys], nodes)
+
+        # Adding a node only moves keys to the new node
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, nodes=self.nodes + [{"db_number": 3}])
+        moved = [cache._node_index(key) for key in keys]
+        self.assertTrue(all(new in (old, 2) for old, new in zip(nodes, moved)))
+        self.assertLess(moved.count(2), 500)
+
+    def test_single_key_commands(self):
+        for i in range(10):
+            cache.hset("hash%d" % i, "a", i)
+            cache.increment("counter%d" % i)
+        self.assertEqual([cache.hgetall("hash%d" % i) for i in range(10)], [{b"a": str(i).encode()} for i in range(10)])
+        self.assertEqual(cache.get_many(["counter%d" % i for i in range(10)], decode=False),
+                         {"counter%d" % i: b"1" for i in range(10)})
+        self.assertEqual(cache.delete_pattern("*"), 20)
+
+    def test_scripts(self):
+        keys = ["key%d" % i for i in range(10)]
+        for key in keys:
+            self.assertEqual(cache.incr_expire(key, expirein=100), 1)
+        self.assertTrue(all(client.dbsize() > 0 for client in cache._clients))
+        with self.assertRaises(ValueError):
+            cache.run_script("incr_expire", keys, [1, 0])
+
+    def test_async(self):
+        async def run():
+            mapping = {"key%d" % i: i for i in range(20)}
+            self.assertTrue(await cache.aset_many(mapping, expirein=100))
+            self.assertEqual(await cache.aget_many(list(mapping.keys())), mapping)
+            self.assertEqual(await cache.adelete_many(list(mapping.keys())), 20)
+            await cache.aclose()
+
+        asyncio.run(run())
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """Testing routing of reads to replicas."""
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = 6379
+    namespace = "NS_TEST"
+    # A different database stands in for a replica, data isn't copied to it
+    replicas = [{"db_number": 2}]
+
+    def setUp(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, db_number=1, replicas=self.replicas)
+        cache.flush_all()
+        self.replica = cache._replica_clients[0][0]
+        self.replica.flushdb()
+
+    def tearDown(self):
+        cache.flush_all()
+        self.replica.flushdb()
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+
+    def test_reads_from_replica(self):
+        cache.set("a", 1, expirein=100)
+        cache.hset("hash", "f", 1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.hgetall("hash"), {})
+        self.assertEqual(cache.increment("counter"), 1)
+
+        self.replica.set(cache._prep_key("a"), cache._encode_val(2))
+        self.assertEqual(cache.get("a"), 2)
+        self.assertEqual(cache._r.get(cache._prep_key("a")), cache._encode_val(1))
+
+    def test_read_your_writes(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, db_number=1, replicas=self.replicas,
+                   read_your_writes=0.5)
+        self.replica.set(cache._prep_key("b"), cache._encode_val(2))
+        cache.set("a", 1, expirein=100)
+        self.assertEqual(cache.get_many(["a", "b"]), {"a": 1, "b": None})
+        self.assertEqual(cache.get("b"), 2)
+        sleep(0.6)
+        self.assertIsNone(cache.get("a"))
+
+    def test_read_your_writes_threads(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, db_number=1, replicas=self.replicas,
+                   read_your_writes=0.01)
+        errors = []
+
+        def write(n):
+            try:
+                for i in range(2000):
+                    cache._mark_written(["%d:%d" % (n, i)])
+                    cache._recently_written(["%d:%d" % (n, i)])
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(e)
+
+        # Switch threads as often as possible to make races likely
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    """Testing short-circuiting of calls while Redis is unavailable."""
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = 6379
+    namespace = "NS_TEST"
+
+    def tearDown(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+        cache.flush_all()
+
+    def init_unavailable(self, **kwargs):
+        # Nothing listens on port 1
+        cache.init(host="localhost", port=1, namespace=self.namespace, socket_connect_timeout=0.1,
+                   circuit_breaker_failures=2, circuit_breaker_reset_timeout=0.2, **kwargs)
+
+    def test_opens_after_failures(self):
+        self.init_unavailable()
+        self.assertEqual(cache.circuit_breaker_stats()["state"], "closed")
+        for _ in range(2):
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                cache.get("a")
+        self.assertEqual(cache.circuit_breaker_stats()["state"], "open")
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get_many(["a", "b"]), {"a": None, "b": None})
+        self.assertFalse(cache.set("a", 1, expirein=100))
+        self.assertEqual(cache.delete_many(["a"]), 0)
+        self.assertEqual(cache.hgetall("hash"), {})
+        self.assertEqual(cache.get_or_compute("a", lambda: 5, expirein=100), 5)
+        self.assertEqual(asyncio.run(cache.aget("a")), None)
+        stats = cache.circuit_breaker_stats()
+        self.assertEqual(stats["trips"], 1)
+        self.assertEqual(stats["failures"], 2)
+        self.assertEqual(stats["short_circuited"], 6)
+
+        # The probe fails and the circuit breaker opens again
+        sleep(0.2)
+        with self.assertRaises(redis.exceptions.ConnectionError):
+            cache.get("a")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.circuit_breaker_stats()["trips"], 2)
+
+    def test_raises_when_open(self):
+        self.init_unavailable(circuit_breaker_fail_silently=False)
+        for _ in range(2):
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                cache.set("a", 1, expirein=100)
+        with self.assertRaises(cache.CircuitOpenError):
+            cache.get("a")
+
+    def test_latency(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, circuit_breaker_failures=3,
+                   circuit_breaker_latency=0, circuit_breaker_reset_timeout=0.1)
+        cache.set("a", 1, expirein=100)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.circuit_breaker_stats()["state"], "open")
+        self.assertIsNone(cache.get("a"))
+
+        cache._breaker.latency = None
+        sleep(0.1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.circuit_breaker_stats()["state"], "closed")
+        self.assertEqual(cache.circuit_breaker_stats()["failures"], 0)
+
+    def test_probe_from_local_cache(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, circuit_breaker_failures=1,
+                   circuit_breaker_latency=0, circuit_breaker_reset_timeout=0.1, local_cache_namespaces=["local"])
+        cache.set("a", 1, expirein=100, namespace="local")
+        self.assertEqual(cache.circuit_breaker_stats()["state"], "open")
+
+        # A probe that is answered from the local cache doesn't close the circuit breaker
+        cache._breaker.latency = None
+        sleep(0.1)
+        self.assertEqual(cache.get("a", namespace="local"), 1)
+        self.assertEqual(cache.circuit_breaker_stats()["state"], "half_open")
+
+        # The next call is let through as a probe
+        self.assertTrue(cache.set("b", 2, expirein=100))
+        self.assertEqual(cache.circuit_breaker_stats()["state"], "closed")
+
+    def test_disabled(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+        self.assertIsNone(cache.circuit_breaker_stats())
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    """Testing statistics of commands and namespaces."""
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = 6379
+    namespace = "NS_TEST"
+
+    def setUp(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, instrumentation=True)
+        cache.flush_all()
+
+    def tearDown(self):
+        cache.flush_all()
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+
+    def test_command_stats(self):
+        cache.set_many({"a": 1, "b": "x" * 100}, expirein=100, namespace="ns")
+        cache.get("a", namespace="ns")
+        cache.get_many(["a", "b", "c"], namespace="ns")
+        cache.get("a")
+        cache.increment("counter")
+
+        stats = cache.command_stats()
+        self.assertEqual(stats["commands"]["get"]["calls"], 2)
+        self.assertEqual(stats["commands"]["get_many"]["calls"], 1)
+        self.assertEqual(stats["commands"]["increment"]["calls"], 1)
+        self.assertEqual(stats["commands"]["increment"]["errors"], 0)
+        self.assertNotIn("payload", stats["commands"]["increment"])
+        latency = stats["commands"]["get"]["latency"]
+        self.assertEqual(latency["count"], 2)
+        self.assertEqual(sum(count for _, count in latency["buckets"]), 2)
+        self.assertLessEqual(latency["p50"], latency["p99"])
+
+        payload = stats["commands"]["set_many"]["payload"]
+        self.assertEqual(payload["count"], 1)
+        self.assertEqual(payload["sum"], len(cache._encode_val(1)) + len(cache._encode_val("x" * 100)))
+        self.assertEqual(stats["commands"]["get_many"]["payload"]["sum"], payload["sum"])
+
+        self.assertEqual(stats["namespaces"]["ns"], {"hits": 3, "misses": 1, "hit_ratio": 0.75})
+        self.assertEqual(stats["namespaces"][""], {"hits": 0, "misses": 1, "hit_ratio": 0.0})
+
+        lock = cache._instrumentation._lock
+        cache.command_stats(reset=True)
+        self.assertEqual(cache.command_stats(), {"commands": {}, "namespaces": {}})
+        # Threads that wait for the lock while statistics are reset keep using the same lock
+        self.assertIs(cache._instrumentation._lock, lock)
+
+    def test_emit(self):
+        cache.get("a")
+        with mock.patch("brainzutils.metrics.set") as metrics_set:
+            cache.emit_command_stats()
+        self.assertEqual(metrics_set.call_count, 2)
+        command_call, namespace_call = metrics_set.call_args_list
+        self.assertEqual(command_call.kwargs["tags"], {"command": "get"})
+        self.assertEqual(command_call.kwargs["calls"], 1)
+        self.assertEqual(sum(v for k, v in command_call.kwargs.items() if k.startswith("latency_le_")), 1)
+        self.assertEqual(namespace_call.kwargs, {"tags": {"namespace": "none"}, "hits": 0, "misses": 1})
+        self.assertEqual(cache.command_stats()["commands"], {})
+
+    def test_disabled(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+        self.assertIsNone(cache.command_stats())
+
+
+class HotKeysTestCase(unittest.TestCase):
+    """Testing detection of frequently read keys."""
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = 6379
+    namespace = "NS_TEST"
+
+    def tearDown(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+
+    def test_hot_keys(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, hot_keys_sample_rate=1, hot_keys_top=3)
+        for _ in range(50):
+            cache.get("popular", namespace="artist")
+        for i in range(20):
+            cache.get_many(["key%d" % i, "less_popular"], namespace="artist")
+        cache.get("other")
+
+        top = cache.hot_keys()
+        self.assertEqual(top["artist"][:2], [("popular", 50), ("less_popular", 20)])
+        self.assertEqual(len(top["artist"]), 3)
+        self.assertEqual(top[""], [("other", 1)])
+
+        cache.hot_keys(reset=True)
+        self.assertEqual(cache.hot_keys(), {})
+
+    def test_int_keys(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, hot_keys_sample_rate=1)
+        # Keys whose hashes are equal modulo the width of the sketch
+        cache.get_many([0] * 10 + [cache_stats.HotKeys.SKETCH_WIDTH], namespace="artist")
+        self.assertEqual(cache.hot_keys()["artist"], [(0, 10), (cache_stats.HotKeys.SKETCH_WIDTH, 1)])
+
+    def test_sampling(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, hot_keys_sample_rate=0.1)
+        cache.get_many(["popular"] * 2000 + ["key%d" % i for i in range(100)])
+        key, count = cache.hot_keys()[""][0]
+        self.assertEqual(key, "popular")
+        self.assertAlmostEqual(count, 2000, delta=500)
+
+    def test_disabled(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+        self.assertIsNone(cache.hot_keys())
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    """Testing the cache in shared memory between the processes of a host."""
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = 6379
+    namespace = "NS_TEST"
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "shared")
+        cache.init(host=self.host, port=self.port, namespace=self.namespace,
+                   shared_cache_namespaces=["shared"], shared_cache_path=self.path)
+        cache.flush_all()
+
+    def tearDown(self):
+        cache.flush_all()
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+        os.remove(self.path)
+        os.rmdir(os.path.dirname(self.path))
+
+    def test_get(self):
+        cache.set("a", {"value": 1}, expirein=100, namespace="shared")
+        cache.set("b", 2, expirein=100)
+        cache._r.delete(cache._prep_key("a", "shared"), cache._prep_key("b"))
+        self.assertEqual(cache.get_many(["a", "b"], namespace="shared"), {"a": {"value": 1}, "b": None})
+        self.assertIsNone(cache.get("b"))
+
+        cache.delete("a", namespace="shared")
+        self.assertIsNone(cache._shared.get(cache._prep_key("a", "shared")))
+        stats = cache.shared_cache_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["entries"], 0)
+
+    def test_processes(self):
+        other = cache_shared.SharedCache(self.path, 64 * 1024 * 1024, 2048, 60)
+        cache.set("a", 1, expirein=100, namespace="shared")
+        self.assertEqual(other.get(cache._prep_key("a", "shared")), cache._encode_val(1))
+        other.close()
+
+        cache._r.delete(cache._prep_key("a", "shared"))
+        pid = os.fork()
+        if pid == 0:
+            try:
+                ok = cache.get("a", namespace="shared") == 1 and cache.set("b", 2, expirein=100, namespace="shared")
+            except BaseException:  # pylint: disable=broad-except
+                ok = False
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        cache._r.delete(cache._prep_key("b", "shared"))
+        self.assertEqual(cache.get("b", namespace="shared"), 2)
+
+        with self.assertRaises(ValueError):
+            cache_shared.SharedCache(self.path, 1024 * 1024, 512, 60)
+
+    def test_default_path(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace, db_number=1,
+                   shared_cache_namespaces=["shared"], shared_cache_size=1024 * 1024)
+        path = cache._shared.path
+        try:
+            self.assertIn("-%d-" % os.geteuid(), os.path.basename(path))
+            # Processes that use other databases don't share values
+            cache.init(host=self.host, port=self.port, namespace=self.namespace, db_number=2,
+                       shared_cache_namespaces=["shared"], shared_cache_size=1024 * 1024)
+            self.assertNotEqual(cache._shared.path, path)
+            os.remove(cache._shared.path)
+        finally:
+            os.remove(path)
+
+    def test_unsafe_file(self):
+        link = self.path + "-link"
+        os.symlink(self.path, link)
+        try:
+            with self.assertRaises(OSError):
+                cache_shared.SharedCache(link, 64 * 1024 * 1024, 2048, 60)
+        finally:
+            os.remove(link)
+
+        os.chmod(self.path, 0o666)
+        with self.assertRaises(PermissionError):
+            cache_shared.SharedCache(self.path, 64 * 1024 * 1024, 2048, 60)
+
+    def test_eviction(self):
+        path = self.path + "-small"
+        # A single bucket
+        shared = cache_shared.SharedCache(path, 64 + 8 + cache_shared.SHARED_CACHE_WAYS * 128, 128, 60)
+        try:
+            for i in range(cache_shared.SHARED_CACHE_WAYS):
+                shared.set("key%d" % i, b"value")
+            shared.get("key0")
+            shared.set("new", b"value")
+            self.assertEqual(shared.get("key0"), b"value")
+            self.assertIsNone(shared.get("key1"))
+            self.assertEqual(shared.stats()["evictions"], 1)
+            self.assertEqual(shared.stats()["entries"], cache_shared.SHARED_CACHE_WAYS)
+
+            # Values that don't fit into a slot replace older values
+            shared.set("new", b"x" * 128)
+            self.assertIsNone(shared.get("new"))
+
+            shared.set("expiring", b"value", expirein=0.1)
+            sleep(0.15)
+            self.assertIsNone(shared.get("expiring"))
+        finally:
+            shared.close()
+            os.remove(path)
+
+
+class ClientTrackingTestCase(unittest.TestCase):
+    """Testing client side caching with invalidation messages from redis."""
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = 6379
+    namespace = "NS_TEST"
+
+    def setUp(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+        if int(cache._r.info()["redis_version"].split(".")[0]) < 6:
+            self.skipTest("Client side caching requires Redis 6")
+        cache.init(
+            host=self.host,
+            port=self.port,
+            namespace=self.namespace,
+            client_tracking_namespaces=["tracked"],
+        )
+        cache.flush_all()
+        # The first access starts listening for invalidation messages
+        cache.get("a", namespace="tracked")
+        for _ in range(50):
+            if cache.client_tracking_stats()["connected"]:
+                break
+            sleep(0.1)
+
+    def tearDown(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+
+    def wait_for_invalidations(self, count, timeout=5):
+        """Waits until the number of invalidations reaches ``count``."""
+        deadline = time() + timeout
+        while cache.client_tracking_stats()["invalidations"] < count:
+            self.assertLess(time(), deadline, "Invalidation messages didn't arrive")
+            sleep(0.01)
+
+    def test_invalidation(self):
+        self.assertTrue(cache.client_tracking_stats()["connected"])
+        invalidations = cache.client_tracking_stats()["invalidations"]
+        cache.set("a", {"value": 1}, namespace="tracked", expirein=0)
+        # The write invalidates the item in the process and Redis also sends a message for it
+        self.wait_for_invalidations(invalidations + 2)
+        self.assertEqual(cache.get("a", namespace="tracked"), {"value": 1})
+        self.assertEqual(cache.get("a", namespace="tracked"), {"value": 1})
+        self.assertEqual(cache.get("a", namespace="tracked", decode=False), cache._encode_val({"value": 1}))
+        self.assertEqual(cache.client_tracking_stats()["hits"], 2)
+
+        # Another process changes the value
+        invalidations = cache.client_tracking_stats()["invalidations"]
+        cache._r.set(cache._prep_key("a", "tracked"), cache._encode_val({"value": 2}))
+        self.wait_for_invalidations(invalidations + 1)
+        self.assertEqual(cache.get("a", namespace="tracked"), {"value": 2})
+
+        invalidations = cache.client_tracking_stats()["invalidations"]
+        cache._r.flushdb()
+        self.wait_for_invalidations(invalidations + 1)
+        self.assertEqual(cache.client_tracking_stats()["entries"], 0)
+        self.assertIsNone(cache.get("a", namespace="tracked"))
+
+    def test_own_writes(self):
+        cache.set_many({"a": 1, "b": 2}, namespace="tracked", expirein=0)
+        self.assertEqual(cache.get_many(["a", "b"], namespace="tracked"), {"a": 1, "b": 2})
+        cache.set("a", 3, namespace="tracked", expirein=0)
+        self.assertEqual(cache.get("a", namespace="tracked"), 3)
+        cache.delete("b", namespace="tracked")
+        self.assertIsNone(cache.get("b", namespace="tracked"))
+
+    def test_overlapping_namespaces(self):
+        cache.init(
+            host=self.host,
+            port=self.port,
+            namespace=self.namespace,
+            client_tracking_namespaces=["release", "release_group"],
+        )
+        cache.get("a", namespace="release")
+        for _ in range(50):
+            if cache.client_tracking_stats()["connected"]:
+                break
+            sleep(0.1)
+        self.assertTrue(cache.client_tracking_stats()["connected"])
+
+        invalidations = cache.client_tracking_stats()["invalidations"]
+        cache.set("a", 1, namespace="release", expirein=0)
+        cache.set("a", 2, namespace="release_group", expirein=0)
+        # Both writes invalidate the items in the process and Redis also sends messages for them
+        self.wait_for_invalidations(invalidations + 4)
+        self.assertEqual(cache.get("a", namespace="release"), 1)
+        self.assertEqual(cache.get("a", namespace="release_group"), 2)
+        self.assertEqual(cache.get("a", namespace="release"), 1)
+        self.assertEqual(cache.get("a", namespace="release_group"), 2)
+        self.assertEqual(cache.client_tracking_stats()["hits"], 2)
+
+        # Versioned keys of an invalidated namespace are tracked too
+        cache.invalidate_namespace("release_group")
+        invalidations = cache.client_tracking_stats()["invalidations"]
+        cache.set("a", 3, namespace="release_group", expirein=0)
+        self.wait_for_invalidations(invalidations + 2)
+        self.assertEqual(cache.get("a", namespace="release_group"), 3)
+        invalidations = cache.client_tracking_stats()["invalidations"]
+        cache._r.set(cache._prep_key("a", "release_group"), cache._encode_val(4))
+        self.wait_for_invalidations(invalidations + 1)
+        self.assertEqual(cache.get("a", namespace="release_group"), 4)
+
+    def test_disabled(self):
+        cache.init(host=self.host, port=self.port, namespace=self.namespace)
+        self.assertIsNone(cache.client_tracking_stats())
 
 
 class CacheKeyTestCase(unittest.TestCase):
@@ -170,6 +1423,14 @@ class CacheKeyTestCase(unittest.TestCase):
         mock_redis.return_value.mset.assert_called_with({expected_key: expected_value})
         mock_redis.return_value.pexpire.assert_not_called()
 
+    def test_unix_socket(self):
+        cache.init(unix_socket_path='/run/redis.sock', namespace=self.namespace, socket_timeout=2)
+        pool = cache._r.connection_pool
+        self.assertIs(pool.connection_class, redis.UnixDomainSocketConnection)
+        self.assertEqual(pool.connection_kwargs["path"], '/run/redis.sock')
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 2)
+        self.assertNotIn("host", pool.connection_kwargs)
+
     @mock.patch('brainzutils.cache.redis.StrictRedis', autospec=True)
     def test_key_expire(self, mock_redis):
         cache.init(host='host', port=2, namespace=self.namespace)
@@ -177,5 +1438,9 @@ class CacheKeyTestCase(unittest.TestCase):
         expected_key = 'NS_TEST:key'
         # msgpack encoded value
         expected_value = b'\xc4\x05value'
-        mock_redis.return_value.mset.assert_called_with({expected_key: expected_value})
-        mock_redis.return_value.pexpire.assert_called_with(expected_key, 30000)
+        pipeline = mock_redis.return_value.pipeline
+        pipeline.assert_called_with(transaction=True)
+        pipeline.return_value.set.assert_called_with(expected_key, expected_value, px=30000, nx=False, xx=False)
+        pipeline.return_value.execute.assert_called_once()
+        mock_redis.return_value.mset.assert_not_called()
+        mock_redis.return_value.pexpire.assert_not_called()